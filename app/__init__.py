@@ -1,11 +1,62 @@
 # Import necessary modules and functions from Flask and Flask extensions
+import click
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
+from sqlalchemy import event
 
-# Initialize SQLAlchemy and Migrate objects
+# Initialize the SQLAlchemy object
 db = SQLAlchemy()
-migrate = Migrate()
+
+class MigrateCommands(click.Group):
+    """
+    The ``flask db`` command group of Flask-Migrate, loaded the first time it is used.
+    
+    Flask-Migrate imports Alembic, a large share of the app's import time, but only the
+    migration commands need it, so web and worker processes never load it.
+    """
+    
+    def __init__(self, app):
+        """
+        Initialize the group.
+        
+        Args:
+            app (Flask): The application whose database is migrated.
+        """
+        super().__init__("db", help="Perform database migrations.")
+        self._app = app
+        self._group = None
+    
+    def _load(self):
+        """Set up Flask-Migrate for the app and get its command group."""
+        if self._group is None:
+            from flask_migrate import Migrate
+            from flask_migrate.cli import db as db_cli_group
+            Migrate(self._app, db)
+            self._group = db_cli_group
+        return self._group
+    
+    def list_commands(self, ctx):
+        """List the migration commands."""
+        return self._load().list_commands(ctx)
+    
+    def get_command(self, ctx, name):
+        """Get a migration command by name."""
+        return self._load().get_command(ctx, name)
+
+def apply_sqlite_pragmas(engine, pragmas):
+    """
+    Run the configured PRAGMA statements on every new connection of a SQLite engine.
+    
+    Args:
+        engine (Engine): The SQLite engine.
+        pragmas (dict): PRAGMA names and values, e.g. {"journal_mode": "WAL"}.
+    """
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
 
 def create_app():
     """
@@ -17,18 +68,84 @@ def create_app():
     # Create a Flask application instance
     app = Flask(__name__, instance_relative_config=True)
     
-    # Load default configuration from a Python object
-    app.config.from_object('app.config.Config')
+    # Load the settings shared with the API classes and the workers
+    from app.config import get_settings
+    app.config.from_object(get_settings())
+    
+    # Send the app's logs through the background logging thread
+    from app.logs import configure_logging
+    configure_logging(app.config)
     
     # Initialize the SQLAlchemy extension with the app
     db.init_app(app)
-    # Initialize the Migrate extension with the app and database
-    migrate.init_app(app, db)
+    # Register the migration commands; Flask-Migrate is only imported when they run
+    app.cli.add_command(MigrateCommands(app))
+    # Tune every new SQLite connection
+    if app.config["SQLALCHEMY_DATABASE_URI"].startswith("sqlite"):
+        with app.app_context():
+            apply_sqlite_pragmas(db.engine, app.config["SQLITE_PRAGMAS"])
     
     # Import the main Blueprint from the app.routes module
     from app.routes import main
     # Register the main Blueprint with the app
     app.register_blueprint(main)
     
+    # Apply the polling schedule and the publishing quota to the media container schedulers of every account
+    from app.scheduler import configure_schedulers, get_schedulers
+    configure_schedulers((
+        app.config["CONTAINER_POLL_INITIAL"],
+        app.config["CONTAINER_POLL_MAX"],
+        app.config["CONTAINER_POLL_BACKOFF"],
+        app.config["CONTAINER_MAX_WAIT"],
+    ), (
+        app.config["PUBLISH_QUOTA_LIMIT"],
+        app.config["PUBLISH_QUOTA_WINDOW"],
+        app.config["PUBLISH_QUOTA_RESERVE"],
+        app.config["PUBLISH_QUOTA_REFRESH"],
+    ), app)  # Each account's quota is shared through the database by every process that publishes to it
+    
+    # The known-hash filter and the fingerprint index are loaded from the post table on first use,
+    # so web processes and CLI commands that never check for duplicates do not read the whole table
+    from app.hashfilter import loaded_hash_filter, rebuild_hash_filter_command
+    app.cli.add_command(rebuild_hash_filter_command)
+    # Register the command that moves stored posts to the current hash version
+    from app.hashing import rehash_posts_command
+    app.cli.add_command(rehash_posts_command)
+    # Register the command that seeds the post table from the accounts' existing media
+    from app.backfill import backfill_command
+    app.cli.add_command(backfill_command)
+    
+    # Expose the scheduler's queues and the caches as gauges on /metrics
+    from app.metrics import registry
+    registry.gauge("reel_containers_pending", "Media containers waiting to finish or to be published.",
+                   lambda: sum(scheduler.pending() for scheduler in get_schedulers().values()))
+    registry.gauge("reel_publish_queue_depth", "Finished containers held back by the publishing quota.",
+                   lambda: sum(scheduler.snapshot()["queue_depth"] for scheduler in get_schedulers().values()))
+    from app.mediacache import media_cache_size
+    registry.gauge("reel_media_cache_bytes", "Size of the videos in the local media cache.", media_cache_size)
+    # Reported once the filter was loaded by a duplicate check
+    registry.gauge("reel_hash_filter_items", "Post hashes in the known-hash filter.",
+                   lambda: loaded_hash_filter().stats()["items"])
+    registry.gauge("reel_hash_filter_bytes", "Memory used by the known-hash Bloom filter.",
+                   lambda: loaded_hash_filter().stats()["bloom_bytes"])
+    registry.gauge("reel_hash_filter_false_positive_rate", "Estimated false-positive rate of the known-hash filter.",
+                   lambda: loaded_hash_filter().stats()["false_positive_rate"])
+    from app.leases import held_leases
+    registry.gauge("reel_leases_held", "Job and video leases held by this process.", held_leases)
+    
+    # Register the command that runs the reel job queue in its own process
+    # Worker threads are only started by it, by the gunicorn hooks in gunicorn.conf.py and by main.py,
+    # so other commands never claim jobs they would abandon on exit
+    from app.worker import worker_command
+    app.cli.add_command(worker_command)
+    # Register the command that sets a sender's priority and rate limit
+    from app.admission import sender_command
+    app.cli.add_command(sender_command)
+    # Register the command that signs profiling requests
+    from app.profiling import profile_token_command
+    app.cli.add_command(profile_token_command)
+    # Register the commands that manage the Instagram accounts
+    from app.accounts import account_cli
+    app.cli.add_command(account_cli)
     # Return the configured Flask application instance
     return app
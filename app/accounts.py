@@ -0,0 +1,171 @@
+# Import necessary modules for the account registry
+import logging
+import click
+from app.cache import TTLCache
+from app.config import get_settings
+from app.models import Account
+from app import db
+
+settings = get_settings()
+
+logger = logging.getLogger("LOLify.accounts")
+
+# Key of the account configured with PAGE_ID and ACCESS_TOKEN in the settings
+DEFAULT_KEY = "default"
+
+# Active accounts loaded from the database, reloaded every ACCOUNT_CACHE_TTL seconds
+_registry = TTLCache(settings.ACCOUNT_CACHE_TTL)
+
+class Credentials:
+    """
+    Everything needed to act as one Instagram account, detached from the database session
+    so it can be shared with the scheduler and worker threads.
+    """
+
+    __slots__ = ("key", "account_id", "page_id", "instagram_id", "access_token", "worker_threads")
+
+    def __init__(self, key, account_id, page_id, access_token, instagram_id=None, worker_threads=None):
+        """
+        Initialize the credentials.
+
+        Args:
+            key (str): Name of the account, DEFAULT_KEY for the account from the settings.
+            account_id (int): ID of the Account row, or None for the account from the settings.
+            page_id (str): ID of the Facebook Page linked to the account.
+            access_token (str): Page access token.
+            instagram_id (str): Instagram Business Account ID, if already known.
+            worker_threads (int): Size of the account's worker pool, if set.
+        """
+        self.key = key
+        self.account_id = account_id
+        self.page_id = page_id
+        self.access_token = access_token
+        self.instagram_id = instagram_id
+        self.worker_threads = worker_threads
+
+    @classmethod
+    def from_account(cls, account):
+        """Build the credentials of an Account row."""
+        return cls(account.name, account.id, account.page_id, account.access_token,
+                   account.instagram_id, account.worker_threads)
+
+def default_credentials():
+    """Get the credentials of the account configured with PAGE_ID and ACCESS_TOKEN."""
+    return Credentials(DEFAULT_KEY, None, settings.PAGE_ID, settings.ACCESS_TOKEN)
+
+def load_registry():
+    """
+    Load the active accounts from the database.
+
+    Returns:
+        dict: ``by_id`` maps account IDs to their credentials, and ``by_recipient`` maps
+            Instagram and Page IDs to the account webhooks sent to them are routed to.
+    """
+    by_id = {}
+    by_recipient = {}
+    for account in Account.query.filter_by(active=True).order_by(Account.id):
+        credentials = Credentials.from_account(account)
+        by_id[account.id] = credentials
+        by_recipient[account.page_id] = credentials
+        if account.instagram_id:
+            by_recipient[account.instagram_id] = credentials
+    db.session.commit()  # End the read transaction
+    return {"by_id": by_id, "by_recipient": by_recipient}
+
+def get_registry():
+    """Get the active accounts, loading them from the database at most every ACCOUNT_CACHE_TTL seconds."""
+    return _registry.get_or_load("accounts", load_registry)
+
+def invalidate_accounts():
+    """Reload the accounts on next use, after they were changed in this process."""
+    _registry.invalidate()
+
+def active_accounts():
+    """Get the credentials of every active account in the database."""
+    return list(get_registry()["by_id"].values())
+
+def get_credentials(account_id):
+    """
+    Get the credentials a job is published with.
+
+    Args:
+        account_id (int): ID of the job's account, or None for the account from the settings.
+
+    Returns:
+        Credentials: The account's credentials, or None if the account is missing or inactive.
+    """
+    if account_id is None:
+        return default_credentials()
+    return get_registry()["by_id"].get(account_id)
+
+def route_recipient(recipient_id):
+    """
+    Find the account a webhook event was sent to.
+
+    Args:
+        recipient_id (str): The Instagram or Page ID the event was sent to.
+
+    Returns:
+        Credentials: The registered account, the account from the settings for other recipients
+            if PAGE_ID is set, or None if no account can publish the event's reels.
+    """
+    credentials = get_registry()["by_recipient"].get(recipient_id) if recipient_id else None
+    if credentials is not None:
+        return credentials
+    if settings.PAGE_ID and settings.ACCESS_TOKEN:
+        return default_credentials()
+    return None
+
+@click.group("account")
+def account_cli():
+    """Manage the Instagram accounts served by this deployment."""
+
+@account_cli.command("add")
+@click.argument("name")
+@click.option("--page-id", required=True, help="ID of the Facebook Page linked to the account.")
+@click.option("--access-token", required=True, help="Page access token of the account.")
+@click.option("--instagram-id", help="Instagram Business Account ID; looked up from the Page when omitted.")
+@click.option("--worker-threads", type=int, help="Size of the account's worker pool.")
+def add_account_command(name, page_id, access_token, instagram_id, worker_threads):
+    """Register an account and route the webhooks sent to it."""
+    if not instagram_id:
+        # Imported here as the API classes depend on this module
+        from app.core import FacebookAPI
+        with FacebookAPI(Credentials(name, None, page_id, access_token)) as fapi:
+            instagram_id = fapi.get_instagram_id()
+        if not instagram_id:
+            raise click.ClickException("Could not find the Instagram Business Account of the Page")
+    account = Account(name=name, page_id=page_id, access_token=access_token,
+                      instagram_id=instagram_id, worker_threads=worker_threads)
+    db.session.add(account)
+    db.session.commit()
+    invalidate_accounts()
+    click.echo(f"Account {name}: Instagram ID {instagram_id}")
+
+@account_cli.command("update")
+@click.argument("name")
+@click.option("--access-token", help="New page access token.")
+@click.option("--worker-threads", type=int, help="Size of the account's worker pool (-1 for the default).")
+@click.option("--active/--inactive", default=None, help="Route webhooks to the account and process its jobs, or stop.")
+def update_account_command(name, access_token, worker_threads, active):
+    """Change an account; running processes pick the change up within ACCOUNT_CACHE_TTL seconds."""
+    account = Account.query.filter_by(name=name).first()
+    if account is None:
+        raise click.ClickException(f"No account named {name}")
+    if access_token:
+        account.access_token = access_token
+    if worker_threads is not None:
+        account.worker_threads = None if worker_threads < 0 else worker_threads
+    if active is not None:
+        account.active = active
+    db.session.commit()
+    invalidate_accounts()
+    click.echo(f"Account {account.name} updated")
+
+@account_cli.command("list")
+def list_accounts_command():
+    """List the registered accounts."""
+    for account in Account.query.order_by(Account.id):
+        threads = account.worker_threads if account.worker_threads is not None else settings.ACCOUNT_WORKER_THREADS
+        click.echo(f"{account.name}: page {account.page_id}, Instagram ID {account.instagram_id}, "
+                   f"{threads} worker(s), {'active' if account.active else 'inactive'}")
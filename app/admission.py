@@ -0,0 +1,191 @@
+# Import necessary modules for webhook admission control
+import logging
+from datetime import timedelta
+import click
+from app.config import get_settings
+from app.crud import get_or_create_users, advance_user_slot, count_ready_jobs
+from app.metrics import WEBHOOK_ADMISSIONS
+from app.models import Job, utcnow
+from app import db
+
+logger = logging.getLogger("LOLify.admission")
+
+# Decisions for an incoming reel
+QUEUED = "queued"
+DEFERRED = "deferred"
+DROPPED = "dropped"
+
+# Reasons recorded on deferred and dropped jobs
+SENDER_RATE_LIMITED = "sender_rate_limited"  # Deferred until the sender's rate allows it
+SENDER_OVER_LIMIT = "sender_over_limit"  # Dropped, the sender is further ahead of their rate than SENDER_MAX_DEFER
+INTAKE_FULL = "intake_full"  # Dropped, the account's intake queue holds INTAKE_QUEUE_SIZE ready jobs
+
+# How many times a sender's rate limiter is re-read when another process updates it concurrently
+_SLOT_RETRIES = 3
+
+def sender_limits(user, settings):
+    """
+    Get the rate limit of a sender.
+
+    Args:
+        user (User): The sender, or None for reels without a sender.
+        settings (Config): The app settings.
+
+    Returns:
+        tuple: (interval, tolerance) in seconds: the spacing of the sender's reels and how far
+            ahead of it a burst may run. (0, 0) means the sender is not rate limited.
+    """
+    rate = settings.SENDER_RATE_LIMIT
+    burst = settings.SENDER_BURST
+    if user is not None:
+        rate = user.rate_limit if user.rate_limit is not None else rate
+        burst = user.burst if user.burst is not None else burst
+    if user is None or rate <= 0:
+        return 0.0, 0.0
+    interval = 3600.0 / rate
+    return interval, max(0, burst - 1) * interval
+
+def schedule_sender(reels, user, now, depths, settings):
+    """
+    Decide the fate of one sender's reels with the generic cell rate algorithm.
+
+    The sender's ``next_slot`` is the theoretical arrival time of their next reel: it moves
+    one interval forward for every admitted reel. A reel arriving no more than the burst
+    tolerance ahead of it is queued right away; further ahead it is deferred until its slot,
+    and beyond SENDER_MAX_DEFER it is dropped. Reels of regular senders are dropped as well
+    while the intake queue of the account they were sent to is full.
+
+    Args:
+        reels (list[dict]): The sender's reels, in arrival order; decisions are written into them.
+        user (User): The sender, or None for reels without a sender.
+        now (datetime): The current time.
+        depths (dict): Ready jobs in the intake queue of each account (by ``account_id``) before these reels.
+        settings (Config): The app settings.
+
+    Returns:
+        tuple: The sender's new ``next_slot`` and the intake queue depths after these reels.
+    """
+    depths = dict(depths)
+    interval, tolerance = sender_limits(user, settings)
+    priority = user.priority if user is not None else 0
+    next_slot = user.next_slot if user is not None else None
+    max_defer = timedelta(seconds=settings.SENDER_MAX_DEFER)
+    for reel in reels:
+        reel.update(priority=priority, run_after=None, virtual_time=now, status=Job.PENDING, shed_reason=None,
+                    slot_interval=0)
+        account_id = reel.get("account_id")
+        if priority <= 0 and depths[account_id] >= settings.INTAKE_QUEUE_SIZE:
+            reel.update(status=Job.DROPPED, shed_reason=INTAKE_FULL)
+            continue
+        if interval:
+            slot = max(next_slot or now, now)
+            run_after = max(now, slot - timedelta(seconds=tolerance))
+            if run_after - now > max_defer:
+                reel.update(status=Job.DROPPED, shed_reason=SENDER_OVER_LIMIT)
+                continue
+            next_slot = slot + timedelta(seconds=interval)
+            reel["slot_interval"] = interval  # Given back if the reel turns out to be a redelivery
+            reel["virtual_time"] = slot  # Later reels of a busy sender take turns with other senders
+            if run_after > now:
+                reel.update(run_after=run_after, shed_reason=SENDER_RATE_LIMITED)
+                continue  # Deferred jobs do not count towards the intake queue
+        depths[account_id] += 1
+    return next_slot, depths
+
+def admit_reels(reels):
+    """
+    Apply per-sender rate limits, priorities and the per-account intake queue bound to a batch of reels.
+
+    Each reel is queued, deferred or dropped; deferred and dropped reels are still stored as
+    jobs with their reason, so the webhook can acknowledge every delivery immediately and
+    redeliveries of dropped reels are recognised. Once the reels are stored, ``settle_reels``
+    counts the decisions and gives back the slots of reels that were already queued.
+
+    Args:
+        reels (list[dict]): Reels with at least a ``sender_id`` and an optional ``account_id`` key, as passed to ``enqueue_jobs``.
+            ``priority``, ``run_after``, ``virtual_time``, ``status``, ``shed_reason`` and ``slot_interval`` are set on each.
+
+    Returns:
+        list[str]: The decision for each reel (QUEUED, DEFERRED or DROPPED), in order.
+    """
+    settings = get_settings()
+    now = utcnow()
+    users = get_or_create_users({reel["sender_id"] for reel in reels if reel.get("sender_id")})
+    depths = {account_id: count_ready_jobs(now, account_id) for account_id in {reel.get("account_id") for reel in reels}}
+    by_sender = {}
+    for reel in reels:
+        by_sender.setdefault(reel.get("sender_id"), []).append(reel)
+
+    for sender_id, sender_reels in by_sender.items():
+        user = users.get(sender_id)
+        for attempt in range(_SLOT_RETRIES):
+            expected = user.next_slot if user is not None else None
+            next_slot, new_depths = schedule_sender(sender_reels, user, now, depths, settings)
+            if user is None or next_slot == expected or advance_user_slot(user, expected, next_slot):
+                break
+            db.session.refresh(user)  # Another process admitted reels of this sender meanwhile
+        else:
+            # Still contended: let the reels through at the last computed slots rather than fail the webhook
+            logger.warning("Rate limiter of sender %s is contended, admitting without updating it", sender_id)
+        depths = new_depths
+
+    decisions = []
+    for reel in reels:
+        if reel["status"] == Job.DROPPED:
+            decision = DROPPED
+        elif reel["run_after"] is not None:
+            decision = DEFERRED
+        else:
+            decision = QUEUED
+        decisions.append(decision)
+    return decisions
+
+def settle_reels(reels, decisions, jobs):
+    """
+    Count the admission decisions of stored reels and undo the admission of redeliveries.
+
+    A reel whose job could not be inserted was already queued from the same delivery by
+    another process, so its sender's rate limiter is moved back by the slot it took and the
+    reel is left out of the admission metrics.
+
+    Args:
+        reels (list[dict]): The reels passed to ``admit_reels``.
+        decisions (list[str]): The decisions returned by ``admit_reels``.
+        jobs (list[Job]): The jobs returned by ``enqueue_jobs``, None for redeliveries.
+    """
+    refunds = {}
+    for reel, decision, job in zip(reels, decisions, jobs):
+        if job is not None:
+            WEBHOOK_ADMISSIONS.inc(decision=decision, reason=reel["shed_reason"] or "")
+        elif reel["slot_interval"]:
+            refunds[reel["sender_id"]] = refunds.get(reel["sender_id"], 0) + reel["slot_interval"]
+    users = get_or_create_users(set(refunds))
+    for sender_id, seconds in refunds.items():
+        user = users[sender_id]
+        for attempt in range(_SLOT_RETRIES):
+            expected = user.next_slot
+            if expected is None or advance_user_slot(user, expected, expected - timedelta(seconds=seconds)):
+                break
+            db.session.refresh(user)  # Another process admitted reels of this sender meanwhile
+        else:
+            logger.warning("Rate limiter of sender %s is contended, keeping the slots of redelivered reels", sender_id)
+
+@click.command("sender")
+@click.argument("instagram_id")
+@click.option("--priority", type=int, help="Scheduling priority; above 0 also skips intake shedding.")
+@click.option("--rate-limit", type=float, help="Reels per hour (0 for unlimited, -1 for the default).")
+@click.option("--burst", type=int, help="Reels allowed at once (-1 for the default).")
+def sender_command(instagram_id, priority, rate_limit, burst):
+    """Show or change the admission settings of a sender."""
+    user = get_or_create_users({instagram_id})[instagram_id]
+    if priority is not None:
+        user.priority = priority
+    if rate_limit is not None:
+        user.rate_limit = None if rate_limit < 0 else rate_limit
+    if burst is not None:
+        user.burst = None if burst < 0 else burst
+    db.session.commit()
+    settings = get_settings()
+    click.echo(f"Sender {user.instagram_id}: priority {user.priority}, "
+               f"rate limit {user.rate_limit if user.rate_limit is not None else settings.SENDER_RATE_LIMIT}/h, "
+               f"burst {user.burst if user.burst is not None else settings.SENDER_BURST}")
@@ -0,0 +1,211 @@
+# Import necessary modules for seeding the post table from an account's existing media
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import click
+from flask import current_app
+from app.config import get_settings
+
+logger = logging.getLogger("LOLify.backfill")
+
+# Media types with a video to fingerprint; images and albums are skipped
+VIDEO_TYPES = {"VIDEO", "REELS"}
+
+# Pages collected before the checkpoint is moved past them, even if the batch is not full,
+# and pages listed ahead of the one being collected at most
+CHECKPOINT_PAGES = 10
+
+def parse_timestamp(value):
+    """Parse a Graph API timestamp such as ``2024-05-01T12:00:00+0000`` into a naive UTC datetime."""
+    try:
+        return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S%z").astimezone(timezone.utc).replace(tzinfo=None)
+    except (TypeError, ValueError):
+        return None
+
+def fingerprint_video(url, version):
+    """
+    Download a video once, hashing it and sampling its frames for the perceptual fingerprint.
+
+    The media cache is bypassed: the account's whole history would evict the videos that
+    workers are about to need, for bytes that are only read once.
+
+    Args:
+        url (str): The URL of the video.
+        version (int): The hash version to compute.
+
+    Returns:
+        tuple: The hex digest of the video and its fingerprint as hex, if it could be computed.
+    """
+    # Imported here so that the commands do not load the Graph API modules until they run
+    from app.core import hash_video_from_url
+    from app.fingerprint import FingerprintSink, to_hex
+    sink = FingerprintSink.open()
+    try:
+        digests = hash_video_from_url(url, [version], sink=sink)
+    except Exception:
+        if sink:
+            sink.close()
+        raise
+    return digests[version], to_hex(sink.result() if sink else None)
+
+def _heartbeat(app, lease_ttl, stop):
+    """Renew the backfill's lease every JOB_HEARTBEAT_INTERVAL seconds until ``stop`` is set."""
+    from app import db
+    from app.leases import renew_leases
+    interval = app.config["JOB_HEARTBEAT_INTERVAL"]
+    while not stop.wait(interval):
+        with app.app_context():
+            try:
+                renew_leases(lease_ttl)
+            except Exception as e:
+                db.session.rollback()
+                logger.error("Failed to renew the backfill lease: %s", e)
+
+def run_backfill(credentials, concurrency=8, page_size=50, batch_size=200, restart=False):
+    """
+    Store a post for every video the account has published, so repeats of them are caught.
+
+    Pages of media are listed ahead while the videos of earlier pages are downloaded and
+    fingerprinted on ``concurrency`` threads; media that already have a post (e.g. those
+    published by this service) are not downloaded again. Results are stored in page order,
+    ``batch_size`` posts per transaction, together with the paging cursor of the next page,
+    so an interrupted run resumes after the last stored batch. The backfill holds a lease
+    on the account, so two runs never work on the same checkpoint.
+
+    Args:
+        credentials (Credentials): The account to backfill.
+        concurrency (int): Videos downloaded at once.
+        page_size (int): Media requested per Graph API page.
+        batch_size (int): Posts stored per transaction.
+        restart (bool): Start over from the newest media even if the last run is unfinished.
+
+    Returns:
+        dict: Media counted by result (added, duplicate, known, skipped, failed) and the elapsed seconds.
+
+    Raises:
+        click.ClickException: If another run is backfilling the account.
+        LeaseLost: If the lease was taken over by another run meanwhile.
+    """
+    # Imported here as the models need the app package to be initialized
+    from app.core import InstagramAPI
+    from app.crud import backfill_lease_name, known_media_ids, save_backfill_batch, start_backfill
+    from app.hashing import current_version
+    from app.leases import acquire_lease, release_lease
+    from app.metrics import BACKFILL_MEDIA
+    from app.models import utcnow
+    lease_ttl = get_settings().JOB_LEASE_TTL
+    lease_name = backfill_lease_name(credentials.key)
+    token = acquire_lease(lease_name, lease_ttl)
+    if token is None:
+        raise click.ClickException(f"Another backfill of {credentials.key} is running, or one stopped less than JOB_LEASE_TTL seconds ago")
+    counts = dict.fromkeys(("added", "duplicate", "known", "skipped", "failed"), 0)
+    started = time.monotonic()
+    stop = threading.Event()
+    try:
+        checkpoint = start_backfill(credentials.key, restart)
+        cursor = checkpoint.cursor
+        if cursor:
+            logger.info("Resuming the backfill of %s after %d media", credentials.key, checkpoint.media_seen)
+        version = current_version()
+        api = InstagramAPI(credentials)
+        pages = deque()  # Listed pages whose videos are downloading: (futures, next cursor, media count)
+        in_flight = 0
+        more = True
+        rows, seen, failed, pages_since_checkpoint = [], 0, 0, 0
+        executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="backfill")
+        # Keep the lease while downloads run, which may take longer than its TTL for a single page
+        heartbeat = threading.Thread(target=_heartbeat, args=(current_app._get_current_object(), lease_ttl, stop),
+                                     name="backfill-heartbeat", daemon=True)
+        heartbeat.start()
+        try:
+            while more or pages:
+                # List ahead until the pool has a queue to work through, but not so far that pages
+                # of known media go unsaved: those are checkpointed as they are collected
+                while more and in_flight < 2 * concurrency and len(pages) < CHECKPOINT_PAGES:
+                    media, cursor = api.get_media_page(after=cursor, limit=page_size)
+                    more = cursor is not None
+                    known = known_media_ids([item["id"] for item in media])
+                    futures = []
+                    for item in media:
+                        if item["id"] in known:
+                            counts["known"] += 1
+                        elif item.get("media_type") not in VIDEO_TYPES or not item.get("media_url"):
+                            counts["skipped"] += 1
+                        else:
+                            futures.append((item, executor.submit(fingerprint_video, item["media_url"], version)))
+                    pages.append((futures, cursor, len(media)))
+                    in_flight += len(futures)
+                # Collect the oldest page, keeping the checkpoint in page order
+                futures, page_cursor, page_media = pages.popleft()
+                in_flight -= len(futures)
+                for item, future in futures:
+                    try:
+                        hashed, fingerprint = future.result()
+                    except Exception as e:
+                        logger.warning("Could not fingerprint media %s: %s", item["id"], e)
+                        counts["failed"] += 1
+                        failed += 1
+                        continue
+                    published_at = parse_timestamp(item.get("timestamp"))
+                    rows.append({
+                        "caption": (item.get("caption") or "")[:2083],  # Trim the caption to fit the column
+                        "hashed": hashed,
+                        "hash_version": version,
+                        "fingerprint": fingerprint,
+                        "media_id": item["id"],
+                        "job_id": None,
+                        "published_at": published_at,
+                        # Place the post in the collection by when it was published, not when it was backfilled
+                        "created_at": published_at or utcnow(),
+                    })
+                seen += page_media
+                pages_since_checkpoint += 1
+                done = page_cursor is None
+                if done or len(rows) >= batch_size or pages_since_checkpoint >= CHECKPOINT_PAGES:
+                    inserted = save_backfill_batch(credentials.key, token, rows, page_cursor, seen, failed)
+                    counts["added"] += inserted
+                    counts["duplicate"] += len(rows) - inserted
+                    logger.info("Backfill of %s: %d media, %d posts added", credentials.key,
+                                sum(counts.values()), counts["added"])
+                    rows, seen, failed, pages_since_checkpoint = [], 0, 0, 0
+        finally:
+            # Videos not started yet are dropped, e.g. on Ctrl-C; those downloading finish first
+            executor.shutdown(wait=True, cancel_futures=True)
+            stop.set()
+            heartbeat.join()
+    finally:
+        release_lease(lease_name, token)
+        for result, count in counts.items():
+            BACKFILL_MEDIA.inc(count, result=result)
+    return dict(counts, seconds=time.monotonic() - started)
+
+@click.command("backfill")
+@click.option("--account", "account_name", help="Name of a registered account (defaults to the account from the settings).")
+@click.option("--concurrency", default=8, show_default=True, help="Videos downloaded and fingerprinted at once.")
+@click.option("--page-size", default=50, show_default=True, help="Media requested per Graph API page.")
+@click.option("--batch-size", default=200, show_default=True, help="Posts stored per transaction.")
+@click.option("--restart", is_flag=True, help="Start over from the newest media instead of resuming an interrupted run.")
+def backfill_command(account_name, concurrency, page_size, batch_size, restart):
+    """Store a post for every video the account already published, so reposts of them are caught as duplicates."""
+    from app.accounts import Credentials, default_credentials
+    from app.models import Account
+    if account_name:
+        account = Account.query.filter_by(name=account_name).first()
+        if account is None:
+            raise click.ClickException(f"No account named {account_name}")
+        credentials = Credentials.from_account(account)
+    else:
+        credentials = default_credentials()
+        if not (credentials.page_id and credentials.access_token):
+            raise click.ClickException("PAGE_ID and ACCESS_TOKEN are not set; pass --account")
+    result = run_backfill(credentials, max(1, concurrency), page_size, batch_size, restart)
+    processed = sum(count for key, count in result.items() if key != "seconds")
+    click.echo(f"Added:     {result['added']} post(s)")
+    click.echo(f"Duplicate: {result['duplicate']} video(s) already stored under another media")
+    click.echo(f"Known:     {result['known']} media already stored")
+    click.echo(f"Skipped:   {result['skipped']} media without a video")
+    click.echo(f"Failed:    {result['failed']} video(s) that could not be downloaded, retried by the next run")
+    click.echo(f"{processed} media in {result['seconds']:.1f}s ({processed / max(result['seconds'], 1e-6):.1f}/s)")
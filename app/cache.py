@@ -0,0 +1,167 @@
+# Import necessary modules for the in-process caches
+import heapq
+import threading
+import time
+from concurrent.futures import Future
+
+class TTLCache:
+    """
+    Thread-safe in-process cache whose entries expire after a time-to-live.
+
+    Expiry times are kept in a heap, so expired entries are dropped as new ones are
+    stored instead of piling up until they happen to be read again. With ``max_entries``
+    the entries closest to expiry are dropped early to stay within the limit.
+    """
+
+    def __init__(self, ttl, max_entries=None):
+        """
+        Initialize the cache.
+
+        Args:
+            ttl (float): Default number of seconds an entry stays valid.
+            max_entries (int): Largest number of entries kept, or None for no limit.
+        """
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._entries = {}
+        self._expiry = []  # Heap of (expires_at, key)
+        self._lock = threading.Lock()
+        self._loading = {}  # Key -> Future of the load in flight
+
+    def get(self, key, default=None):
+        """
+        Get a cached value.
+
+        Args:
+            key (str): The cache key.
+            default: Value returned when the key is missing or expired.
+
+        Returns:
+            The cached value, or ``default``.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return default
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Store a value.
+
+        Args:
+            key (str): The cache key.
+            value: The value to store.
+            ttl (float): Seconds the value stays valid (defaults to the cache TTL).
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._purge(now)
+            self._store(key, value, now + (self._ttl if ttl is None else ttl))
+
+    def add(self, key, value, ttl=None):
+        """
+        Store a value only if the key is missing or expired.
+
+        Args:
+            key (str): The cache key.
+            value: The value to store.
+            ttl (float): Seconds the value stays valid (defaults to the cache TTL).
+
+        Returns:
+            bool: True if the value was stored, False if the key was already present.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._purge(now)
+            if key in self._entries:
+                return False
+            self._store(key, value, now + (self._ttl if ttl is None else ttl))
+            return True
+
+    def _store(self, key, value, expires_at):
+        """Store an entry and schedule its expiry. Must be called with the lock held."""
+        self._entries[key] = (value, expires_at)
+        heapq.heappush(self._expiry, (expires_at, key))
+        while self._max_entries is not None and len(self._entries) > self._max_entries:
+            expires_at, key = heapq.heappop(self._expiry)
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] == expires_at:
+                del self._entries[key]
+
+    def _purge(self, now):
+        """Drop every entry that has expired. Must be called with the lock held."""
+        while self._expiry and self._expiry[0][0] <= now:
+            expires_at, key = heapq.heappop(self._expiry)
+            entry = self._entries.get(key)
+            # The key may have been stored again with a later expiry since
+            if entry is not None and entry[1] == expires_at:
+                del self._entries[key]
+
+    def get_or_load(self, key, loader, ttl=None):
+        """
+        Get a cached value, calling ``loader`` to fill it on a miss.
+
+        Only one thread loads a given key at a time, so a burst of misses results in a single
+        lookup whose result (or error) every waiting thread gets; misses of other keys load in
+        parallel. A loader returning None is not cached, so failed lookups are retried next time.
+
+        Args:
+            key (str): The cache key.
+            loader (callable): Called without arguments to produce the value.
+            ttl (float): Seconds the loaded value stays valid (defaults to the cache TTL).
+
+        Returns:
+            The cached or freshly loaded value.
+        """
+        missing = object()
+        value = self.get(key, missing)
+        if value is not missing:
+            return value
+        with self._lock:
+            loading = self._loading.get(key)
+            if loading is None:
+                loading = self._loading[key] = Future()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            return loading.result()
+        try:
+            # Another thread may have loaded the value between our miss and taking the lock
+            value = self.get(key, missing)
+            if value is missing:
+                value = loader()
+                if value is not None:
+                    self.set(key, value, ttl)
+            loading.set_result(value)
+            return value
+        except BaseException as e:
+            loading.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._loading[key]
+
+    def invalidate(self, key=None):
+        """
+        Drop one entry, or every entry when no key is given.
+
+        Args:
+            key (str): The cache key to drop.
+        """
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+                self._expiry.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def __len__(self):
+        """Get the number of entries that have not been purged yet."""
+        with self._lock:
+            return len(self._entries)
@@ -0,0 +1,169 @@
+# Import necessary modules for the post collection API
+import base64
+import hashlib
+import itertools
+import json
+from datetime import datetime
+from sqlalchemy import and_, or_
+from app.cache import TTLCache
+from app.config import get_settings
+from app.metrics import COLLECTION_REQUESTS
+from app.models import Post
+
+settings = get_settings()
+
+# Rendered pages of the collection, keyed by (generation, cursor, limit)
+page_cache = TTLCache(settings.COLLECTION_CACHE_TTL, max_entries=settings.COLLECTION_CACHE_SIZE)
+
+# Bumped whenever the collection changes, so pages rendered before the change are never served again
+_generation = itertools.count(1)
+_current_generation = next(_generation)
+
+def invalidate_collection():
+    """Drop the cached pages after a post was stored or published in this process."""
+    global _current_generation
+    _current_generation = next(_generation)
+    page_cache.invalidate()
+
+def encode_cursor(post):
+    """
+    Encode the position of a post as an opaque cursor.
+
+    Args:
+        post (Post): The last post of a page.
+
+    Returns:
+        str: A URL-safe cursor pointing after the post.
+    """
+    position = f"{post.created_at.isoformat()}|{post.id}"
+    return base64.urlsafe_b64encode(position.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor made by ``encode_cursor``.
+
+    Args:
+        cursor (str): The cursor from a previous page.
+
+    Returns:
+        tuple: (created_at, id) of the post the cursor points after.
+
+    Raises:
+        ValueError: If the cursor is malformed.
+    """
+    try:
+        position = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, post_id = position.split("|")
+        return datetime.fromisoformat(created_at), int(post_id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+def visible_posts():
+    """
+    Query the posts of the collection: published reels and posts stored directly, but not claims still being published.
+
+    Returns:
+        Query: The filtered Post query.
+    """
+    return Post.query.filter(or_(Post.media_id.isnot(None), Post.job_id.is_(None)))
+
+def serialize_post(post):
+    """
+    Convert a post to the JSON representation of the collection API.
+
+    Args:
+        post (Post): The post.
+
+    Returns:
+        dict: The post's public fields.
+    """
+    return {
+        "id": post.id,
+        "caption": post.caption,
+        "hashed": post.hashed,
+        "media_id": post.media_id,
+        "created_at": post.created_at.isoformat() if post.created_at else None,
+        "published_at": post.published_at.isoformat() if post.published_at else None,
+    }
+
+def last_modified(posts):
+    """Get the latest time any of the posts was stored or published, or None for no posts."""
+    times = [post.published_at or post.created_at for post in posts if post.published_at or post.created_at]
+    return max(times) if times else None
+
+def render(data, modified):
+    """
+    Render a response body along with its validators.
+
+    Args:
+        data (dict): The JSON document.
+        modified (datetime): When its content last changed, if known.
+
+    Returns:
+        dict: The body, its ETag and its Last-Modified time.
+    """
+    body = json.dumps(data, separators=(",", ":")).encode()
+    return {"body": body, "etag": hashlib.sha1(body).hexdigest(), "last_modified": modified}
+
+def get_collection_page(cursor=None, limit=None):
+    """
+    Get one page of the collection, newest posts first.
+
+    Pages are found with a keyset query on (created_at, id) backed by an index, so reading
+    any page costs the same however deep into the collection it is. Rendered pages are
+    cached until a post is stored or published in this process, and for at most
+    COLLECTION_CACHE_TTL seconds, which bounds how stale a page can be when another process
+    (e.g. ``flask worker``) adds posts.
+
+    Args:
+        cursor (str): The ``next_cursor`` of the previous page, or None for the first page.
+        limit (int): Number of posts per page (defaults to COLLECTION_PAGE_SIZE, capped at COLLECTION_MAX_PAGE_SIZE).
+
+    Returns:
+        dict: The rendered page, as returned by ``render``.
+
+    Raises:
+        ValueError: If the cursor is malformed.
+    """
+    limit = min(max(1, limit or settings.COLLECTION_PAGE_SIZE), settings.COLLECTION_MAX_PAGE_SIZE)
+    generation = _current_generation
+    key = (generation, cursor, limit)
+    page = page_cache.get(key)
+    if page is not None:
+        COLLECTION_REQUESTS.inc(result="hit")
+        return page
+    COLLECTION_REQUESTS.inc(result="miss")
+
+    query = visible_posts()
+    if cursor:
+        created_at, post_id = decode_cursor(cursor)
+        # The redundant upper bound lets the database seek into the index; without it SQLite scans from the start
+        query = query.filter(
+            Post.created_at <= created_at,
+            or_(Post.created_at < created_at, and_(Post.created_at == created_at, Post.id < post_id)),
+        )
+    # Fetch one extra row to learn whether there is a next page
+    posts = query.order_by(Post.created_at.desc(), Post.id.desc()).limit(limit + 1).all()
+    has_more = len(posts) > limit
+    posts = posts[:limit]
+    page = render({
+        "posts": [serialize_post(post) for post in posts],
+        "next_cursor": encode_cursor(posts[-1]) if has_more else None,
+    }, last_modified(posts))
+    page_cache.set(key, page)
+    return page
+
+def get_collection_post(post_id):
+    """
+    Get a single post of the collection.
+
+    Args:
+        post_id (int): The ID of the post.
+
+    Returns:
+        dict: The rendered post, as returned by ``render``, or None if there is no such post in the collection.
+    """
+    post = visible_posts().filter(Post.id == post_id).first()
+    if post is None:
+        return None
+    return render(serialize_post(post), last_modified([post]))
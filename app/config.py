@@ -1,12 +1,63 @@
-# Import necessary modules from dotenv, pathlib, and os
+# Import necessary modules from dotenv, pathlib, functools, and os
 from dotenv import load_dotenv
 from pathlib import Path
+from functools import lru_cache
 import os
 
-# Define the base directory of the project
+# Define the base directory of the app package and of the project
 BASE_DIR = Path(__file__).resolve().parent
-# Load environment variables from the .env file located in the base directory
-load_dotenv(BASE_DIR / ".env")
+PROJECT_DIR = BASE_DIR.parent
+# Load environment variables from the .env file in the project directory, once for the whole app
+load_dotenv(PROJECT_DIR / ".env")
+
+def get_database_uri():
+    """
+    Get the database URI from the DATABASE_URL environment variable, defaulting to a local SQLite file.
+    
+    Returns:
+        str: The SQLAlchemy database URI.
+    """
+    uri = os.getenv("DATABASE_URL", "sqlite:///sqlite3.db")
+    # Hosting providers often hand out the legacy postgres:// scheme, which SQLAlchemy rejects
+    if uri.startswith("postgres://"):
+        uri = "postgresql://" + uri[len("postgres://"):]
+    return uri
+
+def get_engine_options(uri):
+    """
+    Get the SQLAlchemy engine options for a database URI.
+    
+    Connection pool sizes only apply to server databases; SQLite gets a busy timeout instead.
+    
+    Args:
+        uri (str): The SQLAlchemy database URI.
+    
+    Returns:
+        dict: Keyword arguments for ``create_engine``.
+    """
+    if uri.startswith("sqlite"):
+        return {"connect_args": {"timeout": float(os.getenv("SQLITE_BUSY_TIMEOUT", "30"))}}
+    return {
+        "pool_size": int(os.getenv("DB_POOL_SIZE", "10")),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "20")),
+        "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", "30")),
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "1800")),
+        "pool_pre_ping": True,
+    }
+
+def parse_mapping(value, cast=str):
+    """
+    Parse a "name=value,name=value" setting into a dict.
+    
+    Args:
+        value (str): The raw setting, e.g. "LOLify.transport=WARNING,LOLify.poll=DEBUG".
+        cast (callable): Applied to every value.
+    
+    Returns:
+        dict: The parsed names and values.
+    """
+    pairs = (item.split("=", 1) for item in value.split(",") if "=" in item)
+    return {name.strip(): cast(setting.strip()) for name, setting in pairs}
 
 class Config:
     """
@@ -14,12 +65,190 @@ class Config:
     
     Attributes:
         SECRET_KEY (str): Secret key for the application, loaded from environment variables.
-        SQLALCHEMY_DATABASE_URI (str): URI for the SQLAlchemy database connection.
+        PAGE_ID (str): ID of the Facebook Page linked to the default Instagram account (see ``flask account`` for more).
+        ACCESS_TOKEN (str): Graph API access token of the Page.
+        VERIFY_TOKEN (str): Token Meta sends back when verifying the webhook subscription.
+        GRAPH_API_BASE (str): Base URL of the Graph API, e.g. a local stand-in server for testing.
+        GRAPH_POOL_SIZE (int): Number of kept-alive connections to the Graph API.
+        GRAPH_MAX_RETRIES (int): Number of times a failed Graph API request is retried.
+        METADATA_CACHE_TTL (int): Seconds static account metadata is cached.
+        PUBLISHING_LIMIT_TTL (int): Seconds the content publishing limit response is cached.
+        SQLALCHEMY_DATABASE_URI (str): URI for the SQLAlchemy database connection, from DATABASE_URL.
+        SQLALCHEMY_ENGINE_OPTIONS (dict): Connection pool options for the database engine.
         SQLALCHEMY_TRACK_MODIFICATIONS (bool): Flag to disable SQLAlchemy modification tracking.
+        SQLITE_PRAGMAS (dict): PRAGMA statements run on every new SQLite connection.
+        LOG_LEVEL (str): Level of the app's "LOLify" logger.
+        LOG_LEVELS (dict): Levels of individual child loggers, e.g. {"LOLify.transport": "WARNING"}.
+        LOG_FORMAT (str): "json" for one JSON object per line, or "text".
+        LOG_FILE (str): Path of the rotating log file; empty to log to stderr only.
+        LOG_QUEUE_SIZE (int): Records buffered for the logging thread before new ones are dropped.
+        LOG_SAMPLING (dict): Fraction of records kept per logger for high-frequency messages.
+        PROFILE_SAMPLE_RATE (float): Fraction of webhook requests and jobs profiled with cProfile (0 disables sampling).
+        PROFILE_DIR (str): Directory the profiles are written to.
+        PROFILE_MAX_FILES (int): Number of profiles kept; older ones are deleted.
+        PROFILE_SIGNATURE_TTL (int): Seconds a signed X-Profile header stays valid.
+        WORKER_THREADS (int): Number of background worker threads of each gunicorn worker and of ``flask worker`` (0 leaves the job queue to ``flask worker``).
+        WORKER_POLL_INTERVAL (float): Seconds an idle worker waits before checking the queue again.
+        JOB_MAX_ATTEMPTS (int): Number of times a failing job is retried before it is marked as failed.
+        JOB_LEASE_TTL (float): Seconds a job's lease is held without renewal; the job of a process that stops renewing it is taken over after that.
+        JOB_HEARTBEAT_INTERVAL (float): Seconds between renewals of the leases held by a process.
+        LEASE_RETENTION (int): Seconds an expired lease is kept before it is deleted.
+        CONTAINER_POLL_INITIAL (float): Seconds before the first status check of a media container.
+        CONTAINER_POLL_MAX (float): Maximum seconds between two status checks of a media container.
+        CONTAINER_POLL_BACKOFF (float): Factor the check interval grows by after each unfinished check.
+        CONTAINER_MAX_WAIT (float): Seconds after which a container that never finishes is given up on.
+        MAX_VIDEO_BYTES (int): Largest reel that is downloaded.
+        DOWNLOAD_CHUNK_SIZE (int): Size of the buffer used to read videos.
+        DOWNLOAD_PART_SIZE (int): Size of each byte range of a parallel download.
+        DOWNLOAD_PARALLELISM (int): Number of byte ranges fetched at once.
+        DOWNLOAD_CONNECT_TIMEOUT (float): Seconds to wait for a connection to the CDN.
+        DOWNLOAD_READ_TIMEOUT (float): Seconds without data after which a download connection is considered stalled.
+        DOWNLOAD_TOTAL_TIMEOUT (float): Seconds a whole download may take.
+        DOWNLOAD_MAX_RETRIES (int): Number of times an interrupted byte range is resumed.
+        HASH_VERSION (int): Hash algorithm new posts are stored under: 1 for SHA-256, 2 for BLAKE2b.
+        HASH_THREADS (int): Number of threads hashing videos off the download threads; 0 hashes on the download thread (the default on a single CPU).
+        HASH_BUFFER_SIZE (int): Bytes of video hashed at once.
+        MEDIA_CACHE_DIR (str): Directory of the on-disk media cache.
+        MEDIA_CACHE_MAX_BYTES (int): Byte budget of the media cache (0 disables it).
+        COLLECTION_PAGE_SIZE (int): Default number of posts per page of the collection API.
+        COLLECTION_MAX_PAGE_SIZE (int): Largest page a client may ask for.
+        COLLECTION_CACHE_TTL (float): Seconds a rendered collection page is cached.
+        COLLECTION_CACHE_SIZE (int): Largest number of rendered collection pages kept.
+        FINGERPRINT_MAX_DISTANCE (int): Largest fingerprint Hamming distance treated as the same reel.
+        SENDER_RATE_LIMIT (float): Reels per hour a sender may send before their reels are deferred (0 for unlimited).
+        SENDER_BURST (int): Reels a sender may send at once before the rate limit applies.
+        SENDER_MAX_DEFER (float): Longest a reel is deferred for its sender's rate; later ones are dropped.
+        INTAKE_QUEUE_SIZE (int): Ready jobs of an account above which reels of regular senders are dropped.
+        ACCOUNT_WORKER_THREADS (int): Worker threads of each registered account that does not set its own.
+        ACCOUNT_CACHE_TTL (int): Seconds the registered accounts are cached before changes are picked up.
+        DELIVERY_DEDUP_TTL (float): Seconds a webhook delivery is remembered so redeliveries of it are dropped.
+        DELIVERY_DEDUP_SIZE (int): Largest number of webhook deliveries remembered in each process.
+        HASH_FILTER_CAPACITY (int): Number of post hashes the in-memory known-hash filter is sized for.
+        HASH_FILTER_ERROR_RATE (float): Target false-positive rate of the known-hash filter.
+        HASH_FILTER_RECENT (int): Number of recently published hashes the filter remembers exactly.
+        HASH_FILTER_RELOAD_INTERVAL (float): Seconds between reloads of a worker process's known-hash filter from the post table (0 disables them).
+        PUBLISH_QUOTA_LIMIT (int): Posts allowed per window until the Graph API reports its own limit.
+        PUBLISH_QUOTA_WINDOW (int): Length of the rolling publishing window in seconds.
+        PUBLISH_QUOTA_RESERVE (int): Number of posts per window kept back from automatic publishing.
+        PUBLISH_QUOTA_REFRESH (float): Seconds between refreshes of the quota from the Graph API.
     """
     # Load the secret key from the environment variables
     SECRET_KEY = os.getenv("SECRET_KEY")
-    # Define the database URI for SQLAlchemy (using SQLite database)
-    SQLALCHEMY_DATABASE_URI = 'sqlite:///sqlite3.db'
+    
+    # Meta credentials
+    PAGE_ID = os.getenv("PAGE_ID")
+    ACCESS_TOKEN = os.getenv("ACCESS_TOKEN")
+    VERIFY_TOKEN = os.getenv("VERIFY_TOKEN")
+    
+    # Graph API transport settings
+    GRAPH_API_BASE = os.getenv("GRAPH_API_BASE", "https://graph.facebook.com/v20.0")
+    GRAPH_POOL_SIZE = int(os.getenv("GRAPH_POOL_SIZE", "20"))
+    GRAPH_MAX_RETRIES = int(os.getenv("GRAPH_MAX_RETRIES", "4"))
+    METADATA_CACHE_TTL = int(os.getenv("METADATA_CACHE_TTL", "3600"))
+    PUBLISHING_LIMIT_TTL = int(os.getenv("PUBLISHING_LIMIT_TTL", "300"))
+    
+    # Define the database URI for SQLAlchemy (SQLite unless DATABASE_URL is set)
+    SQLALCHEMY_DATABASE_URI = get_database_uri()
+    # Size the connection pool so many workers can share the database
+    SQLALCHEMY_ENGINE_OPTIONS = get_engine_options(SQLALCHEMY_DATABASE_URI)
+    # Let SQLite readers and a writer work concurrently and avoid an fsync on every commit
+    SQLITE_PRAGMAS = {
+        "journal_mode": os.getenv("SQLITE_JOURNAL_MODE", "WAL"),
+        "synchronous": os.getenv("SQLITE_SYNCHRONOUS", "NORMAL"),
+        "busy_timeout": int(float(os.getenv("SQLITE_BUSY_TIMEOUT", "30")) * 1000),
+    }
     # Disable SQLAlchemy modification tracking to save resources
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    
+    # Logging settings; records are formatted and written by a background thread
+    LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+    LOG_LEVELS = parse_mapping(os.getenv("LOG_LEVELS", ""), str.upper)
+    LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+    LOG_FILE = os.getenv("LOG_FILE", str(PROJECT_DIR / "app.log"))
+    LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+    LOG_SAMPLING = parse_mapping(os.getenv("LOG_SAMPLING", "LOLify.poll=0.1"), float)
+    
+    # Profiling settings
+    PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+    PROFILE_DIR = os.getenv("PROFILE_DIR", str(PROJECT_DIR / "profiles"))
+    PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "50"))
+    PROFILE_SIGNATURE_TTL = int(os.getenv("PROFILE_SIGNATURE_TTL", "300"))
+    
+    # Background job queue settings
+    WORKER_THREADS = int(os.getenv("WORKER_THREADS", "2"))
+    WORKER_POLL_INTERVAL = float(os.getenv("WORKER_POLL_INTERVAL", "5"))
+    JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+    JOB_LEASE_TTL = float(os.getenv("JOB_LEASE_TTL", "90"))
+    JOB_HEARTBEAT_INTERVAL = float(os.getenv("JOB_HEARTBEAT_INTERVAL", "30"))
+    LEASE_RETENTION = int(os.getenv("LEASE_RETENTION", "86400"))
+    
+    # Media container polling settings
+    CONTAINER_POLL_INITIAL = float(os.getenv("CONTAINER_POLL_INITIAL", "2"))
+    CONTAINER_POLL_MAX = float(os.getenv("CONTAINER_POLL_MAX", "30"))
+    CONTAINER_POLL_BACKOFF = float(os.getenv("CONTAINER_POLL_BACKOFF", "1.5"))
+    CONTAINER_MAX_WAIT = float(os.getenv("CONTAINER_MAX_WAIT", "1800"))
+    
+    # Video download settings
+    MAX_VIDEO_BYTES = int(os.getenv("MAX_VIDEO_BYTES", str(500 * 1024 * 1024)))
+    DOWNLOAD_CHUNK_SIZE = int(os.getenv("DOWNLOAD_CHUNK_SIZE", str(1024 * 1024)))
+    DOWNLOAD_PART_SIZE = int(os.getenv("DOWNLOAD_PART_SIZE", str(4 * 1024 * 1024)))
+    DOWNLOAD_PARALLELISM = int(os.getenv("DOWNLOAD_PARALLELISM", "4"))
+    DOWNLOAD_CONNECT_TIMEOUT = float(os.getenv("DOWNLOAD_CONNECT_TIMEOUT", "10"))
+    DOWNLOAD_READ_TIMEOUT = float(os.getenv("DOWNLOAD_READ_TIMEOUT", "30"))
+    DOWNLOAD_TOTAL_TIMEOUT = float(os.getenv("DOWNLOAD_TOTAL_TIMEOUT", "300"))
+    DOWNLOAD_MAX_RETRIES = int(os.getenv("DOWNLOAD_MAX_RETRIES", "3"))
+    
+    # Content hashing settings
+    HASH_VERSION = int(os.getenv("HASH_VERSION", "1"))
+    HASH_THREADS = int(os.getenv("HASH_THREADS", str(min(2, (os.cpu_count() or 1) - 1))))
+    HASH_BUFFER_SIZE = int(os.getenv("HASH_BUFFER_SIZE", str(4 * 1024 * 1024)))
+    
+    # Media cache settings
+    MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR", str(PROJECT_DIR / "media_cache"))
+    MEDIA_CACHE_MAX_BYTES = int(os.getenv("MEDIA_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+    
+    # Collection API settings
+    COLLECTION_PAGE_SIZE = int(os.getenv("COLLECTION_PAGE_SIZE", "50"))
+    COLLECTION_MAX_PAGE_SIZE = int(os.getenv("COLLECTION_MAX_PAGE_SIZE", "200"))
+    COLLECTION_CACHE_TTL = float(os.getenv("COLLECTION_CACHE_TTL", "30"))
+    COLLECTION_CACHE_SIZE = int(os.getenv("COLLECTION_CACHE_SIZE", "1000"))
+    
+    # Near-duplicate detection settings
+    FINGERPRINT_MAX_DISTANCE = int(os.getenv("FINGERPRINT_MAX_DISTANCE", "6"))
+    
+    # Webhook admission control settings
+    SENDER_RATE_LIMIT = float(os.getenv("SENDER_RATE_LIMIT", "60"))
+    SENDER_BURST = int(os.getenv("SENDER_BURST", "10"))
+    SENDER_MAX_DEFER = float(os.getenv("SENDER_MAX_DEFER", "3600"))
+    INTAKE_QUEUE_SIZE = int(os.getenv("INTAKE_QUEUE_SIZE", "1000"))
+    ACCOUNT_WORKER_THREADS = int(os.getenv("ACCOUNT_WORKER_THREADS", "1"))
+    ACCOUNT_CACHE_TTL = int(os.getenv("ACCOUNT_CACHE_TTL", "60"))
+    
+    # Webhook redelivery settings (Meta keeps retrying a delivery for up to 36 hours)
+    DELIVERY_DEDUP_TTL = float(os.getenv("DELIVERY_DEDUP_TTL", "129600"))
+    DELIVERY_DEDUP_SIZE = int(os.getenv("DELIVERY_DEDUP_SIZE", "100000"))
+    
+    # Known-hash filter settings
+    HASH_FILTER_CAPACITY = int(os.getenv("HASH_FILTER_CAPACITY", "1000000"))
+    HASH_FILTER_ERROR_RATE = float(os.getenv("HASH_FILTER_ERROR_RATE", "0.001"))
+    HASH_FILTER_RECENT = int(os.getenv("HASH_FILTER_RECENT", "10000"))
+    HASH_FILTER_RELOAD_INTERVAL = float(os.getenv("HASH_FILTER_RELOAD_INTERVAL", "3600"))
+    
+    # Publishing quota settings
+    PUBLISH_QUOTA_LIMIT = int(os.getenv("PUBLISH_QUOTA_LIMIT", "50"))
+    PUBLISH_QUOTA_WINDOW = int(os.getenv("PUBLISH_QUOTA_WINDOW", "86400"))
+    PUBLISH_QUOTA_RESERVE = int(os.getenv("PUBLISH_QUOTA_RESERVE", "0"))
+    PUBLISH_QUOTA_REFRESH = float(os.getenv("PUBLISH_QUOTA_REFRESH", "300"))
+
+@lru_cache(maxsize=None)
+def get_settings():
+    """
+    Get the settings shared by create_app(), the API classes, the workers and the routes.
+    
+    The .env file and the environment are read once, when this module is imported, and every
+    caller gets the same object, including threads that run outside an application context.
+    
+    Returns:
+        Config: The application settings.
+    """
+    return Config()
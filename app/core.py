@@ -1,125 +1,272 @@
-from dotenv import load_dotenv
-from pathlib import Path
 import os
-import requests
-import time
 import logging
-from logging.handlers import RotatingFileHandler
-import hashlib
 import tempfile
+from app.accounts import default_credentials
+from app.cache import TTLCache
+from app.config import get_settings
+from app.hashing import StreamHasher, current_version, hash_file
+from app.mediacache import get_media_cache
+from app.quota import PublishLimitReached
+from app.scheduler import get_scheduler
 
-# Load environment variables from .env file located in the parent directory of the current file's parent directory
-BASE_DIR = Path(__file__).resolve().parent.parent
-LOG_DIR = BASE_DIR / "logs"
-LOG_DIR.mkdir(parents=True,exist_ok=True)
-load_dotenv(BASE_DIR / ".env")
+# Settings shared with create_app() and the routes; the default account's credentials are read from here
+settings = get_settings()
 
-# Retrieve environment variables for PAGE_ID and ACCESS_TOKEN
-PAGE_ID = os.getenv("PAGE_ID")
-ACCESS_TOKEN = os.getenv("ACCESS_TOKEN")
-
-# Set up logging
+# Logger of the app; its handlers are set up by configure_logging() in create_app()
 logger = logging.getLogger("LOLify")
-logger.setLevel(logging.DEBUG)
+# Container status checks run on every poll, so their logs are sampled (see LOG_SAMPLING)
+poll_logger = logging.getLogger("LOLify.poll")
+
+# Process-wide cache of Graph API metadata that rarely changes, keyed by account
+metadata_cache = TTLCache(settings.METADATA_CACHE_TTL)
 
-# Create a StreamHandler for console output
-stream_handler = logging.StreamHandler()
-stream_handler.setLevel(logging.INFO)
+# Graph API error codes meaning the access token is invalid or expired
+_AUTH_ERROR_CODES = {102, 190}
 
-# Create a RotatingFileHandler for logging to a file with rotation
-log_file = BASE_DIR / 'app.log'
-file_handler = RotatingFileHandler(log_file, maxBytes=5*1024*1024, backupCount=3)
-file_handler.setLevel(logging.DEBUG)
+def metadata_key(account, name):
+    """Get the metadata cache key of an account's ``name`` entry."""
+    return f"{account.key}:{name}"
 
-# Create a logging format
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-stream_handler.setFormatter(formatter)
-file_handler.setFormatter(formatter)
+def check_auth_error(response, account=None):
+    """
+    Drop an account's cached metadata when the Graph API rejects its credentials.
+    
+    Args:
+        response (requests.Response): A Graph API response.
+        account (Credentials): The account the request was made for (defaults to the account from the settings).
+    
+    Returns:
+        bool: True if the response is an authentication error.
+    """
+    auth_error = response.status_code == 401
+    if not auth_error and response.status_code >= 400:
+        try:
+            auth_error = response.json().get("error", {}).get("code") in _AUTH_ERROR_CODES
+        except ValueError:
+            pass
+    if auth_error:
+        account = account or default_credentials()
+        logger.warning("Graph API authentication error for account %s, invalidating cached metadata", account.key)
+        for name in ("instagram_id", "publishing_limit"):
+            metadata_cache.invalidate(metadata_key(account, name))
+    return auth_error
 
-# Add the handlers to the logger
-logger.addHandler(stream_handler)
-logger.addHandler(file_handler)
+def warm_metadata_cache():
+    """Resolve the Instagram Business Account ID ahead of the first webhook."""
+    if not (settings.PAGE_ID and settings.ACCESS_TOKEN):
+        return None
+    try:
+        with FacebookAPI() as fapi:
+            return fapi.get_cached_instagram_id()
+    except Exception as e:
+        logger.warning("Failed to warm metadata cache: %s", e)
+        return None
+
+def stream_video(url, sink, max_bytes=None):
+    """
+    Stream a video from a URL into a callable without buffering it whole.
+    
+    Large videos are fetched as parallel byte ranges and handed to the sink in order,
+    with interrupted ranges resumed and connect, read and total time budgets enforced.
+    
+    Args:
+        url (str): The URL of the video.
+        sink (callable): Called with a memoryview of each chunk, in order; the view is only valid during the call.
+        max_bytes (int): Abort if the video is larger than this (defaults to the MAX_VIDEO_BYTES setting).
+    
+    Returns:
+        int: The number of bytes streamed.
+    """
+    # Imported here so that requests is only loaded once a worker downloads its first video
+    from app.download import get_downloader
+    return get_downloader().download(url, sink, max_bytes or settings.MAX_VIDEO_BYTES)
 
 def download_video_to_tempfile(url):
-    response = requests.get(url, stream=True)
-    if response.status_code == 200:
-        # Create a temporary file
-        temp_file = tempfile.NamedTemporaryFile(delete=False)
-        try:
+    """Download a video to a temporary file and return its path, for callers that need the bytes on disk."""
+    temp_file = tempfile.NamedTemporaryFile(delete=False)
+    try:
+        with temp_file:
             # Write video content to the temporary file
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    temp_file.write(chunk)
-        finally:
-            temp_file.close()
-        return temp_file.name
-    else:
-        raise Exception(f"Failed to download video, status code: {response.status_code}")
+            stream_video(url, temp_file.write)
+    except Exception:
+        os.remove(temp_file.name)
+        raise
+    return temp_file.name
 
-def hash_video_from_file(file_path, hash_algorithm='sha256'):
-    hash_func = hashlib.new(hash_algorithm)
+def hash_video_from_file(file_path, version=None):
+    """
+    Hash a video file.
+    
+    Args:
+        file_path (Path): Path of the video file.
+        version (int): The hash version to use (defaults to the HASH_VERSION setting).
+    
+    Returns:
+        str: The hex digest of the video.
+    """
+    version = version or current_version()
+    return hash_file(file_path, [version])[version]
+
+def read_video_from_file(file_path, sink):
+    """
+    Stream a video file into a callable, one reusable buffer at a time.
+    
+    Args:
+        file_path (Path): Path of the video file.
+        sink (callable): Called with a memoryview of each chunk; the view is only valid during the call.
+    """
+    buffer = bytearray(settings.DOWNLOAD_CHUNK_SIZE)
+    view = memoryview(buffer)
     with open(file_path, 'rb') as f:
-        while chunk := f.read(8192):
-            hash_func.update(chunk)
-    return hash_func.hexdigest()
+        while size := f.readinto(buffer):
+            sink(view[:size])
 
-def get_hash_from_video(video_url):
-    try:
-        # Download video to a temporary file
-        temp_file_path = download_video_to_tempfile(video_url)
-        
-        # Compute hash
-        video_hash = hash_video_from_file(temp_file_path)
-        return video_hash
+def hash_video_from_url(url, versions=None, sink=None):
+    """
+    Hash a video straight from its HTTP stream, without writing it to disk.
+    
+    The bytes are hashed on the hashing threads while the download goes on, see app.hashing.
+    
+    Args:
+        url (str): The URL of the video.
+        versions (list[int]): The hash versions to compute (defaults to the HASH_VERSION setting).
+        sink (callable): Optional callable that also receives every chunk, e.g. to keep the bytes.
     
+    Returns:
+        dict: The hex digest of the video under each version.
+    """
+    hasher = StreamHasher(versions or [current_version()])
+    if sink is None:
+        stream_video(url, hasher)
+    else:
+        def update(chunk):
+            hasher(chunk)
+            sink(chunk)
+        stream_video(url, update)
+    return hasher.hexdigests()
+
+def get_hashes_from_video(video_url, versions=None, sink=None):
+    """
+    Hash a video under one or more hash versions, reading it from the local media cache if
+    this URL was downloaded before.
+    
+    Downloads are written to the cache as they stream, so retries and later re-processing
+    of the same URL read local bytes instead of going back to the CDN.
+    
+    Args:
+        video_url (str): The URL of the video.
+        versions (list[int]): The hash versions to compute, the first one being the one the
+            cache is indexed by (defaults to the HASH_VERSION setting).
+        sink (callable): Optional callable that also receives every chunk of the video. If reading
+            the cached copy fails partway, its ``reset`` method, if any, is called before the video
+            is downloaded and fed to it again from the start.
+    
+    Returns:
+        dict: The hex digest of the video under each version, or None if it could not be downloaded.
+    """
+    versions = versions or [current_version()]
+    cache = get_media_cache()
+    cached = None
+    try:
+        cached = cache.lookup(video_url) if cache else None
+        if cached is not None:
+            hashed, path = cached
+            digests = {versions[0]: hashed}
+            if len(versions) > 1 or sink is not None:
+                # Feed the local bytes to the fingerprint and the other versions in one read
+                hasher = StreamHasher(versions[1:])
+                def update(chunk):
+                    hasher(chunk)
+                    if sink is not None:
+                        sink(chunk)
+                read_video_from_file(path, update)
+                digests.update(hasher.hexdigests())
+            return digests
+        temp_file = cache.writer() if cache else None
+    except OSError as e:
+        logger.warning("Media cache unavailable for %s: %s", video_url, e)
+        temp_file = None
+        reset = getattr(sink, "reset", None)
+        if cached is not None and reset is not None:
+            reset()  # The sink already got the start of the cached copy
+    try:
+        if temp_file is None:
+            # Compute hash while streaming the video
+            return hash_video_from_url(video_url, versions, sink=sink)
+        def keep(chunk):
+            temp_file.write(chunk)
+            if sink is not None:
+                sink(chunk)
+        digests = hash_video_from_url(video_url, versions, sink=keep)
     except Exception as e:
-        print(f"An error occurred: {e}")
+        if temp_file is not None:
+            cache.discard(temp_file)
+        logger.error("Failed to hash video %s: %s", video_url, e)
+        return None
+    try:
+        cache.commit(temp_file, digests[versions[0]], video_url)
+    except OSError as e:
+        cache.discard(temp_file)
+        logger.warning("Failed to cache video %s: %s", video_url, e)
+    return digests
+
+def get_hash_from_video(video_url, sink=None):
+    """
+    Hash a video under the current hash version, see ``get_hashes_from_video``.
     
-    finally:
-        # Clean up the temporary file
-        os.remove(temp_file_path)
+    Returns:
+        str: The hex digest of the video, or None if it could not be downloaded.
+    """
+    digests = get_hashes_from_video(video_url, sink=sink)
+    return digests[current_version()] if digests else None
 
 class FacebookAPI:
     """Class to interact with the Facebook Graph API."""
     
-    _HOST = "https://graph.facebook.com/v20.0"
-    
-    def __init__(self):
-        """Initialize the FacebookAPI class and set up a requests session."""
+    def __init__(self, account=None):
+        """
+        Initialize the FacebookAPI class on top of the shared Graph API transport.
+        
+        Args:
+            account (Credentials): The account to act as (defaults to the account from the settings).
+        """
         logger.debug("Initializing FacebookAPI class")
-        session = requests.Session()
-        session.headers = {
-            'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36'
-        }
-        self._session = session
+        # Imported here so that importing this module does not load requests
+        from app.transport import get_transport
+        self._transport = get_transport()
+        self.account = account or default_credentials()
+    
+    def get_transport(self):
+        """Get the shared Graph API transport."""
+        return self._transport
     
     def get_session(self):
-        """Get the current session."""
-        return self._session
+        """Get the shared, pooled session."""
+        return self._transport.session
     
     def get_host(self):
         """Get the host URL."""
-        return self._HOST
+        return self._transport.base_url
     
     def __enter__(self):
         """Enter the runtime context related to this object."""
         return self
     
     def __exit__(self, exc_type, exc_val, exc_tb):
-        """Exit the runtime context related to this object, closing the session."""
+        """Exit the runtime context related to this object; the shared session stays open for reuse."""
         logger.debug("Exiting FacebookAPI context")
-        self.get_session().close()
     
     def get_instagram_id(self):
         """Get the Instagram Business Account ID linked to the Facebook Page."""
         logger.debug("Fetching Instagram Business Account ID")
         params = {
             "fields": "instagram_business_account",
-            "access_token": ACCESS_TOKEN
+            "access_token": self.account.access_token
         }
-        response = self.get_session().get(f"{self.get_host()}/{PAGE_ID}", params=params)
+        response = self.get_transport().get(f"{self.account.page_id}", endpoint="page", params=params)
+        check_auth_error(response, self.account)
         if response.status_code != 200:
-            logger.error(f"Failed to get Instagram ID: {response.status_code}")
+            logger.error("Failed to get Instagram ID: %s", response.status_code)
             return None
         data = response.json()
         instagram_business_account = data.get("instagram_business_account")
@@ -127,44 +274,51 @@ class FacebookAPI:
             logger.warning("No Instagram Business Account linked to the Facebook Page")
             return None
         return instagram_business_account["id"]
+    
+    def get_cached_instagram_id(self):
+        """Get the Instagram Business Account ID, only calling the Graph API when it is neither stored nor cached."""
+        if self.account.instagram_id:
+            return self.account.instagram_id  # Stored with the account when it was registered
+        return metadata_cache.get_or_load(metadata_key(self.account, "instagram_id"), self.get_instagram_id)
 
 class InstagramAPI:
     """Class to interact with the Instagram Graph API."""
-    
-    _HOST = "https://graph.instagram.com"
-    _WAIT_INTERVAL = 30
 
-    def __init__(self):
-        """Initialize the InstagramAPI class and set up a requests session."""
+    def __init__(self, account=None):
+        """
+        Initialize the InstagramAPI class on top of the shared Graph API transport.
+        
+        Args:
+            account (Credentials): The account to publish to (defaults to the account from the settings).
+        """
         logger.debug("Initializing InstagramAPI class")
-        session = requests.Session()
-        session.headers = {
-            'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36'
-        }
-        self._session = session
-        with FacebookAPI() as fapi:
-            self._instagram_id = fapi.get_instagram_id()
+        from app.transport import get_transport
+        self._transport = get_transport()
+        self.account = account or default_credentials()
+        self._instagram_id = self.account.instagram_id or metadata_cache.get(metadata_key(self.account, "instagram_id"))
+        if self._instagram_id is None:
+            with FacebookAPI(self.account) as fapi:
+                self._instagram_id = fapi.get_cached_instagram_id()
+    
+    def get_transport(self):
+        """Get the shared Graph API transport."""
+        return self._transport
     
-    def get_wait_interval(self):
-        """Get the wait interval time between retries."""
-        return self._WAIT_INTERVAL
-
     def get_session(self):
-        """Get the current session."""
-        return self._session
+        """Get the shared, pooled session."""
+        return self._transport.session
     
     def get_host(self):
         """Get the host URL."""
-        return self._HOST
+        return self._transport.base_url
     
     def __enter__(self):
         """Enter the runtime context related to this object."""
         return self
     
     def __exit__(self, exc_type, exc_val, exc_tb):
-        """Exit the runtime context related to this object, closing the session."""
+        """Exit the runtime context related to this object; the shared session stays open for reuse."""
         logger.debug("Exiting InstagramAPI context")
-        self.get_session().close()
     
     def get_instagram_id(self):
         """Get the Instagram Business Account ID."""
@@ -172,7 +326,7 @@ class InstagramAPI:
     
     def _create_container(self, URL, caption="", media_type="image"):
         """Create a media container for posting."""
-        logger.debug(f"Creating media container: URL={URL}, caption={caption}, media_type={media_type}")
+        logger.debug("Creating %s media container for %s", media_type, URL)
         params = {
             # "caption": caption,
             "caption":"""\
@@ -180,7 +334,7 @@ class InstagramAPI:
 
             #lovequotes #LOLify #love #emotion #trending #funny #darkhumor #memes #couplegoals #lovequotes #relationshipgoals #tmkoc #heartbroken #explore #lol #dailymemes #feelings #brokenheart #relatable #dankmemes #savage #explore #viral #explorepage #breakup
             """,
-            "access_token": ACCESS_TOKEN
+            "access_token": self.account.access_token
         }
         if media_type.lower() == "image":
             params["image_url"] = URL
@@ -188,66 +342,141 @@ class InstagramAPI:
             params["video_url"] = URL
             params["media_type"] = "REELS"
         
-        response = self.get_session().post(f"{FacebookAPI._HOST}/{self.get_instagram_id()}/media", params=params)
+        response = self.get_transport().post(f"{self.get_instagram_id()}/media", endpoint="media", params=params)
+        check_auth_error(response, self.account)
         container_id = response.json().get("id")
         if container_id:
-            logger.info(f"Created media container with ID: {container_id}")
+            logger.info("Created media container with ID: %s", container_id)
         else:
             logger.error("Failed to create media container")
         return container_id
     
-    def get_publishing_limit(self):
-        """Get the publishing limit for the Instagram Business Account."""
+    def get_publishing_config(self, use_cache=True):
+        """Get the publishing limit usage and configuration, cached for PUBLISHING_LIMIT_TTL seconds."""
+        if use_cache:
+            return metadata_cache.get_or_load(metadata_key(self.account, "publishing_limit"),
+                                              lambda: self.get_publishing_config(use_cache=False), settings.PUBLISHING_LIMIT_TTL)
         logger.debug("Fetching content publishing limit")
         params = {
-            "access_token": ACCESS_TOKEN
+            "fields": "config,quota_usage",
+            "access_token": self.account.access_token
+        }
+        response = self.get_transport().get(f"{self.get_instagram_id()}/content_publishing_limit", endpoint="content_publishing_limit", params=params)
+        if check_auth_error(response, self.account) or response.status_code != 200:
+            return None
+        data = response.json()["data"][0]
+        metadata_cache.set(metadata_key(self.account, "publishing_limit"), data, settings.PUBLISHING_LIMIT_TTL)
+        logger.info("Current publishing limit usage: %s", data.get('quota_usage'))
+        return data
+    
+    def get_publishing_limit(self, use_cache=True):
+        """Get the publishing limit usage for the Instagram Business Account."""
+        data = self.get_publishing_config(use_cache=use_cache)
+        return data["quota_usage"] if data else None
+    
+    def get_media_page(self, after=None, limit=50):
+        """
+        Get a page of the account's published media, newest first.
+    
+        Args:
+            after (str): Paging cursor returned with the previous page, None for the first page.
+            limit (int): Number of media requested.
+    
+        Returns:
+            tuple: The media (dicts with ``id``, ``media_type``, ``media_url``, ``caption`` and
+            ``timestamp``) and the cursor of the next page, None on the last page.
+    
+        Raises:
+            RuntimeError: If the Graph API does not return the page.
+        """
+        logger.debug("Fetching media page after %s", after)
+        params = {
+            "fields": "id,media_type,media_product_type,media_url,caption,timestamp",
+            "limit": limit,
+            "access_token": self.account.access_token
         }
-        response = self.get_session().get(f"{FacebookAPI._HOST}/{self.get_instagram_id()}/content_publishing_limit", params=params)
-        quota_usage = response.json()["data"][0]["quota_usage"]
-        logger.info(f"Current publishing limit usage: {quota_usage}")
-        return quota_usage
+        if after:
+            params["after"] = after
+        response = self.get_transport().get(f"{self.get_instagram_id()}/media", endpoint="media_list", params=params)
+        if check_auth_error(response, self.account) or response.status_code != 200:
+            raise RuntimeError(f"Failed to list media: {response.status_code} {response.text[:200]}")
+        data = response.json()
+        paging = data.get("paging") or {}
+        # The last page has no link to a next one, though it may still carry cursors
+        next_cursor = (paging.get("cursors") or {}).get("after") if paging.get("next") else None
+        return data.get("data", []), next_cursor
     
     def _check_container_status(self, container_id):
         """Check the status of the media container."""
-        logger.debug(f"Checking container status for ID: {container_id}")
+        poll_logger.debug("Checking container status for ID: %s", container_id)
         params = {
             "fields": "status_code",
-            "access_token": ACCESS_TOKEN
+            "access_token": self.account.access_token
         }
-        response = self.get_session().get(f"{FacebookAPI._HOST}/{container_id}", params=params)
+        response = self.get_transport().get(f"{container_id}", endpoint="status", params=params)
+        check_auth_error(response, self.account)
         status_code = response.json().get("status_code", "").lower()
-        logger.info(f"Container ID {container_id} status: {status_code}")
+        poll_logger.info("Container ID %s status: %s", container_id, status_code)
         return status_code
     
-    def _publish_container(self, container_id):
-        """Publish the created media container."""
-        logger.debug(f"Publishing container with ID: {container_id}")
+    def _media_publish(self, container_id):
+        """Publish a finished media container and return the published media ID."""
+        logger.debug("Publishing container with ID: %s", container_id)
         params = {
             "creation_id": container_id,
-            "access_token": ACCESS_TOKEN
+            "access_token": self.account.access_token
         }
-        while True:
-            container_status = self._check_container_status(container_id)
-            if container_status == "finished":
-                response = self.get_session().post(f"{FacebookAPI._HOST}/{self.get_instagram_id()}/media_publish", params=params)
-                logger.info(f"Published container ID: {container_id}")
-                break
-            elif container_status == "error":
-                logger.error(f"Error publishing container ID: {container_id}")
-                break
-            else: 
-                time.sleep(self.get_wait_interval())
+        response = self.get_transport().post(f"{self.get_instagram_id()}/media_publish", endpoint="media_publish", params=params)
+        check_auth_error(response, self.account)
+        if response.status_code >= 500:
+            # The container may have been published anyway; the scheduler checks its status
+            raise RuntimeError(f"Publishing returned {response.status_code}")
+        error = response.json().get("error") or {}
+        if error.get("code") == 9 and error.get("error_subcode") == 2207042:
+            raise PublishLimitReached(error.get("message", "Publishing limit reached"))
+        media_id = response.json().get("id")
+        logger.info("Published container ID: %s", container_id)
+        return media_id
+    
+    def _publish_container(self, container_id):
+        """Publish the created media container, blocking until the scheduler is done with it."""
+        return self.resume_post(container_id).result()
+    
+    def submit_post(self, URL, caption="", media_type="image", on_created=None, guard=None):
+        """
+        Create a media container and hand it to the shared scheduler without waiting.
+        
+        ``on_created`` is called with the container ID before the scheduler sees it, so the
+        caller can record the container and resume it with ``resume_post`` after a crash.
+        ``guard`` is called by the scheduler right before publishing, and stops the publish by raising.
+        
+        Returns:
+            tuple: The container ID and a future resolving to the published media ID,
+            or (None, None) if the container could not be created.
+        """
+        logger.debug("Submitting %s post for %s", media_type, URL)
+        container_id = self._create_container(URL, caption=caption, media_type=media_type)
+        if not container_id:
+            return None, None
+        if on_created is not None:
+            on_created(container_id)
+        return container_id, self.resume_post(container_id, guard=guard)
+    
+    def resume_post(self, container_id, guard=None):
+        """Hand an existing media container to the account's scheduler, returning a future resolving to the published media ID."""
+        return get_scheduler(self.account.key).submit(self, container_id, guard=guard)
     
     def make_post(self, URL, caption="", media_type="image"):
-        """Create and publish a post on Instagram."""
-        logger.debug(f"Making post: URL={URL}, caption={caption}, media_type={media_type}")
+        """Create and publish a post on Instagram, returning the published media ID (or None on failure)."""
+        logger.debug("Making %s post for %s", media_type, URL)
         container_id = self._create_container(URL, caption=caption, media_type=media_type)
         if container_id:
-            self._publish_container(container_id)
+            return self._publish_container(container_id)
+        return None
             
     # def send_message(self,*,recipient_id,message):
     #     params = {
-    #         'access_token': ACCESS_TOKEN,
+    #         'access_token': settings.ACCESS_TOKEN,
 
     #     }
     #     headers = {
@@ -261,7 +490,7 @@ class InstagramAPI:
     #             "text":message
     #         }
     #     }
-    #     response = self.get_session().post(f"{FacebookAPI._HOST}/me/messages",headers=headers,params=params,json=payload)
+    #     response = self.get_transport().post("me/messages",headers=headers,params=params,json=payload)
     #     print(response.json())
 
 if __name__ == "__main__":
@@ -1,35 +1,260 @@
 # Import the database object and models from the app package
+from datetime import timedelta
+from sqlalchemy import String, and_, cast, exists, func, literal, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.attributes import set_committed_value
 from app import db
-from app.models import Post, User
+from app.collection import invalidate_collection
+from app.hashfilter import get_hash_filter, loaded_hash_filter
+from app.hashing import current_version
+from app.leases import LeaseLost, acquire_lease, db_now, db_time, release_lease
+from app.models import Backfill, Job, Lease, Post, PublishSlot, User, utcnow
 
-def create_post(caption, hashed):
+def create_post(caption, hashed, fingerprint=None, hash_version=None):
     """
     Create a new post and add it to the database.
     
     Args:
         caption (str): The caption for the post.
         hashed (str): A unique hash identifier for the post.
+        fingerprint (str): The perceptual fingerprint of the video, if known.
+        hash_version (int): The hash version of ``hashed`` (defaults to the current one).
     
     Returns:
         Post: The newly created Post object.
     """
-    new_post = Post(caption=caption, hashed=hashed)  # Create a new Post object
+    new_post = Post(caption=caption, hashed=hashed, fingerprint=fingerprint, published_at=utcnow(),
+                    hash_version=hash_version or current_version())  # Create a new Post object
     db.session.add(new_post)  # Add the new post to the session
     db.session.commit()  # Commit the session to save the post to the database
+    get_hash_filter().add(hashed)  # Keep the known-hash filter in step with the table
+    invalidate_collection()  # The post is now part of the collection
     return new_post  # Return the newly created post
 
+def _insert_posts(rows):
+    """
+    Insert posts in one statement, skipping those whose hash already exists, without committing.
+    
+    Args:
+        rows (list[dict]): The column values of each post.
+    
+    Returns:
+        int: The number of posts inserted.
+    """
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        # Only load the dialect in use; the PostgreSQL one is slow to import
+        if dialect == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert
+        statement = insert(Post).values(rows).on_conflict_do_nothing(index_elements=["hashed"])
+        return db.session.execute(statement).rowcount
+    # Other databases: rely on the unique constraint, one savepoint per post
+    inserted = 0
+    for values in rows:
+        try:
+            with db.session.begin_nested():
+                db.session.add(Post(**values))
+            inserted += 1
+        except IntegrityError:
+            pass
+    return inserted
+
+def claim_post(hashed, caption, fingerprint=None, job_id=None, hash_version=None):
+    """
+    Atomically claim a hash by inserting its post, doing nothing if the hash already exists.
+    
+    The insert-or-ignore runs as a single statement, so when several workers handle the
+    same reel only one of them gets the claim and goes on to publish it.
+    
+    Args:
+        hashed (str): The hash of the video.
+        caption (str): The caption for the post.
+        fingerprint (str): The perceptual fingerprint of the video, if known.
+        job_id (int): The ID of the job claiming the hash.
+        hash_version (int): The hash version of ``hashed`` (defaults to the current one).
+    
+    Returns:
+        bool: True if the hash was claimed, False if a post with this hash already exists.
+    """
+    values = {"caption": caption or "", "hashed": hashed, "fingerprint": fingerprint, "job_id": job_id,
+              "hash_version": hash_version or current_version()}
+    claimed = _insert_posts([values]) == 1
+    db.session.commit()
+    get_hash_filter().add(hashed)  # The hash is stored either way, by us or by whoever beat us to it
+    return claimed
+
+def publish_post(hashed, media_id):
+    """
+    Mark a claimed post as published.
+    
+    Args:
+        hashed (str): The hash of the video.
+        media_id (str): The ID of the published Instagram media.
+    """
+    Post.query.filter_by(hashed=hashed).update({"media_id": media_id, "published_at": utcnow()}, synchronize_session=False)
+    db.session.commit()
+    get_hash_filter().remember(hashed)  # Answer repeats of this reel without the database
+    invalidate_collection()  # The post is now part of the collection
+
+def release_post(hashed, job_id, lease_token=None):
+    """
+    Give up a claim that was never published, so the reel can be processed again.
+    
+    Args:
+        hashed (str): The hash of the video.
+        job_id (int): The ID of the job that holds the claim.
+        lease_token (int): The fencing token the job was claimed with; the claim is kept if
+            another process has claimed the job since, as the claim is now its.
+    """
+    query = Post.query.filter_by(hashed=hashed, job_id=job_id, media_id=None)
+    if lease_token is not None:
+        query = query.filter(exists().where(Job.id == job_id, Job.lease_token == lease_token))
+    query.delete(synchronize_session=False)
+    db.session.commit()
+
 def get_post_by_hashed(hashed):
     """
     Retrieve a post from the database by its hash.
     
+    The known-hash filter is checked first, so hashes that were never stored skip the query.
+    Hashes stored by another process since the filter was loaded may be missed; the atomic
+    claim in ``claim_post`` is what guarantees a reel is only published once.
+    
     Args:
         hashed (str): The hash identifier of the post.
     
     Returns:
         Post: The Post object matching the given hash, or None if no match is found.
     """
+    if get_hash_filter().lookup(hashed) == get_hash_filter().MISS:
+        return None  # Definitely not stored, no need to ask the database
     return Post.query.filter_by(hashed=hashed).first()  # Query the database for the post with the given hash
 
+def migrate_post_hash(post_id, old_hashed, hashed, hash_version):
+    """
+    Move a published post to a newer hash version, once its video was hashed under it.
+    
+    Only published posts are moved: the hash of a claim is still used by the job publishing it.
+    
+    Args:
+        post_id (int): The ID of the post.
+        old_hashed (str): The hash the post is stored under; the post is left alone if it changed meanwhile.
+        hashed (str): The hash of the video under the new version.
+        hash_version (int): The new hash version.
+    
+    Returns:
+        bool: True if the post was moved, False if it changed meanwhile or another post already has the new hash.
+    """
+    try:
+        moved = Post.query.filter(Post.id == post_id, Post.hashed == old_hashed, Post.media_id.isnot(None)).update(
+            {"hashed": hashed, "hash_version": hash_version}, synchronize_session=False,
+        )
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return False
+    hash_filter = loaded_hash_filter()  # A filter loaded later reads the new hash from the table
+    if moved == 1 and hash_filter is not None:
+        hash_filter.add(hashed)
+        hash_filter.remember(hashed)
+    return moved == 1
+
+def known_media_ids(media_ids):
+    """
+    Get which of the given Instagram media are already stored as posts.
+    
+    Args:
+        media_ids (list[str]): IDs of published Instagram media.
+    
+    Returns:
+        set[str]: The IDs that have a post.
+    """
+    if not media_ids:
+        return set()
+    known = {media_id for (media_id,) in db.session.query(Post.media_id).filter(Post.media_id.in_(media_ids))}
+    db.session.commit()  # End the read transaction
+    return known
+
+def backfill_lease_name(account):
+    """Get the name of the lease held by the backfill of an account."""
+    return f"backfill:{account}"
+
+def start_backfill(account, restart=False):
+    """
+    Get the checkpoint a backfill of an account starts from.
+    
+    An unfinished run is resumed where it stopped; a finished one starts over from the
+    newest media, so media published since and videos that failed to download are picked up.
+    
+    Args:
+        account (str): The name of the account.
+        restart (bool): Start over even if the last run is unfinished.
+    
+    Returns:
+        Backfill: The checkpoint, with a None cursor when starting over.
+    """
+    backfill = db.session.get(Backfill, account)
+    if backfill is None:
+        backfill = Backfill(account=account)
+        db.session.add(backfill)
+    elif restart or backfill.finished_at is not None:
+        backfill.cursor = None
+        backfill.media_seen = backfill.posts_added = backfill.failed = 0
+        backfill.started_at = utcnow()
+        backfill.finished_at = None
+    db.session.commit()
+    return backfill
+
+def save_backfill_batch(account, lease_token, rows, cursor, media_seen, failed):
+    """
+    Store a batch of backfilled posts and move the account's checkpoint past them, in one transaction.
+    
+    Posts whose hash is already stored are skipped, e.g. the same video posted twice or a
+    batch stored by an earlier run that stopped before its checkpoint.
+    
+    The write is fenced like a job's: it only goes through while the backfill's lease is
+    still held under ``lease_token``, so a run that lost its lease cannot move the checkpoint.
+    
+    Args:
+        account (str): The name of the account.
+        lease_token (int): The fencing token of the backfill's lease.
+        rows (list[dict]): The column values of each post.
+        cursor (str): The paging cursor of the next page, None once the oldest media was processed.
+        media_seen (int): Media listed since the last checkpoint.
+        failed (int): Videos that could not be downloaded since the last checkpoint.
+    
+    Returns:
+        int: The number of posts inserted.
+    
+    Raises:
+        LeaseLost: If another run holds the backfill's lease now.
+    """
+    inserted = _insert_posts(rows) if rows else 0
+    # The checkpoint's times come from the database clock, like the lease it is fenced by
+    now = db_time()
+    held = exists().where(Lease.name == backfill_lease_name(account), Lease.token == lease_token,
+                          Lease.expires_at > now)
+    updated = Backfill.query.filter(Backfill.account == account, held).update({
+        "cursor": cursor,
+        "media_seen": Backfill.media_seen + media_seen,
+        "posts_added": Backfill.posts_added + inserted,
+        "failed": Backfill.failed + failed,
+        "updated_at": now,
+        "finished_at": now if cursor is None else None,
+    }, synchronize_session=False)
+    if updated != 1:
+        db.session.rollback()
+        raise LeaseLost(f"The backfill of {account} was taken over by another run")
+    db.session.commit()
+    hash_filter = loaded_hash_filter()  # A filter loaded later reads the new hashes from the table
+    for values in rows if hash_filter is not None else ():
+        hash_filter.add(values["hashed"])
+    if inserted:
+        invalidate_collection()  # The posts are now part of the collection
+    return inserted
+
 def create_user(instagram_id):
     """
     Create a new user and add it to the database.
@@ -56,3 +281,358 @@ def get_user_by_instagram_id(instagram_id):
         User: The User object matching the given Instagram ID, or None if no match is found.
     """
     return User.query.filter_by(instagram_id=instagram_id).first()  # Query the database for the user with the given Instagram ID
+
+def get_or_create_users(instagram_ids):
+    """
+    Retrieve the users with the given Instagram IDs, creating the ones seen for the first time.
+    
+    Args:
+        instagram_ids (set[str]): The Instagram IDs of the users.
+    
+    Returns:
+        dict: User objects by Instagram ID.
+    """
+    if not instagram_ids:
+        return {}
+    users = {user.instagram_id: user for user in User.query.filter(User.instagram_id.in_(instagram_ids))}
+    missing = [instagram_id for instagram_id in instagram_ids if instagram_id not in users]
+    if missing:
+        db.session.add_all([User(instagram_id=instagram_id) for instagram_id in missing])
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()  # Another process created some of them first
+        users = {user.instagram_id: user for user in User.query.filter(User.instagram_id.in_(instagram_ids))}
+    return users
+
+def advance_user_slot(user, expected, next_slot):
+    """
+    Move a user's rate limiter forward, unless another process moved it since it was read.
+    
+    Args:
+        user (User): The user.
+        expected (datetime): The ``next_slot`` value the new one was computed from.
+        next_slot (datetime): The new value.
+    
+    Returns:
+        bool: True if the slot was updated, False if it changed in the meantime and must be re-read.
+    """
+    current = User.next_slot.is_(None) if expected is None else User.next_slot == expected
+    updated = User.query.filter(User.id == user.id, current).update({"next_slot": next_slot}, synchronize_session=False)
+    db.session.commit()
+    return updated == 1
+
+def get_publish_slot(account):
+    """
+    Read an account's shared publishing quota.
+    
+    Args:
+        account (str): The key of the account.
+    
+    Returns:
+        tuple: The account's ``next_slot`` (None if it never published) and the database's current time.
+    """
+    next_slot = db.session.query(PublishSlot.next_slot).filter_by(account=account).scalar()
+    now = db_now()
+    db.session.commit()  # End the read transaction
+    return next_slot, now
+
+def advance_publish_slot(account, expected, next_slot):
+    """
+    Move an account's publishing quota forward, unless another process moved it since it was read.
+    
+    Args:
+        account (str): The key of the account.
+        expected (datetime): The ``next_slot`` value the new one was computed from, None if there was no row.
+        next_slot (datetime): The new value.
+    
+    Returns:
+        bool: True if the slot was updated, False if it changed in the meantime and must be re-read.
+    """
+    if expected is None:
+        db.session.add(PublishSlot(account=account, next_slot=next_slot))
+        try:
+            db.session.commit()
+            return True
+        except IntegrityError:
+            db.session.rollback()  # Another process published first
+            return False
+    updated = PublishSlot.query.filter_by(account=account, next_slot=expected).update(
+        {"next_slot": next_slot}, synchronize_session=False,
+    )
+    db.session.commit()
+    return updated == 1
+
+def set_publish_slot(account, seconds):
+    """
+    Overwrite an account's publishing quota, e.g. with the usage reported by the Graph API.
+    
+    Args:
+        account (str): The key of the account.
+        seconds (float): How far ahead of the database's clock the account's next slot is.
+    """
+    next_slot = db_now() + timedelta(seconds=seconds)
+    if not PublishSlot.query.filter_by(account=account).update({"next_slot": next_slot}, synchronize_session=False):
+        db.session.add(PublishSlot(account=account, next_slot=next_slot))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()  # Created by another process meanwhile
+        PublishSlot.query.filter_by(account=account).update({"next_slot": next_slot}, synchronize_session=False)
+        db.session.commit()
+
+def of_account(account_id):
+    """Get the filter matching the jobs of an account, None standing for the account from the settings."""
+    return Job.account_id.is_(None) if account_id is None else Job.account_id == account_id
+
+def count_ready_jobs(now=None, account_id=None):
+    """
+    Count an account's pending jobs that may be claimed now, i.e. the depth of its intake queue.
+    
+    Args:
+        now (datetime): The current time (defaults to now).
+        account_id (int): The ID of the account, or None for the account from the settings.
+    
+    Returns:
+        int: The number of pending jobs that are not deferred.
+    """
+    now = now or utcnow()
+    return Job.query.filter(of_account(account_id), Job.status == Job.PENDING,
+                            or_(Job.run_after.is_(None), Job.run_after <= now)).count()
+
+def create_job(url, caption="", sender_id=None, delivery_key=None, priority=0, run_after=None, account_id=None):
+    """
+    Queue a new reel job and add it to the database.
+    
+    Args:
+        url (str): The URL of the reel video.
+        caption (str): The caption for the reel.
+        sender_id (str): The Instagram ID of the user who sent the reel.
+        delivery_key (str): Key of the webhook delivery the reel came from, if known.
+        priority (int): Priority of the job; higher is claimed first.
+        run_after (datetime): Earliest time the job may be claimed, if not right away.
+        account_id (int): The ID of the account to publish to, or None for the account from the settings.
+    
+    Returns:
+        Job: The newly created Job object.
+    """
+    new_job = Job(url=url, caption=caption or "", sender_id=sender_id, delivery_key=delivery_key, account_id=account_id,
+                  priority=priority, run_after=run_after, virtual_time=run_after or utcnow())  # Create a new Job object
+    db.session.add(new_job)  # Add the new job to the session
+    db.session.commit()  # Commit the session to save the job to the database
+    return new_job  # Return the newly created job
+
+def create_jobs(items):
+    """
+    Queue several reel jobs in a single transaction.
+    
+    If some of the reels were already queued from the same webhook delivery (e.g. by another
+    process handling a redelivery), the batch is retried one job at a time and those are skipped.
+    
+    Args:
+        items (list[dict]): One dict per reel with ``url``, ``caption``, ``sender_id`` and optional ``delivery_key``,
+            ``account_id``, ``priority``, ``run_after``, ``virtual_time``, ``status``, ``shed_reason`` (see app.admission)
+            and ``profile`` keys.
+    
+    Returns:
+        list[Job]: The newly created Job objects in the same order as ``items``, with None for skipped redeliveries.
+    """
+    now = utcnow()
+    def new_job(item):
+        return Job(url=item["url"], caption=item.get("caption") or "", sender_id=item.get("sender_id"),
+                   delivery_key=item.get("delivery_key"), account_id=item.get("account_id"), priority=item.get("priority", 0),
+                   run_after=item.get("run_after"), virtual_time=item.get("virtual_time") or now,
+                   status=item.get("status", Job.PENDING), shed_reason=item.get("shed_reason"),
+                   profile=bool(item.get("profile")))
+    new_jobs = [new_job(item) for item in items]
+    db.session.add_all(new_jobs)  # Add all the new jobs to the session
+    try:
+        db.session.commit()  # Commit once for the whole batch
+        return new_jobs
+    except IntegrityError:
+        db.session.rollback()
+    # At least one delivery key is taken: insert the jobs one by one, skipping the conflicts
+    created = []
+    for item in items:
+        job = new_job(item)
+        db.session.add(job)
+        try:
+            db.session.commit()
+            created.append(job)
+        except IntegrityError:
+            db.session.rollback()
+            created.append(None)
+    return created
+
+def job_lease_name(job_id):
+    """Get the name of a job's lease."""
+    return f"job:{job_id}"
+
+def job_lease_live():
+    """
+    Get the filter matching jobs whose lease is held, i.e. whose process is alive and working on them.
+    
+    Expiry is compared with the database's clock, like the leases themselves are written.
+    """
+    name = literal("job:", String) + cast(Job.id, String)
+    return exists().where(Lease.name == name, Lease.expires_at > db_time())
+
+def claim_next_job(lease_ttl, account_id=None):
+    """
+    Atomically claim an account's next job that is ready to be processed.
+    
+    A job is ready when it is pending and not deferred, or when it is running but its lease
+    expired (its process died or lost touch with the database). Ready jobs are claimed by
+    priority, then by virtual time: each sender's reels are spaced by their rate limit, so a
+    sender who queued many reels at once takes turns with the others instead of going first.
+    
+    Claiming a job takes its lease, so no other process works on it until the lease expires,
+    and records the lease's fencing token on the job, so writes of a previous holder fail.
+    
+    Args:
+        lease_ttl (float): Seconds the job's lease is held unless renewed.
+        account_id (int): The ID of the account, or None for the account from the settings.
+    
+    Returns:
+        Job: The claimed Job object, or None if no job is ready or another worker won the race.
+    """
+    now = utcnow()
+    ready = and_(of_account(account_id), or_(
+        and_(Job.status == Job.PENDING, or_(Job.run_after.is_(None), Job.run_after <= now)),
+        and_(Job.status == Job.RUNNING, ~job_lease_live()),
+    ))
+    # Find the ready job with the highest priority and the earliest fair-share slot
+    order = (Job.priority.desc(), func.coalesce(Job.virtual_time, Job.created_at), Job.id)
+    job = Job.query.filter(ready).order_by(*order).first()
+    db.session.commit()  # End the read transaction so the next poll sees fresh data
+    if job is None:
+        return None
+    # Only one process gets the lease, even across nodes
+    name = job_lease_name(job.id)
+    token = acquire_lease(name, lease_ttl, after=job.lease_token or 0)
+    if token is None:
+        return None
+    # Flip the job to running under the new token, unless it was finished meanwhile
+    claimed = Job.query.filter(
+        Job.id == job.id, Job.status.in_((Job.PENDING, Job.RUNNING)),
+        or_(Job.lease_token.is_(None), Job.lease_token < token),
+    ).update(
+        {"status": Job.RUNNING, "attempts": Job.attempts + 1, "lease_token": token, "updated_at": utcnow()},
+        synchronize_session=False,
+    )
+    db.session.commit()
+    if claimed != 1:
+        release_lease(name, token)
+        return None
+    db.session.refresh(job)  # Reload the claimed row
+    job.held_token = token
+    return job
+
+def get_orphaned_publishing_jobs():
+    """
+    Get the publishing jobs whose lease expired, i.e. whose process died before the container was published.
+    
+    Returns:
+        list[Job]: The abandoned jobs that have a media container to resume.
+    """
+    jobs = Job.query.filter(Job.status == Job.PUBLISHING, Job.container_id.isnot(None),
+                            ~job_lease_live()).order_by(Job.id).all()
+    db.session.commit()  # End the read transaction so the next pass sees fresh data
+    return jobs
+
+def take_over_job(job, lease_ttl):
+    """
+    Atomically take over an abandoned publishing job by taking its lease.
+    
+    Args:
+        job (Job): A job returned by ``get_orphaned_publishing_jobs``.
+        lease_ttl (float): Seconds the job's lease is held unless renewed.
+    
+    Returns:
+        bool: True if this process now owns the job, False if another process took it over first.
+    """
+    name = job_lease_name(job.id)
+    token = acquire_lease(name, lease_ttl, after=job.lease_token or 0)
+    if token is None:
+        return False
+    expected = job.lease_token
+    taken = Job.query.filter(Job.id == job.id, Job.status == Job.PUBLISHING,
+                             Job.lease_token.is_(None) if expected is None else Job.lease_token == expected).update(
+        {"lease_token": token, "updated_at": utcnow()}, synchronize_session=False,
+    )
+    db.session.commit()
+    if taken != 1:
+        release_lease(name, token)
+        return False
+    db.session.refresh(job)  # Reload the taken row
+    job.held_token = token
+    return True
+
+def fence(job):
+    """Get the filter matching a job only while it is still held under the lease token this process claimed it with."""
+    if job.held_token is not None:
+        return Job.lease_token == job.held_token
+    return Job.lease_token.is_(None)  # Never claimed, e.g. dropped by admission control
+
+def _fenced_update(job, values):
+    """
+    Write new values to a job, unless its lease passed to another process since it was claimed.
+    
+    Raises:
+        LeaseLost: If another process holds the job now.
+    """
+    updated = Job.query.filter(Job.id == job.id, fence(job)).update(dict(values, updated_at=utcnow()), synchronize_session=False)
+    db.session.commit()
+    if updated != 1:
+        raise LeaseLost(f"Job {job.id} was claimed by another process")
+    for key, value in values.items():
+        set_committed_value(job, key, value)  # Keep the loaded job in line without reloading it
+    return job
+
+def update_job(job, status, hashed=None, container_id=None, fingerprint=None, error=None):
+    """
+    Record a new state for a job.
+    
+    The write is fenced: it only goes through while the job is held under the lease token it
+    was claimed with, so a process that lost its lease cannot overwrite the new holder's progress.
+    
+    Args:
+        job (Job): The job to update.
+        status (str): The new status of the job.
+        hashed (str): The hash of the video, if known.
+        container_id (str): The ID of the media container, if one was created.
+        fingerprint (str): The perceptual fingerprint of the video, if known.
+        error (str): The error message, if the job failed.
+    
+    Returns:
+        Job: The updated Job object.
+    
+    Raises:
+        LeaseLost: If another process claimed the job since.
+    """
+    values = {"status": status, "error": error[:2083] if error else None}  # Trim the error to fit the column
+    if hashed is not None:
+        values["hashed"] = hashed
+    if container_id is not None:
+        values["container_id"] = container_id
+    if fingerprint is not None:
+        values["fingerprint"] = fingerprint
+    return _fenced_update(job, values)
+
+def defer_job(job, run_after, reason):
+    """
+    Put a claimed job back in the queue until ``run_after``, without counting the attempt.
+    
+    Args:
+        job (Job): The job to defer.
+        run_after (datetime): Earliest time the job may be claimed again.
+        reason (str): Why the job was deferred, recorded as its ``shed_reason``.
+    
+    Returns:
+        Job: The updated Job object.
+    
+    Raises:
+        LeaseLost: If another process claimed the job since.
+    """
+    return _fenced_update(job, {"status": Job.PENDING, "run_after": run_after, "shed_reason": reason,
+                                "attempts": max(0, job.attempts - 1)})
@@ -0,0 +1,286 @@
+# Import necessary modules for the video download engine
+import logging
+import os
+import random
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import HTTPError as URLLib3Error
+from app.config import get_settings
+from app.metrics import DOWNLOADED_BYTES, DOWNLOAD_RESUMES
+
+logger = logging.getLogger("LOLify.download")
+
+# Parses "bytes START-END/TOTAL"
+_CONTENT_RANGE = re.compile(r"bytes (\d+)-(\d+)/(\d+|\*)")
+
+class DownloadError(Exception):
+    """Raised when a video cannot be downloaded."""
+
+class DownloadTimeout(DownloadError):
+    """Raised when a download runs past its total time budget."""
+
+class _Interrupted(Exception):
+    """Raised when a response ends before the requested range was received."""
+
+# Per-thread reusable read buffers, so memory per stream is bounded by one chunk
+_buffers = threading.local()
+
+def _get_buffer(size):
+    """Get this thread's reusable read buffer, allocating it on first use."""
+    buffer = getattr(_buffers, "buffer", None)
+    if buffer is None or len(buffer) != size:
+        buffer = _buffers.buffer = bytearray(size)
+    return buffer
+
+class RangedDownloader:
+    """
+    Download engine that fetches large videos as parallel byte ranges.
+
+    The first request asks for the first part only: its response tells us whether the CDN
+    supports ranges and how big the video is. The rest of the video is then fetched as
+    fixed-size parts on a small thread pool while the first part streams, and every part
+    is handed to the sink in order, so the video can be hashed incrementally as it arrives.
+
+    An interrupted part is resumed from the last byte received instead of from zero. Every
+    request has connect and read timeouts, and the whole download has a total time budget,
+    so a stalled connection can never hold a worker for longer than that.
+    """
+
+    def __init__(self, part_size=4 * 1024 * 1024, parallelism=4, chunk_size=1024 * 1024, connect_timeout=10.0,
+                 read_timeout=30.0, total_timeout=300.0, max_retries=3, backoff_base=0.5):
+        """
+        Initialize the downloader.
+
+        Args:
+            part_size (int): Size in bytes of each byte range.
+            parallelism (int): Number of ranges fetched concurrently besides the first one.
+            chunk_size (int): Size of the read buffer.
+            connect_timeout (float): Seconds to wait for a connection to the CDN.
+            read_timeout (float): Seconds to wait for the next bytes of a response before treating it as stalled.
+            total_timeout (float): Seconds a whole download may take.
+            max_retries (int): Number of times each range is resumed after a failure.
+            backoff_base (float): Base delay in seconds of the exponential backoff between resumes.
+        """
+        self.part_size = part_size
+        self.parallelism = max(1, parallelism)
+        self.chunk_size = chunk_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.total_timeout = total_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        session = requests.Session()
+        session.headers["Accept-Encoding"] = "identity"  # Byte ranges must refer to the stored bytes
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=0)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        self.session = session
+
+    def download(self, url, sink, max_bytes):
+        """
+        Download a video into a callable, in order.
+
+        Args:
+            url (str): The URL of the video.
+            sink (callable): Called with a memoryview of each chunk, in order; the view is only valid during the call.
+            max_bytes (int): Abort if the video is larger than this.
+
+        Returns:
+            int: The number of bytes downloaded.
+
+        Raises:
+            DownloadError: If the video could not be downloaded, or DownloadTimeout if it took too long.
+        """
+        deadline = time.monotonic() + self.total_timeout
+        cancel = threading.Event()
+        response = self._probe(url, deadline)
+        if response.status_code == 200:
+            # The server ignores ranges: stream the whole video over one connection
+            content_length = int(response.headers.get("Content-Length") or 0)
+            if content_length > max_bytes:
+                response.close()
+                raise DownloadError(f"Video too large: {content_length} bytes")
+            return self._fetch(url, 0, None, sink, deadline, cancel, response=response, max_bytes=max_bytes)
+        if response.status_code != 206:
+            response.close()
+            raise DownloadError(f"Failed to download video, status code: {response.status_code}")
+        match = _CONTENT_RANGE.match(response.headers.get("Content-Range", ""))
+        size = int(match.group(3)) if match and match.group(3) != "*" else None
+        if size is None:
+            response.close()
+            raise DownloadError("Failed to download video, missing Content-Range")
+        if size > max_bytes:
+            response.close()
+            raise DownloadError(f"Video too large: {size} bytes")
+
+        first_end = min(size, self.part_size)
+        parts = iter([(start, min(size, start + self.part_size)) for start in range(first_end, size, self.part_size)])
+        executor = ThreadPoolExecutor(max_workers=self.parallelism, thread_name_prefix="download")
+        window = deque()  # (part, future) in video order, at most `parallelism` of them
+
+        def submit_next():
+            part = next(parts, None)
+            if part is not None:
+                window.append((part, executor.submit(self._fetch_part, url, part[0], part[1], deadline, cancel)))
+
+        try:
+            # Start fetching the following parts while the first one streams into the sink
+            for _ in range(self.parallelism):
+                submit_next()
+            total = self._fetch(url, 0, first_end, sink, deadline, cancel, response=response)
+            while window:
+                (start, end), future = window.popleft()
+                try:
+                    data = future.result(timeout=max(0.0, deadline - time.monotonic()))
+                except FutureTimeoutError:
+                    raise DownloadTimeout(f"Download exceeded {self.total_timeout}s")
+                submit_next()
+                sink(memoryview(data))
+                total += len(data)
+            return total
+        finally:
+            # Stop parts still in flight; their threads exit at the next chunk or read timeout
+            cancel.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _probe(self, url, deadline):
+        """Request the first part of a video, retrying connection errors and 5xx responses."""
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self._open(url, 0, self.part_size, deadline)
+            except (requests.RequestException, OSError) as e:
+                error = e
+            else:
+                if response.status_code < 500 and response.status_code != 429:
+                    return response
+                error = f"status code {response.status_code}"
+                response.close()
+            if attempt == self.max_retries:
+                raise DownloadError(f"Failed to download video: {error}")
+            self._backoff(attempt, deadline)
+
+    def _backoff(self, attempt, deadline):
+        """Sleep a jittered exponential backoff delay, unless it would run past the deadline."""
+        delay = random.uniform(0, self.backoff_base * 2 ** attempt)
+        if time.monotonic() + delay > deadline:
+            raise DownloadTimeout(f"Download exceeded {self.total_timeout}s")
+        time.sleep(delay)
+
+    def _fetch_part(self, url, start, end, deadline, cancel):
+        """Fetch a byte range into memory, resuming after failures, as immutable bytes."""
+        data = bytearray(end - start)
+        position = 0
+
+        def write(chunk):
+            nonlocal position
+            data[position:position + len(chunk)] = chunk
+            position += len(chunk)
+
+        self._fetch(url, start, end, write, deadline, cancel)
+        # Copied here, on the part's own thread, so the sink can keep the part without copying it
+        return bytes(data)
+
+    def _fetch(self, url, start, end, write, deadline, cancel, response=None, max_bytes=None):
+        """
+        Stream bytes ``start``..``end`` (exclusive) of a video into ``write``, resuming after failures.
+
+        Args:
+            url (str): The URL of the video.
+            start (int): First byte of the range.
+            end (int): End of the range, or None to read until the response ends (no resume possible).
+            write (callable): Called with a memoryview of each chunk, in order.
+            deadline (float): ``time.monotonic()`` value after which the download is abandoned.
+            cancel (threading.Event): Set when the download as a whole has failed.
+            response (requests.Response): An already open response for the start of the range, if any.
+            max_bytes (int): Abort if more than this many bytes arrive (only checked when ``end`` is None).
+
+        Returns:
+            int: The number of bytes fetched.
+        """
+        offset = start
+        buffer = _get_buffer(self.chunk_size)
+        view = memoryview(buffer)
+        for attempt in range(self.max_retries + 1):
+            try:
+                if response is None:
+                    response = self._open(url, offset, end, deadline)
+                    match = _CONTENT_RANGE.match(response.headers.get("Content-Range", ""))
+                    if response.status_code != 206 or not match or int(match.group(1)) != offset:
+                        status = response.status_code
+                        if status >= 500 or status == 429:
+                            raise _Interrupted(f"status code {status}")
+                        raise DownloadError(f"Range request failed, status code: {status}")
+                raw = response.raw
+                raw.decode_content = True
+                while end is None or offset < end:
+                    if cancel.is_set():
+                        raise DownloadError("Download cancelled")
+                    if time.monotonic() > deadline:
+                        raise DownloadTimeout(f"Download exceeded {self.total_timeout}s")
+                    want = self.chunk_size if end is None else min(self.chunk_size, end - offset)
+                    size = raw.readinto(view[:want])
+                    if not size:
+                        break
+                    offset += size
+                    DOWNLOADED_BYTES.inc(size)
+                    if max_bytes is not None and offset - start > max_bytes:
+                        raise DownloadError(f"Video exceeded {max_bytes} bytes")
+                    write(view[:size])
+                if end is not None and offset < end:
+                    raise _Interrupted(f"connection closed at byte {offset}")
+                return offset - start
+            except (_Interrupted, requests.RequestException, URLLib3Error, OSError) as e:
+                if end is None or attempt == self.max_retries:
+                    raise DownloadError(f"Download failed at byte {offset}: {e}")
+                DOWNLOAD_RESUMES.inc()
+                logger.warning("Download of %s interrupted at byte %s (%s), resuming", url, offset, e)
+                self._backoff(attempt, deadline)
+            finally:
+                if response is not None:
+                    response.close()
+                    response = None
+
+    def _open(self, url, start, end, deadline):
+        """Send a range request for bytes ``start``..``end`` (exclusive; None for the rest of the video)."""
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise DownloadTimeout(f"Download exceeded {self.total_timeout}s")
+        byte_range = f"bytes={start}-" if end is None else f"bytes={start}-{end - 1}"
+        timeout = (min(self.connect_timeout, remaining), min(self.read_timeout, remaining))
+        return self.session.get(url, headers={"Range": byte_range}, stream=True, timeout=timeout)
+
+# Process-wide downloader, created on first use
+_downloader = None
+_downloader_lock = threading.Lock()
+
+def get_downloader():
+    """Get the process-wide video downloader, configured from the app settings."""
+    global _downloader
+    if _downloader is None:
+        with _downloader_lock:
+            if _downloader is None:
+                settings = get_settings()
+                _downloader = RangedDownloader(
+                    part_size=settings.DOWNLOAD_PART_SIZE,
+                    parallelism=settings.DOWNLOAD_PARALLELISM,
+                    chunk_size=settings.DOWNLOAD_CHUNK_SIZE,
+                    connect_timeout=settings.DOWNLOAD_CONNECT_TIMEOUT,
+                    read_timeout=settings.DOWNLOAD_READ_TIMEOUT,
+                    total_timeout=settings.DOWNLOAD_TOTAL_TIMEOUT,
+                    max_retries=settings.DOWNLOAD_MAX_RETRIES,
+                )
+    return _downloader
+
+def _reset_after_fork():
+    """Give a forked child (e.g. gunicorn --preload) its own connection pool instead of the parent's sockets."""
+    global _downloader, _downloader_lock
+    _downloader = None
+    _downloader_lock = threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
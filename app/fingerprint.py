@@ -0,0 +1,245 @@
+# Import necessary modules for perceptual video fingerprints
+import functools
+import itertools
+import logging
+import shutil
+import subprocess
+import threading
+
+logger = logging.getLogger("LOLify.fingerprint")
+
+# ffmpeg is optional: without it, near-duplicate detection is simply skipped
+FFMPEG = shutil.which("ffmpeg")
+
+# Frames are sampled once per second and shrunk to a 9x8 grayscale grid
+FRAME_WIDTH = 9
+FRAME_HEIGHT = 8
+FRAME_SIZE = FRAME_WIDTH * FRAME_HEIGHT
+MAX_FRAMES = 16
+# Frames whose brightness barely varies (black or blank screens) give meaningless hashes
+MIN_CONTRAST = 8
+
+def fingerprint_from_frames(data):
+    """
+    Compute a 64-bit difference hash from raw 9x8 grayscale frames.
+
+    The frames are averaged pixel by pixel, then each bit records whether a pixel is
+    brighter than its right-hand neighbour. Re-encoding or rescaling a video barely
+    changes these relations, so copies of the same reel end up a few bits apart.
+
+    Args:
+        data (bytes): Concatenated raw frames, FRAME_SIZE bytes each.
+
+    Returns:
+        int: The fingerprint, or None if there are no usable frames.
+    """
+    frames = len(data) // FRAME_SIZE
+    if not frames:
+        return None
+    sums = [0] * FRAME_SIZE
+    for frame in range(frames):
+        offset = frame * FRAME_SIZE
+        for index, value in enumerate(data[offset:offset + FRAME_SIZE]):
+            sums[index] += value
+    if (max(sums) - min(sums)) / frames < MIN_CONTRAST:
+        return None
+    fingerprint = 0
+    for row in range(FRAME_HEIGHT):
+        for col in range(FRAME_WIDTH - 1):
+            index = row * FRAME_WIDTH + col
+            fingerprint = (fingerprint << 1) | (sums[index] > sums[index + 1])
+    return fingerprint
+
+def to_hex(fingerprint):
+    """Format a fingerprint for storage in the database."""
+    return None if fingerprint is None else f"{fingerprint:016x}"
+
+def from_hex(value):
+    """Parse a fingerprint stored in the database."""
+    return None if not value else int(value, 16)
+
+class FingerprintSink:
+    """
+    Download sink that pipes video bytes into ffmpeg to sample frames while the video is hashed.
+
+    Use it as the ``sink`` of ``get_hash_from_video`` and call ``result()`` once the download is done.
+    """
+
+    def __init__(self):
+        """Start the ffmpeg process that decodes the video from stdin."""
+        self._start()
+
+    def _start(self):
+        """Start a new ffmpeg process."""
+        self._process = subprocess.Popen(
+            [
+                FFMPEG, "-loglevel", "error", "-i", "pipe:0",
+                "-vf", f"fps=1,scale={FRAME_WIDTH}:{FRAME_HEIGHT}:flags=area,format=gray",
+                "-frames:v", str(MAX_FRAMES), "-f", "rawvideo", "pipe:1",
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        self._open = True
+
+    @classmethod
+    def open(cls):
+        """Create a sink, or return None if ffmpeg is not installed."""
+        return cls() if FFMPEG else None
+
+    def __call__(self, chunk):
+        """Feed a chunk of the video to ffmpeg."""
+        if not self._open:
+            return
+        try:
+            self._process.stdin.write(chunk)
+        except (BrokenPipeError, ValueError):
+            # ffmpeg stops reading once it has sampled enough frames
+            self._open = False
+
+    def result(self, timeout=30):
+        """
+        Finish decoding and compute the fingerprint.
+
+        Returns:
+            int: The fingerprint, or None if the video could not be decoded.
+        """
+        try:
+            stdout, _ = self._process.communicate(timeout=timeout)
+        except (subprocess.TimeoutExpired, BrokenPipeError, ValueError) as e:
+            self.close()
+            logger.warning("Failed to sample video frames: %s", e)
+            return None
+        return fingerprint_from_frames(stdout)
+
+    def close(self):
+        """Abort the ffmpeg process without computing a fingerprint."""
+        self._open = False
+        self._process.kill()
+        self._process.wait()
+
+    def reset(self):
+        """Drop the bytes fed so far and start over, e.g. when the video is read again from the start."""
+        self.close()
+        self._start()
+
+def _hamming(a, b):
+    """Count the bits that differ between two fingerprints."""
+    return bin(a ^ b).count("1")
+
+class FingerprintIndex:
+    """
+    In-memory multi-index hash for Hamming-distance search over 64-bit fingerprints.
+
+    Each fingerprint is split into four 16-bit bands stored in separate dictionaries. If two
+    fingerprints are within ``max_distance`` bits, at least one band differs by no more than
+    ``max_distance // 4`` bits, so a lookup only probes a handful of buckets per band instead
+    of scanning every stored post.
+    """
+
+    BANDS = 4
+    BAND_BITS = 16
+    # Post IDs below the highest indexed one that every refresh scans again: IDs are handed out
+    # when a post is inserted, so a post may commit after one with a higher ID (e.g. on PostgreSQL)
+    REFRESH_OVERLAP = 1000
+
+    def __init__(self):
+        """Initialize an empty index."""
+        self._tables = [{} for _ in range(self.BANDS)]
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._last_post_id = 0
+        self._recent_ids = set()  # Indexed posts within REFRESH_OVERLAP of the highest ID
+        self._size = 0
+
+    def __len__(self):
+        """Get the number of fingerprints in the index."""
+        return self._size
+
+    def _bands(self, fingerprint):
+        """Split a fingerprint into its band keys."""
+        mask = (1 << self.BAND_BITS) - 1
+        return [(fingerprint >> (band * self.BAND_BITS)) & mask for band in range(self.BANDS)]
+
+    def add(self, fingerprint, post_id):
+        """
+        Add a fingerprint to the index.
+
+        Args:
+            fingerprint (int): The fingerprint of the post.
+            post_id (int): The ID of the post it belongs to.
+        """
+        with self._lock:
+            for table, key in zip(self._tables, self._bands(fingerprint)):
+                table.setdefault(key, []).append((fingerprint, post_id))
+            self._size += 1
+            self._last_post_id = max(self._last_post_id, post_id)
+
+    def search(self, fingerprint, max_distance):
+        """
+        Find the stored posts whose fingerprint is within ``max_distance`` bits.
+
+        Every match is returned, as the closest one may have been deleted or released since
+        it was indexed.
+
+        Args:
+            fingerprint (int): The fingerprint to look up.
+            max_distance (int): The largest Hamming distance considered a match.
+
+        Returns:
+            list[int]: The IDs of the matching posts, closest first.
+        """
+        radius = max_distance // self.BANDS
+        matches = {}
+        with self._lock:
+            for table, key in zip(self._tables, self._bands(fingerprint)):
+                for mask in self._probe_masks(radius):
+                    for candidate, post_id in table.get(key ^ mask, ()):
+                        distance = _hamming(candidate, fingerprint)
+                        if distance <= max_distance:
+                            matches[post_id] = distance
+        return sorted(matches, key=lambda post_id: (matches[post_id], post_id))
+
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def _probe_masks(cls, radius):
+        """Get the XOR masks that turn a band key into every key within ``radius`` bits of it."""
+        masks = [0]
+        for flips in range(1, radius + 1):
+            for bits in itertools.combinations(range(cls.BAND_BITS), flips):
+                masks.append(sum(1 << bit for bit in bits))
+        return tuple(masks)
+
+    def refresh(self, session, model):
+        """
+        Load fingerprints of posts stored since the last refresh, e.g. by other processes.
+
+        The last REFRESH_OVERLAP IDs are scanned again, so posts that committed after a post
+        with a higher ID are still picked up.
+
+        Args:
+            session (Session): The database session to query with.
+            model (type): The Post model.
+        """
+        with self._refresh_lock:
+            floor = max(0, self._last_post_id - self.REFRESH_OVERLAP)
+            rows = (
+                session.query(model.id, model.fingerprint)
+                .filter(model.id > floor, model.fingerprint.isnot(None))
+                .order_by(model.id)
+                .all()
+            )
+            for post_id, fingerprint in rows:
+                if post_id not in self._recent_ids:
+                    self.add(from_hex(fingerprint), post_id)
+                    self._recent_ids.add(post_id)
+            floor = self._last_post_id - self.REFRESH_OVERLAP
+            self._recent_ids = {post_id for post_id in self._recent_ids if post_id > floor}
+
+# Process-wide index shared by every worker thread
+_index = FingerprintIndex()
+
+def get_fingerprint_index():
+    """Get the process-wide fingerprint index."""
+    return _index
@@ -0,0 +1,263 @@
+# Import necessary modules for the in-process known-hash filter
+import hashlib
+import logging
+import math
+import os
+import threading
+from collections import OrderedDict
+import click
+from flask import current_app
+from app.metrics import HASH_FILTER_LOOKUPS
+
+logger = logging.getLogger("LOLify.hashfilter")
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings, using double hashing to derive the bit positions."""
+
+    def __init__(self, capacity, error_rate=0.001):
+        """
+        Initialize an empty filter sized for ``capacity`` items at the given false-positive rate.
+
+        Args:
+            capacity (int): Expected number of items.
+            error_rate (float): Target false-positive rate at full capacity.
+        """
+        capacity = max(1, capacity)
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        """Get the bit positions of an item."""
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+    def add(self, item):
+        """Add an item to the filter."""
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        """Check whether an item may have been added (False means it definitely was not)."""
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    @property
+    def nbytes(self):
+        """Get the memory used by the bit array, in bytes."""
+        return len(self._bits)
+
+    def false_positive_rate(self):
+        """Estimate the current false-positive rate from the number of items added."""
+        return (1 - math.exp(-self.hash_count * self.count / self.size)) ** self.hash_count
+
+class KnownHashFilter:
+    """
+    In-process filter answering "have we seen this video hash?" without a database round trip.
+
+    A Bloom filter over every stored hash gives definite misses, and a small LRU of recently
+    published hashes gives definite hits. Everything else ("maybe") falls through to the database.
+    The filter only ever saves lookups: the atomic hash claim stays the source of truth, so a
+    filter that is stale (e.g. hashes stored by another process) cannot cause a double publish.
+    """
+
+    HIT = "hit"
+    MISS = "miss"
+    MAYBE = "maybe"
+
+    def __init__(self, capacity=1_000_000, error_rate=0.001, lru_size=10_000):
+        """
+        Initialize an empty filter.
+
+        Args:
+            capacity (int): Expected number of stored hashes.
+            error_rate (float): Target false-positive rate of the Bloom filter.
+            lru_size (int): Number of recently published hashes remembered exactly.
+        """
+        self._capacity = capacity
+        self._error_rate = error_rate
+        self._lru_size = lru_size
+        self._bloom = BloomFilter(capacity, error_rate)
+        self._recent = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, hashed, published=False):
+        """
+        Record a stored hash.
+
+        Args:
+            hashed (str): The hash of the video.
+            published (bool): Whether the post is published, which makes it a definite hit.
+        """
+        with self._lock:
+            self._bloom.add(hashed)
+            if published:
+                self._remember(hashed)
+
+    def _remember(self, hashed):
+        """Put a hash at the front of the LRU, evicting the oldest one if full."""
+        self._recent[hashed] = True
+        self._recent.move_to_end(hashed)
+        if len(self._recent) > self._lru_size:
+            self._recent.popitem(last=False)
+
+    def lookup(self, hashed):
+        """
+        Classify a hash without touching the database.
+
+        Args:
+            hashed (str): The hash of the video.
+
+        Returns:
+            str: HIT if the hash was recently published, MISS if it was never stored here, MAYBE otherwise.
+        """
+        with self._lock:
+            if hashed in self._recent:
+                self._recent.move_to_end(hashed)
+                result = self.HIT
+            elif hashed not in self._bloom:
+                result = self.MISS
+            else:
+                result = self.MAYBE
+        HASH_FILTER_LOOKUPS.inc(result=result)
+        return result
+
+    def remember(self, hashed):
+        """Record that a hash was found published in the database."""
+        with self._lock:
+            self._remember(hashed)
+
+    def load(self, session, model, batch_size=10_000):
+        """
+        Rebuild the filter from every post in the database.
+
+        The Bloom filter is sized for at least twice the stored posts, so it stays accurate as the table grows.
+
+        Args:
+            session (Session): The database session to query with.
+            model (type): The Post model.
+            batch_size (int): Number of rows fetched per round trip.
+        """
+        count = session.query(model.id).count()
+        bloom = BloomFilter(max(self._capacity, 2 * count), self._error_rate)
+        for (hashed,) in session.query(model.hashed).yield_per(batch_size):
+            bloom.add(hashed)
+        recent = (
+            session.query(model.hashed)
+            .filter(model.media_id.isnot(None))
+            .order_by(model.id.desc())
+            .limit(self._lru_size)
+            .all()
+        )
+        lru = OrderedDict((hashed, True) for (hashed,) in reversed(recent))
+        with self._lock:
+            self._bloom = bloom
+            self._recent = lru
+
+    def stats(self):
+        """
+        Describe the filter.
+
+        Returns:
+            dict: Number of hashes, memory footprint and estimated false-positive rate.
+        """
+        with self._lock:
+            return {
+                "items": self._bloom.count,
+                "bloom_bytes": self._bloom.nbytes,
+                "bloom_bits": self._bloom.size,
+                "hash_functions": self._bloom.hash_count,
+                "false_positive_rate": self._bloom.false_positive_rate(),
+                "recent": len(self._recent),
+            }
+
+# Process-wide filter shared by every worker thread, loaded on first use
+_filter = None
+_filter_lock = threading.Lock()
+
+def load_hash_filter():
+    """
+    Build a filter sized by the settings and load it from the post table.
+
+    Returns:
+        KnownHashFilter: The loaded filter, or an empty one if the table cannot be read yet.
+    """
+    # Imported here as the models need the app package to be initialized
+    from app import db
+    from app.config import get_settings
+    from app.models import Post
+    settings = get_settings()
+    hash_filter = KnownHashFilter(settings.HASH_FILTER_CAPACITY, settings.HASH_FILTER_ERROR_RATE, settings.HASH_FILTER_RECENT)
+    try:
+        hash_filter.load(db.session, Post)
+        db.session.commit()  # End the read transaction
+    except Exception as e:
+        # The table may not exist yet, e.g. before the first migration
+        db.session.rollback()
+        logger.warning("Could not load the known-hash filter: %s", e)
+    return hash_filter
+
+def get_hash_filter():
+    """Get the process-wide known-hash filter, loading it from the post table on first use."""
+    global _filter
+    if _filter is None:
+        with _filter_lock:
+            if _filter is None:
+                _filter = load_hash_filter()
+    return _filter
+
+def reload_hash_filter():
+    """
+    Rebuild the process-wide filter from the post table, if this process has loaded it.
+
+    Picks up hashes stored by other processes and nodes, e.g. by ``flask backfill``, and
+    resizes the Bloom filter as the table grows. Lookups keep using the old filter until
+    the new one is complete.
+
+    Returns:
+        bool: True if the filter was reloaded.
+    """
+    global _filter
+    if _filter is None:
+        return False
+    hash_filter = load_hash_filter()
+    with _filter_lock:
+        _filter = hash_filter
+    return True
+
+def loaded_hash_filter():
+    """Get the process-wide filter if it was loaded, without loading it, e.g. for the metrics."""
+    return _filter
+
+def configure_hash_filter(capacity, error_rate, lru_size):
+    """Replace the process-wide filter with an empty one of the given size."""
+    global _filter
+    _filter = KnownHashFilter(capacity, error_rate, lru_size)
+    return _filter
+
+def _reset_after_fork():
+    """Give a forked child its own lock; the parent's filter stays valid as a copy."""
+    global _filter_lock
+    _filter_lock = threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+@click.command("rebuild-hash-filter")
+def rebuild_hash_filter_command():
+    """
+    Build the known-hash filter from the post table and report its size and accuracy.
+
+    Running worker processes rebuild their own filter every HASH_FILTER_RELOAD_INTERVAL seconds.
+    """
+    stats = load_hash_filter().stats()
+    click.echo(f"Hashes:              {stats['items']}")
+    click.echo(f"Recently published:  {stats['recent']}")
+    click.echo(f"Bloom filter:        {stats['bloom_bits']} bits, {stats['hash_functions']} hash functions")
+    click.echo(f"Memory:              {stats['bloom_bytes'] / 1024 / 1024:.2f} MiB")
+    click.echo(f"False-positive rate: {stats['false_positive_rate']:.2e} (target {current_app.config['HASH_FILTER_ERROR_RATE']})")
+    interval = current_app.config["HASH_FILTER_RELOAD_INTERVAL"]
+    click.echo(f"Worker processes reload their filter {f'every {interval:g}s' if interval > 0 else 'only on restart'}")
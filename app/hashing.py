@@ -0,0 +1,287 @@
+# Import necessary modules for the versioned content hashing engine
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import click
+from app.cache import TTLCache
+from app.config import get_settings
+
+logger = logging.getLogger("LOLify.hashing")
+
+# Hash algorithms by version, as stored in Post.hash_version; every digest is 64 hex characters.
+# Version 1 is the original SHA-256, kept so existing rows stay comparable.
+HASH_ALGORITHMS = {
+    1: ("sha256", lambda: hashlib.sha256()),
+    2: ("blake2b-256", lambda: hashlib.blake2b(digest_size=32)),
+}
+
+# Chunks at least this large are hashed without a copy when hashing on the calling thread
+_DIRECT_SIZE = 64 * 1024
+
+# Hash versions still present in the post table, reloaded every few minutes
+_stored_versions = TTLCache(300)
+
+# Threads the hashing runs on, started on first use
+_pool = None
+_pool_lock = threading.Lock()
+
+def current_version():
+    """Get the hash version new posts are stored under (the HASH_VERSION setting)."""
+    return get_settings().HASH_VERSION
+
+def new_hash(version=None):
+    """
+    Create a hash object of the given version.
+
+    Args:
+        version (int): The hash version (defaults to the current one).
+
+    Returns:
+        hashlib hash: An empty hash object.
+
+    Raises:
+        ValueError: If the version is unknown.
+    """
+    version = version or current_version()
+    if version not in HASH_ALGORITHMS:
+        raise ValueError(f"Unknown hash version {version}")
+    return HASH_ALGORITHMS[version][1]()
+
+def get_hash_pool():
+    """Get the process-wide pool of hashing threads, starting it on first use."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPoolExecutor(max_workers=max(1, get_settings().HASH_THREADS), thread_name_prefix="hash")
+    return _pool
+
+def _reset_after_fork():
+    """Forget the parent's hashing threads in a forked child; they do not exist there."""
+    global _pool
+    _pool = None
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+class StreamHasher:
+    """
+    Hash a stream of chunks under one or more hash versions, off the calling thread.
+
+    Small chunks are copied into a large buffer; each full buffer is hashed on the hashing
+    pool while the next one fills up, so the download keeps going while the previous buffer
+    is hashed. Chunks backed by immutable bytes at least as large as the buffer, such as the
+    parts of a ranged download, are handed over without a copy. hashlib releases the GIL
+    while it hashes a large buffer, so the hashing threads do not hold up request handling
+    either. Buffers are hashed in order, one at a time, so the digests are the same as
+    hashing the whole video in one go.
+
+    With HASH_THREADS set to 0 (the default on a single CPU, where the copy would cost more
+    than the overlap gains) large chunks are hashed on the calling thread as they come.
+
+    Use it as a download sink and call ``hexdigests()`` once the stream is done.
+    """
+
+    def __init__(self, versions, buffer_size=None):
+        """
+        Initialize the hasher.
+
+        Args:
+            versions (list[int]): The hash versions to compute, e.g. the current one and those
+                of rows that were not migrated yet.
+            buffer_size (int): Bytes handed to the hashing pool at once (defaults to the HASH_BUFFER_SIZE setting).
+        """
+        self._hashes = {version: new_hash(version) for version in versions}
+        self._inline = get_settings().HASH_THREADS <= 0
+        size = buffer_size or get_settings().HASH_BUFFER_SIZE
+        # Two buffers: one being filled while the other one is hashed
+        self._buffers = [bytearray(size), bytearray(size)]
+        self._filling = 0
+        self._used = 0
+        self._pending = None  # Future of the buffer being hashed
+
+    def __call__(self, chunk):
+        """Add a chunk of the stream; the chunk may be reused by the caller once this returns."""
+        chunk = memoryview(chunk)
+        if not self._used and (self._inline and len(chunk) >= _DIRECT_SIZE
+                               or isinstance(chunk.obj, bytes) and len(chunk) >= len(self._buffers[0])):
+            # Hashed right away, or immutable so it can be hashed later without a copy
+            self._submit(chunk)
+            return
+        while chunk:
+            buffer = self._buffers[self._filling]
+            taken = min(len(buffer) - self._used, len(chunk))
+            buffer[self._used:self._used + taken] = chunk[:taken]
+            self._used += taken
+            chunk = chunk[taken:]
+            if self._used == len(buffer):
+                self._flush()
+
+    def _flush(self):
+        """Hand the buffer being filled to the hashing pool and switch to the other one."""
+        self._submit(memoryview(self._buffers[self._filling])[:self._used])
+        self._filling = 1 - self._filling
+        self._used = 0
+
+    def _submit(self, data):
+        """Hash a buffer after the previous one, on the hashing pool if there is one."""
+        self._wait()
+        if self._inline:
+            self._update(data)
+        else:
+            self._pending = get_hash_pool().submit(self._update, data)
+
+    def _update(self, data):
+        """Hash a buffer under every version."""
+        for hash_func in self._hashes.values():
+            hash_func.update(data)
+
+    def _wait(self):
+        """Wait until the buffer being hashed is done, so it can be filled again."""
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result()
+
+    def hexdigests(self):
+        """
+        Finish hashing the stream.
+
+        Returns:
+            dict: The hex digest of the stream under each version.
+        """
+        if self._used:
+            self._flush()
+        self._wait()
+        return {version: hash_func.hexdigest() for version, hash_func in self._hashes.items()}
+
+def hash_file(file_path, versions=None, buffer_size=None):
+    """
+    Hash a file under one or more hash versions, reading it in large buffers.
+
+    Args:
+        file_path (Path): Path of the file.
+        versions (list[int]): The hash versions to compute (defaults to the current one).
+        buffer_size (int): Bytes read at once (defaults to the HASH_BUFFER_SIZE setting).
+
+    Returns:
+        dict: The hex digest of the file under each version.
+    """
+    versions = versions or [current_version()]
+    buffer_size = buffer_size or get_settings().HASH_BUFFER_SIZE
+    hashes = {version: new_hash(version) for version in versions}
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open(file_path, "rb") as f:
+        while size := f.readinto(buffer):
+            for hash_func in hashes.values():
+                hash_func.update(view[:size])
+    return {version: hash_func.hexdigest() for version, hash_func in hashes.items()}
+
+def load_stored_versions():
+    """Get the hash versions of the rows in the post table."""
+    # Imported here as the models need the app package to be initialized
+    from app import db
+    from app.models import Post
+    try:
+        versions = {version for (version,) in db.session.query(Post.hash_version).distinct()}
+    except Exception:
+        db.session.rollback()  # The column may not exist yet, e.g. before the migration
+        raise
+    db.session.commit()  # End the read transaction
+    return versions
+
+def hash_versions():
+    """
+    Get the hash versions a new video must be hashed under to be compared with every stored post.
+
+    While rows of an older version remain, new videos are hashed under that version too, in
+    the same pass, so a repeat of an old reel is still caught. Once ``flask rehash-posts`` or
+    the lazy migration of repeats has moved every row to the current version, this is only
+    the current version and the extra hashing stops.
+
+    Returns:
+        list[int]: The current version, followed by the older ones still stored.
+    """
+    current = current_version()
+    try:
+        stored = _stored_versions.get_or_load("versions", load_stored_versions)
+    except Exception as e:
+        logger.warning("Could not load the stored hash versions: %s", e)
+        stored = set(HASH_ALGORITHMS)  # Compare with every version rather than miss a duplicate
+    return [current] + sorted(version for version in stored if version != current and version in HASH_ALGORITHMS)
+
+def invalidate_hash_versions():
+    """Reload the stored hash versions on next use, after rows were migrated in this process."""
+    _stored_versions.invalidate()
+
+def _rehash(path, url, versions):
+    """
+    Hash the video of a post, from the media cache or downloaded again.
+
+    Returns:
+        dict: The digests of the video under each version, or None if it could not be downloaded.
+    """
+    if path is not None:
+        return hash_file(path, versions)
+    # Imported here so that this module does not depend on the Graph API module
+    from app.core import get_hashes_from_video
+    return get_hashes_from_video(url, versions)
+
+@click.command("rehash-posts")
+@click.option("--batch-size", default=200, show_default=True, help="Posts migrated per round.")
+@click.option("--download", is_flag=True, help="Download videos that are not in the media cache again from their job's URL.")
+def rehash_posts_command(batch_size, download):
+    """Move published posts to the current hash version, from their cached videos."""
+    from app import db
+    from app.crud import migrate_post_hash
+    from app.mediacache import get_media_cache
+    from app.metrics import HASH_MIGRATIONS
+    from app.models import Job, Post
+    current = current_version()
+    cache = get_media_cache()
+    migrated = missing = mismatched = 0
+    last_id = 0
+    # Own threads, as downloads hand their bytes to the hashing pool and wait for it
+    with ThreadPoolExecutor(max_workers=max(1, get_settings().HASH_THREADS), thread_name_prefix="rehash") as executor:
+        while True:
+            # Keyset pagination, so every round costs the same however far into the table it is
+            posts = (db.session.query(Post.id, Post.hashed, Post.hash_version, Post.job_id)
+                     .filter(Post.id > last_id, Post.hash_version != current, Post.media_id.isnot(None))
+                     .order_by(Post.id).limit(batch_size).all())
+            if not posts:
+                break
+            last_id = posts[-1].id
+            job_ids = [post.job_id for post in posts if post.job_id]
+            urls = dict(db.session.query(Job.id, Job.url).filter(Job.id.in_(job_ids))) if download and job_ids else {}
+            db.session.commit()  # End the read transaction while the videos are hashed
+            work = []
+            for post in posts:
+                path = cache.find(post.hashed) if cache else None
+                url = urls.get(post.job_id)
+                if path is None and url is None:
+                    missing += 1
+                    continue
+                work.append((post, executor.submit(_rehash, path, url, [current, post.hash_version])))
+            for post, future in work:
+                try:
+                    digests = future.result()
+                except Exception as e:
+                    logger.warning("Could not rehash post %s: %s", post.id, e)
+                    digests = None
+                if not digests:
+                    missing += 1
+                elif digests[post.hash_version] != post.hashed:
+                    mismatched += 1  # The cached or downloaded bytes are not the stored video
+                elif migrate_post_hash(post.id, post.hashed, digests[current], current):
+                    HASH_MIGRATIONS.inc(source="rehash")
+                    migrated += 1
+    invalidate_hash_versions()
+    remaining = Post.query.filter(Post.hash_version != current).count()
+    db.session.commit()
+    click.echo(f"Migrated:   {migrated} post(s) to hash version {current} ({HASH_ALGORITHMS[current][0]})")
+    click.echo(f"Missing:    {missing} video(s) not cached{'' if download else ' (use --download to fetch them again)'}")
+    click.echo(f"Mismatched: {mismatched} video(s) whose bytes differ from the stored hash")
+    click.echo(f"Remaining:  {remaining} post(s) under older versions"
+               f"{', still compared by hashing new videos under them too' if remaining else ''}")
@@ -0,0 +1,182 @@
+# Import necessary modules for the database-backed work leases
+import logging
+import os
+import socket
+import threading
+import uuid
+from datetime import timedelta
+from sqlalchemy import DateTime, func, literal
+from sqlalchemy.exc import IntegrityError
+from app.models import Lease, utcnow
+from app import db
+
+logger = logging.getLogger("LOLify.leases")
+
+class LeaseLost(Exception):
+    """Raised when a write is fenced off because the lease it was made under passed to another process."""
+
+# ID of this process as a lease owner, renewed in forked children
+_node_id = None
+
+# Leases this process holds and keeps renewing, by name, with their fencing token
+_held = {}
+_held_lock = threading.Lock()
+
+def node_id():
+    """Get the ID this process holds leases under: its host name, process ID and a random suffix."""
+    global _node_id
+    if _node_id is None:
+        _node_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    return _node_id
+
+def _reset_after_fork():
+    """Forget the parent's node ID and leases in a forked child; the parent keeps holding them."""
+    global _node_id
+    _node_id = None
+    _held.clear()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+def db_time(offset=0):
+    """
+    Get the database server's current UTC time, plus ``offset`` seconds, as an SQL expression.
+
+    Lease expiry is written and compared with the database's clock rather than each node's,
+    so a node whose clock runs ahead cannot see another node's live lease as expired.
+
+    Args:
+        offset (float): Seconds added to the current time.
+
+    Returns:
+        ColumnElement: The time, or this node's clock on databases without support here.
+    """
+    dialect = db.session.get_bind().dialect.name
+    if dialect == "sqlite":
+        # Same text format as the stored timestamps, so they compare in order
+        return func.strftime("%Y-%m-%d %H:%M:%f", "now", f"{offset:+.3f} seconds", type_=DateTime)
+    if dialect == "postgresql":
+        # Timestamps are stored without a time zone, in UTC
+        now = func.timezone("UTC", func.now(), type_=DateTime)
+        return now + timedelta(seconds=offset) if offset else now
+    return literal(utcnow() + timedelta(seconds=offset), DateTime)
+
+def db_now():
+    """Get the database server's current UTC time, as used for lease expiry."""
+    return db.session.query(db_time()).scalar()
+
+def acquire_lease(name, ttl, after=0):
+    """
+    Atomically take a lease that is free or has expired.
+
+    Every time a lease changes hands its fencing token grows, so a process that lost its
+    lease (e.g. after a long pause) can be told apart from the one holding it now: writes
+    carrying an older token are rejected.
+
+    Args:
+        name (str): What the lease covers, e.g. ``job:42``.
+        ttl (float): Seconds the lease is held unless renewed.
+        after (int): A token the new one must be greater than, for leases whose row may have been purged.
+
+    Returns:
+        int: The fencing token of the lease, or None if another process holds it.
+    """
+    values = {"owner": node_id(), "expires_at": db_time(ttl)}
+    # Take over an expired lease, moving its token on
+    taken = Lease.query.filter(Lease.name == name, Lease.expires_at <= db_time()).update(
+        dict(values, token=Lease.token + 1), synchronize_session=False,
+    )
+    db.session.commit()
+    if taken != 1:
+        # No lease yet, or a live one: only one of several concurrent inserts wins the primary key
+        db.session.add(Lease(name=name, token=after + 1, **values))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return None
+    token = db.session.query(Lease.token).filter_by(name=name, owner=values["owner"]).scalar()
+    db.session.commit()
+    if token is None:
+        return None
+    with _held_lock:
+        _held[name] = token
+    return token
+
+def holds_lease(name, token):
+    """
+    Check that a lease is still held under the given token.
+
+    Args:
+        name (str): The name of the lease.
+        token (int): The fencing token it was acquired with.
+
+    Returns:
+        bool: True if the lease has neither expired nor changed hands.
+    """
+    held = Lease.query.filter(Lease.name == name, Lease.token == token, Lease.expires_at > db_time()).count() == 1
+    db.session.commit()  # End the read transaction
+    return held
+
+def release_lease(name, token):
+    """
+    Give up a lease, keeping its row so the next holder's token is still greater.
+
+    Args:
+        name (str): The name of the lease.
+        token (int): The fencing token it was acquired with; a lease that changed hands is left alone.
+    """
+    with _held_lock:
+        if _held.get(name) == token:
+            del _held[name]
+    Lease.query.filter(Lease.name == name, Lease.token == token).update(
+        {"expires_at": db_time()}, synchronize_session=False,
+    )
+    db.session.commit()
+
+def renew_leases(ttl):
+    """
+    Extend every lease this process holds, forgetting those that expired and changed hands meanwhile.
+
+    Args:
+        ttl (float): Seconds the leases are held from now.
+
+    Returns:
+        int: The number of leases renewed.
+    """
+    with _held_lock:
+        held = list(_held.items())
+    expires_at = db_time(ttl)
+    renewed = 0
+    for name, token in held:
+        updated = Lease.query.filter(Lease.name == name, Lease.token == token, Lease.owner == node_id()).update(
+            {"expires_at": expires_at}, synchronize_session=False,
+        )
+        if updated == 1:
+            renewed += 1
+            continue
+        logger.warning("Lease %s was lost, another process holds it now", name)
+        with _held_lock:
+            if _held.get(name) == token:
+                del _held[name]
+    db.session.commit()
+    return renewed
+
+def held_leases():
+    """Get the number of leases this process holds."""
+    with _held_lock:
+        return len(_held)
+
+def purge_leases(older_than):
+    """
+    Delete leases that expired long ago.
+
+    Args:
+        older_than (float): Seconds since expiry after which a lease is deleted.
+
+    Returns:
+        int: The number of leases deleted.
+    """
+    deleted = Lease.query.filter(Lease.expires_at < db_time(-older_than)).delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
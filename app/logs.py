@@ -0,0 +1,146 @@
+# Import necessary modules for the logging pipeline
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from app.metrics import LOG_RECORDS_DROPPED
+
+# Attributes every LogRecord has; anything else was passed through ``extra``
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+class JSONFormatter(logging.Formatter):
+    """Format records as one JSON object per line, including any ``extra`` fields."""
+
+    def format(self, record):
+        """Render a record as a JSON line."""
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "thread": record.threadName,
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    Queue handler that leaves all formatting to the listener thread.
+
+    The standard QueueHandler merges the message and its arguments before queueing; this one
+    hands over the record as is, so a worker thread only pays for creating the record. When the
+    queue is full the record is dropped and counted instead of blocking the caller.
+    """
+
+    def prepare(self, record):
+        """Render the traceback now (frames may change), but leave the message to the listener."""
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        """Queue a record without blocking, dropping it if the queue is full."""
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+class SamplingFilter(logging.Filter):
+    """Let through one in every ``every`` records of each message template."""
+
+    def __init__(self, every):
+        """
+        Initialize the filter.
+
+        Args:
+            every (int): Keep one record out of this many, per message template (0 drops them all).
+        """
+        super().__init__()
+        self.every = every
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        """Decide whether a record is kept."""
+        if self.every <= 0:
+            return False
+        with self._lock:
+            count = self._counts.get(record.msg, 0)
+            self._counts[record.msg] = count + 1
+        if count % self.every:
+            return False
+        record.sampled = self.every  # Each kept record stands for this many
+        return True
+
+# Listener of the process-wide logging queue, started by configure_logging()
+_listener = None
+_lock = threading.Lock()
+
+def configure_logging(config):
+    """
+    Route the app's loggers through a bounded queue to a background listener thread.
+
+    Args:
+        config (dict): The app configuration, with LOG_LEVEL, LOG_LEVELS, LOG_FORMAT,
+            LOG_FILE, LOG_QUEUE_SIZE and LOG_SAMPLING.
+    """
+    global _listener
+    if config["LOG_FORMAT"] == "json":
+        formatter = JSONFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handlers = [logging.StreamHandler()]
+    if config["LOG_FILE"]:
+        handlers.append(RotatingFileHandler(config["LOG_FILE"], maxBytes=5*1024*1024, backupCount=3))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    with _lock:
+        if _listener is not None:
+            _listener.stop()  # Flush the previous pipeline, e.g. when the app is created twice
+        log_queue = queue.Queue(config["LOG_QUEUE_SIZE"])
+        _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _listener.start()
+
+    logger = logging.getLogger("LOLify")
+    for handler in [h for h in logger.handlers if isinstance(h, DeferredQueueHandler)]:
+        logger.removeHandler(handler)
+    logger.addHandler(DeferredQueueHandler(log_queue))
+    logger.setLevel(config["LOG_LEVEL"])
+    for name, level in config["LOG_LEVELS"].items():
+        logging.getLogger(name).setLevel(level)
+    for name, rate in config["LOG_SAMPLING"].items():
+        sampled = logging.getLogger(name)
+        for existing in [f for f in sampled.filters if isinstance(f, SamplingFilter)]:
+            sampled.removeFilter(existing)
+        sampled.addFilter(SamplingFilter(round(1 / rate) if rate > 0 else 0))
+
+def stop_logging():
+    """Flush queued records and stop the listener thread."""
+    global _listener
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+def _restart_after_fork():
+    """Restart the listener in a forked child (e.g. gunicorn --preload), since threads do not survive a fork."""
+    global _listener
+    if _listener is not None:
+        _listener._thread = None
+        _listener.start()
+
+atexit.register(stop_logging)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_restart_after_fork)
@@ -0,0 +1,258 @@
+# Import necessary modules for the on-disk media cache
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from app.config import get_settings
+from app.metrics import MEDIA_CACHE_REQUESTS, MEDIA_CACHE_EVICTIONS
+
+logger = logging.getLogger("LOLify.mediacache")
+
+class MediaCache:
+    """
+    Content-addressed on-disk cache of downloaded videos, bounded by a byte budget.
+
+    Videos are stored under ``objects/`` by their hash, and ``urls/`` holds one symlink per
+    video URL pointing at its object, so a retry of the same URL can skip the network. Every
+    file is written to ``tmp/`` first and moved into place with an atomic rename, so workers
+    in several threads or processes never see a partial video. When the cache grows past its
+    budget, the least recently used objects are deleted; a hit refreshes an object's mtime.
+
+    Objects are named by the hash version in use, so each version has its own URL index;
+    the objects of an older version stay readable by their hash until they are evicted.
+    """
+
+    def __init__(self, root, max_bytes, hash_version=1):
+        """
+        Initialize the cache, creating its directories if needed.
+
+        Args:
+            root (Path): Directory holding the cache.
+            max_bytes (int): Total size of the cached videos to stay under.
+            hash_version (int): Hash version of the objects indexed by URL, see app.hashing.
+        """
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self._objects = self.root / "objects"
+        # Version 1 keeps the index of caches written before hashes were versioned
+        self._urls = self.root / ("urls" if hash_version == 1 else f"urls-v{hash_version}")
+        self._tmp = self.root / "tmp"
+        for directory in (self._objects, self._urls, self._tmp):
+            directory.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._bytes = None  # Total size of the objects, counted on first use
+        self.hits = 0
+        self.misses = 0
+        self._remove_stale_tmp()
+
+    def _object_path(self, hashed):
+        """Get the path of the object holding a video."""
+        return self._objects / hashed[:2] / hashed
+
+    def _url_path(self, url):
+        """Get the path of the index entry of a URL."""
+        return self._urls / hashlib.sha256(url.encode()).hexdigest()
+
+    def lookup(self, url):
+        """
+        Find the cached video of a URL.
+
+        Args:
+            url (str): The URL of the video.
+
+        Returns:
+            tuple: (hash, path) of the cached video, or None on a miss.
+        """
+        entry = self._url_path(url)
+        try:
+            target = Path(os.readlink(entry))
+        except OSError:
+            target = None
+        path = self._objects / target.parent.name / target.name if target is not None else None
+        if path is None or not path.exists():
+            if target is not None:
+                self._unlink(entry)  # The object was evicted
+            self._count(MEDIA_CACHE_REQUESTS, "miss")
+            return None
+        try:
+            os.utime(path)  # Mark the object as recently used
+        except OSError:
+            pass
+        self._count(MEDIA_CACHE_REQUESTS, "hit")
+        return path.name, path
+
+    def find(self, hashed):
+        """
+        Find a cached video by its hash, of any version.
+
+        Args:
+            hashed (str): The hash of the video.
+
+        Returns:
+            Path: The path of the cached video, or None if it is not cached.
+        """
+        path = self._object_path(hashed)
+        return path if path.exists() else None
+
+    def writer(self):
+        """
+        Open a temporary file to stream a download into.
+
+        Returns:
+            file: A binary file in the cache's tmp directory; pass it to ``commit`` or ``discard``.
+        """
+        return tempfile.NamedTemporaryFile(dir=self._tmp, delete=False)
+
+    def commit(self, temp_file, hashed, url):
+        """
+        Move a completed download into the cache and index it under its URL.
+
+        Args:
+            temp_file (file): The file returned by ``writer``, fully written.
+            hashed (str): The hash of the video.
+            url (str): The URL the video was downloaded from.
+        """
+        temp_file.close()
+        size = os.path.getsize(temp_file.name)
+        path = self._object_path(hashed)
+        if size > self.max_bytes:
+            self._unlink(Path(temp_file.name))
+            return
+        path.parent.mkdir(exist_ok=True)
+        if path.exists():
+            self._unlink(Path(temp_file.name))  # Same content already cached, e.g. from another URL
+            added = 0
+        else:
+            os.replace(temp_file.name, path)
+            added = size
+        # Point the URL at the object, replacing any older entry atomically
+        link = self._tmp / f"{os.getpid()}-{threading.get_ident()}-{path.name}.link"
+        self._unlink(link)
+        os.symlink(os.path.relpath(path, self._urls), link)
+        os.replace(link, self._url_path(url))
+        with self._lock:
+            if self._bytes is not None:
+                self._bytes += added
+            over_budget = self._bytes is None or self._bytes > self.max_bytes
+        if over_budget:
+            self.evict()
+
+    def discard(self, temp_file):
+        """Drop a download that failed or was abandoned."""
+        temp_file.close()
+        self._unlink(Path(temp_file.name))
+
+    def evict(self):
+        """Delete the least recently used objects until the cache is within its budget."""
+        with self._lock:
+            objects = []
+            for path in self._objects.glob("*/*"):
+                try:
+                    stat = path.stat()
+                except OSError:
+                    continue  # Deleted by another process meanwhile
+                objects.append((stat.st_mtime, stat.st_size, path))
+            total = sum(size for _, size, _ in objects)
+            objects.sort()
+            evicted = 0
+            for _, size, path in objects:
+                if total <= self.max_bytes:
+                    break
+                self._unlink(path)
+                total -= size
+                evicted += 1
+            self._bytes = total
+        if evicted:
+            MEDIA_CACHE_EVICTIONS.inc(evicted)
+            # Drop URL entries whose object is gone
+            for entry in self._urls.iterdir():
+                if not entry.exists():
+                    self._unlink(entry)
+
+    def _remove_stale_tmp(self, max_age=3600):
+        """Delete temporary files left behind by crashed downloads."""
+        cutoff = time.time() - max_age
+        for path in self._tmp.iterdir():
+            try:
+                if path.lstat().st_mtime < cutoff:
+                    path.unlink()
+            except OSError:
+                pass
+
+    def _count(self, counter, result):
+        """Record a lookup result."""
+        counter.inc(result=result)
+        with self._lock:
+            if result == "hit":
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    @staticmethod
+    def _unlink(path):
+        """Delete a file, ignoring files that are already gone."""
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+
+    def size(self):
+        """Get the total size of the cached videos in bytes."""
+        with self._lock:
+            cached = self._bytes
+        if cached is None:
+            self.evict()  # Counts the objects, and trims them if the budget shrank
+            with self._lock:
+                cached = self._bytes
+        return cached
+
+    def stats(self):
+        """
+        Describe the cache.
+
+        Returns:
+            dict: Size, budget, hit and miss counts and hit ratio since startup.
+        """
+        size = self.size()
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "bytes": size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else None,
+            }
+
+# Process-wide cache, created on first use
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_media_cache():
+    """
+    Get the process-wide media cache, configured from the app settings.
+
+    Returns:
+        MediaCache: The cache, or None if MEDIA_CACHE_MAX_BYTES is 0 or its directory cannot be created.
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                settings = get_settings()
+                if settings.MEDIA_CACHE_MAX_BYTES <= 0:
+                    _cache = False
+                else:
+                    try:
+                        _cache = MediaCache(settings.MEDIA_CACHE_DIR, settings.MEDIA_CACHE_MAX_BYTES, settings.HASH_VERSION)
+                    except OSError as e:
+                        logger.warning("Media cache disabled: %s", e)
+                        _cache = False
+    return _cache or None
+
+def media_cache_size():
+    """Get the size of the process-wide media cache, or None if it was not used yet, e.g. for the metrics."""
+    return _cache.size() if _cache else None
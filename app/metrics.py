@@ -0,0 +1,187 @@
+# Import necessary modules for the in-process metrics
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+def _format_labels(names, values, extra=()):
+    """Render a Prometheus label set."""
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    rendered = ",".join(f'{name}="{str(value)}"' for name, value in pairs)
+    return "{" + rendered + "}"
+
+class Counter:
+    """Monotonically increasing counter, optionally split by labels."""
+
+    TYPE = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        """Increase the counter for the given label values."""
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def collect(self):
+        """Yield the exposition lines of the counter."""
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+
+class Histogram:
+    """Cumulative histogram of observed values, optionally split by labels."""
+
+    TYPE = "histogram"
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        """Record a value for the given label values."""
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                # Per-bucket counts (plus +Inf), sum and count
+                series = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Context manager that observes the time spent in its block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def collect(self):
+        """Yield the exposition lines of the histogram."""
+        with self._lock:
+            values = [(key, (list(series[0]), series[1], series[2])) for key, series in self._values.items()]
+        for key, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', le)])} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, key)} {count}"
+
+class Gauge:
+    """Value read from a callback every time the metrics are scraped."""
+
+    TYPE = "gauge"
+
+    def __init__(self, name, documentation, callback):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+
+    def collect(self):
+        """Yield the exposition line of the gauge."""
+        try:
+            value = self.callback()
+        except Exception:
+            return
+        if value is not None:
+            yield f"{self.name} {value}"
+
+class Registry:
+    """Collection of metrics rendered together in the Prometheus text format."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """Add a metric, returning the one already registered under the same name if any."""
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labelnames=()):
+        """Create or get a counter."""
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=Histogram.DEFAULT_BUCKETS):
+        """Create or get a histogram."""
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name, documentation, callback):
+        """Create or replace a callback gauge."""
+        with self._lock:
+            self._metrics[name] = Gauge(name, documentation, callback)
+            return self._metrics[name]
+
+    def render(self):
+        """Render every metric in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.TYPE}")
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+# Process-wide registry and the metrics of the reel pipeline
+registry = Registry()
+
+STAGE_SECONDS = registry.histogram(
+    "reel_stage_seconds", "Time spent in each stage of the reel pipeline.", ["stage"])
+DOWNLOADED_BYTES = registry.counter(
+    "reel_downloaded_bytes_total", "Bytes of video downloaded from the CDN.")
+MEDIA_CACHE_REQUESTS = registry.counter(
+    "reel_media_cache_requests_total", "Media cache lookups by result (hit or miss).", ["result"])
+MEDIA_CACHE_EVICTIONS = registry.counter(
+    "reel_media_cache_evictions_total", "Videos evicted from the media cache to stay within its budget.")
+DOWNLOAD_RESUMES = registry.counter(
+    "reel_download_resumes_total", "Interrupted byte ranges resumed from the last byte received.")
+DEDUP_CHECKS = registry.counter(
+    "reel_dedup_checks_total", "Duplicate checks by result (exact, legacy, near or miss).", ["result"])
+JOBS = registry.counter(
+    "reel_jobs_total", "Jobs that reached a status.", ["status"])
+CONTAINER_POLLS = registry.counter(
+    "reel_container_polls_total", "Media container status checks.")
+CONTAINER_WAIT_SECONDS = registry.histogram(
+    "reel_container_wait_seconds", "Time from container creation until it finished processing.")
+GRAPH_RESPONSES = registry.counter(
+    "graph_api_responses_total", "Graph API responses by endpoint and HTTP status code.", ["endpoint", "status"])
+WEBHOOK_SECONDS = registry.histogram(
+    "webhook_request_seconds", "Time to acknowledge a webhook delivery.")
+WEBHOOK_REELS = registry.counter(
+    "webhook_reels_total", "Reel attachments received through the webhook.")
+WEBHOOK_REDELIVERIES = registry.counter(
+    "webhook_redeliveries_total", "Reel attachments dropped because their webhook delivery was already queued.")
+LOG_RECORDS_DROPPED = registry.counter(
+    "log_records_dropped_total", "Log records dropped because the logging queue was full.")
+PROFILES_WRITTEN = registry.counter(
+    "profiles_written_total", "Profiles written, by what was profiled (webhook or job).", ["kind"])
+HASH_MIGRATIONS = registry.counter(
+    "reel_hash_migrations_total", "Posts moved to the current hash version, by how (repeat or rehash).", ["source"])
+BACKFILL_MEDIA = registry.counter(
+    "reel_backfill_media_total", "Media processed by the backfill, by result (added, duplicate, known, skipped or failed).", ["result"])
+HASH_FILTER_LOOKUPS = registry.counter(
+    "reel_hash_filter_lookups_total", "Known-hash filter lookups by result (hit, miss or maybe).", ["result"])
+COLLECTION_REQUESTS = registry.counter(
+    "collection_page_requests_total", "Collection page requests by response cache result (hit or miss).", ["result"])
+WEBHOOK_ADMISSIONS = registry.counter(
+    "webhook_admissions_total", "Admission decisions for incoming reels (queued, deferred or dropped) by reason.", ["decision", "reason"])
@@ -1,7 +1,17 @@
 # Import necessary functions and modules from SQLAlchemy and the app package
-from sqlalchemy.sql import func
+from datetime import datetime, timezone
+from sqlalchemy.sql import false, func, true
 from app import db
 
+def utcnow():
+    """
+    Get the current UTC time as a naive datetime, matching how timestamps are stored.
+    
+    Returns:
+        datetime: The current UTC time without timezone information.
+    """
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
 class Post(db.Model):
     """
     Post model representing a post in the database.
@@ -10,15 +20,27 @@ class Post(db.Model):
         id (int): Primary key, unique identifier for the post.
         caption (str): Caption for the post, up to 2083 characters.
         hashed (str): Unique hash identifier for the post.
+        hash_version (int): Version of the hash algorithm ``hashed`` was computed with, see app.hashing.
+        fingerprint (str): Perceptual fingerprint of the video as 16 hex characters, if it could be computed.
+        media_id (str): ID of the published Instagram media; None while the hash is only claimed.
+        job_id (int): ID of the job that claimed the hash, if any.
         created_at (datetime): Timestamp when the post was created.
+        published_at (datetime): Timestamp when the post was published, if it has been.
     """
     __tablename__ = 'post'
+    # Backs the keyset pagination of the collection API, newest first
+    __table_args__ = (db.Index("ix_post_created_at_id", "created_at", "id"),)
     
     # Define columns for the Post model
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)  # Auto-incrementing primary key
     caption = db.Column(db.String(2083), nullable=False)  # Caption column with a maximum length of 2083 characters, cannot be null
     hashed = db.Column(db.String(64), nullable=False, unique=True, index=True)  # Unique hash identifier, indexed for faster queries, cannot be null
+    hash_version = db.Column(db.Integer, nullable=False, default=1, server_default="1")  # Hash algorithm of the row, rows from before versioning are SHA-256
+    fingerprint = db.Column(db.String(16), nullable=True)  # Perceptual fingerprint used to catch re-encoded copies
+    media_id = db.Column(db.String(64), nullable=True)  # Published media ID, empty while the post is being published
+    job_id = db.Column(db.Integer, nullable=True)  # Job that claimed the hash, so its retries can reuse the claim
     created_at = db.Column(db.DateTime, server_default=func.now())  # Timestamp for creation, defaults to current time
+    published_at = db.Column(db.DateTime, nullable=True)  # Timestamp of publishing, used as the Last-Modified time of the collection
     
     def __repr__(self):
         """
@@ -36,9 +58,211 @@ class User(db.Model):
     Attributes:
         id (int): Primary key, unique identifier for the user.
         instagram_id (str): Unique Instagram ID for the user.
+        priority (int): Scheduling priority of the user's reels; higher runs first and is exempt from intake shedding when above 0.
+        rate_limit (float): Reels per hour the user may send, overriding SENDER_RATE_LIMIT if set.
+        burst (int): Reels the user may send at once, overriding SENDER_BURST if set.
+        next_slot (datetime): Theoretical arrival time of the user's next reel under their rate limit.
     """
     __tablename__ = "user"
     
     # Define columns for the User model
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)  # Auto-incrementing primary key
     instagram_id = db.Column(db.String(64), nullable=False, unique=True)  # Unique Instagram ID, cannot be null
+    priority = db.Column(db.Integer, nullable=False, default=0, server_default="0")  # Scheduling priority, 0 for regular senders
+    rate_limit = db.Column(db.Float, nullable=True)  # Per-user rate limit in reels per hour, None for the default
+    burst = db.Column(db.Integer, nullable=True)  # Per-user burst size, None for the default
+    next_slot = db.Column(db.DateTime, nullable=True)  # Rate limiter state, advanced as reels are admitted
+
+class Account(db.Model):
+    """
+    Account model representing an Instagram account the app publishes to.
+    
+    Attributes:
+        id (int): Primary key, unique identifier for the account.
+        name (str): Unique short name of the account, used in logs, metrics and commands.
+        page_id (str): ID of the Facebook Page linked to the account.
+        instagram_id (str): Instagram Business Account ID; webhooks sent to it are routed to this account.
+        access_token (str): Page access token used for the account's Graph API calls.
+        worker_threads (int): Number of worker threads of the account, overriding ACCOUNT_WORKER_THREADS if set.
+        active (bool): Whether webhooks are routed to the account and its jobs are processed.
+        created_at (datetime): Timestamp when the account was added.
+    """
+    __tablename__ = "account"
+    
+    # Define columns for the Account model
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)  # Auto-incrementing primary key
+    name = db.Column(db.String(64), nullable=False, unique=True)  # Short name of the account
+    page_id = db.Column(db.String(64), nullable=False, unique=True)  # Facebook Page ID
+    instagram_id = db.Column(db.String(64), nullable=True, unique=True)  # Business account ID, resolved once and stored
+    access_token = db.Column(db.String(1024), nullable=False)  # Page access token
+    worker_threads = db.Column(db.Integer, nullable=True)  # Size of the account's worker pool, None for the default
+    active = db.Column(db.Boolean, nullable=False, default=True, server_default=true())  # Inactive accounts get no webhooks and no workers
+    created_at = db.Column(db.DateTime, default=utcnow)  # Timestamp for creation
+    
+    def __repr__(self):
+        """
+        Representation method for the Account model.
+        
+        Returns:
+            str: A string representation of the Account object.
+        """
+        return f'<Account {self.name}>'
+
+class Job(db.Model):
+    """
+    Job model representing a queued reel waiting to be processed by a worker.
+    
+    Attributes:
+        id (int): Primary key, unique identifier for the job.
+        url (str): URL of the reel video to download and publish.
+        caption (str): Caption (title) of the reel.
+        sender_id (str): Instagram ID of the user who sent the reel.
+        account_id (int): ID of the account the reel is published to, or None for the account configured in the settings.
+        status (str): Current state of the job (pending, running, publishing, done, duplicate, failed or dropped).
+        attempts (int): Number of times a worker has picked up the job.
+        hashed (str): Hash of the downloaded video, once computed.
+        container_id (str): ID of the media container waiting to be published, once created.
+        fingerprint (str): Perceptual fingerprint of the video, once computed.
+        error (str): Last error message recorded for the job.
+        delivery_key (str): Webhook message ID, timestamp and attachment index the job was queued from, if known.
+        priority (int): Priority of the sender when the job was queued; higher is claimed first.
+        run_after (datetime): Earliest time the job may be claimed, later than its creation when the sender was over their rate.
+        virtual_time (datetime): The sender's fair-share slot for the job; ready jobs are claimed in this order.
+        shed_reason (str): Why the job was deferred or dropped by admission control, if it was.
+        lease_token (int): Fencing token of the lease the job was last claimed under; writes under an older one are rejected.
+        profile (bool): Whether the job's processing is profiled, set for reels of a signed profiling request.
+        created_at (datetime): Timestamp when the job was queued.
+        updated_at (datetime): Timestamp of the last state change.
+    """
+    __tablename__ = "job"
+    
+    # Possible values of the status column
+    PENDING = "pending"
+    RUNNING = "running"
+    PUBLISHING = "publishing"
+    DONE = "done"
+    DUPLICATE = "duplicate"
+    FAILED = "failed"
+    DROPPED = "dropped"
+    
+    # Fencing token this process claimed the job under; a plain attribute, so unlike
+    # lease_token it is not reloaded with another process's token after a commit
+    held_token = None
+    
+    # Define columns for the Job model
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)  # Auto-incrementing primary key
+    url = db.Column(db.String(2083), nullable=False, index=True)  # URL of the reel video, indexed so jobs deferred on the same video find its claim
+    caption = db.Column(db.String(2083), nullable=False, default="")  # Caption of the reel, defaults to an empty string
+    sender_id = db.Column(db.String(64), nullable=True)  # Instagram ID of the sender
+    account_id = db.Column(db.Integer, db.ForeignKey("account.id"), nullable=True, index=True)  # Account the reel is published to
+    status = db.Column(db.String(16), nullable=False, default=PENDING, index=True)  # Job state, indexed so workers can find pending jobs quickly
+    attempts = db.Column(db.Integer, nullable=False, default=0)  # Number of processing attempts
+    hashed = db.Column(db.String(64), nullable=True)  # Hash of the video, filled in by the worker
+    container_id = db.Column(db.String(64), nullable=True)  # Media container ID, filled in once the upload is created
+    fingerprint = db.Column(db.String(16), nullable=True)  # Perceptual fingerprint, filled in by the worker
+    error = db.Column(db.String(2083), nullable=True)  # Last error message, if any
+    delivery_key = db.Column(db.String(255), nullable=True, unique=True)  # Webhook delivery the job came from, unique so redeliveries are not queued twice
+    priority = db.Column(db.Integer, nullable=False, default=0, server_default="0")  # Sender priority at queueing time
+    run_after = db.Column(db.DateTime, nullable=True)  # Not claimed before this time
+    virtual_time = db.Column(db.DateTime, nullable=True)  # Claim order among ready jobs, fair across senders
+    shed_reason = db.Column(db.String(32), nullable=True)  # Admission control decision, if the job was deferred or dropped
+    lease_token = db.Column(db.Integer, nullable=True)  # Fencing token of the current claim, see app.leases
+    profile = db.Column(db.Boolean, nullable=False, default=False, server_default=false())  # Profile the processing, see app.profiling
+    created_at = db.Column(db.DateTime, default=utcnow)  # Timestamp for creation
+    updated_at = db.Column(db.DateTime, default=utcnow, onupdate=utcnow)  # Timestamp of the last update
+    
+    def __repr__(self):
+        """
+        Representation method for the Job model.
+        
+        Returns:
+            str: A string representation of the Job object.
+        """
+        return f'<Job {self.id} {self.status}>'
+
+class Lease(db.Model):
+    """
+    Lease model representing a piece of work held by one process until it expires.
+    
+    Attributes:
+        name (str): What the lease covers, e.g. ``job:42`` or ``video:<digest of the URL>``.
+        owner (str): Host name, process ID and random suffix of the process holding the lease.
+        token (int): Fencing token, increased every time the lease changes hands.
+        expires_at (datetime): When the lease lapses unless its holder renews it.
+    """
+    __tablename__ = "lease"
+    
+    # Define columns for the Lease model
+    name = db.Column(db.String(255), primary_key=True)  # Name of the leased work, unique
+    owner = db.Column(db.String(128), nullable=False)  # Process holding the lease
+    token = db.Column(db.Integer, nullable=False, default=1)  # Fencing token, only ever increases
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)  # Expiry, pushed back by heartbeats
+    
+    def __repr__(self):
+        """
+        Representation method for the Lease model.
+        
+        Returns:
+            str: A string representation of the Lease object.
+        """
+        return f'<Lease {self.name} {self.token}>'
+
+class Backfill(db.Model):
+    """
+    Backfill model representing the progress of seeding the post table from an account's existing media.
+    
+    Attributes:
+        account (str): Name of the account, ``default`` for the account from the settings.
+        cursor (str): Graph API paging cursor of the next page of media to process, None to start from the newest media.
+        media_seen (int): Media listed so far in the current run.
+        posts_added (int): Posts stored so far in the current run.
+        failed (int): Videos that could not be downloaded in the current run; they are retried by the next run.
+        started_at (datetime): Timestamp when the current run started.
+        updated_at (datetime): Timestamp of the last checkpoint.
+        finished_at (datetime): Timestamp when the run reached the oldest media, None while it is unfinished.
+    """
+    __tablename__ = "backfill"
+    
+    # Define columns for the Backfill model
+    account = db.Column(db.String(64), primary_key=True)  # Account the progress belongs to
+    cursor = db.Column(db.String(1024), nullable=True)  # Where an interrupted run resumes
+    media_seen = db.Column(db.Integer, nullable=False, default=0)  # Progress counters of the current run
+    posts_added = db.Column(db.Integer, nullable=False, default=0)
+    failed = db.Column(db.Integer, nullable=False, default=0)
+    started_at = db.Column(db.DateTime, default=utcnow)  # Timestamp the run started
+    updated_at = db.Column(db.DateTime, default=utcnow, onupdate=utcnow)  # Timestamp of the last checkpoint
+    finished_at = db.Column(db.DateTime, nullable=True)  # Set once every page was processed
+    
+    def __repr__(self):
+        """
+        Representation method for the Backfill model.
+        
+        Returns:
+            str: A string representation of the Backfill object.
+        """
+        return f'<Backfill {self.account}>'
+
+class PublishSlot(db.Model):
+    """
+    PublishSlot model holding the publishing quota of an account, shared by every process that publishes to it.
+    
+    Attributes:
+        account (str): Key of the account, ``default`` for the account from the settings.
+        next_slot (datetime): Theoretical time of the account's next publish; each publish moves it one
+            ``window / limit`` interval forward, and publishing is allowed while it is less than the
+            bucket's capacity in intervals ahead of now.
+    """
+    __tablename__ = "publish_slot"
+    
+    # Define columns for the PublishSlot model
+    account = db.Column(db.String(64), primary_key=True)  # Account the quota belongs to
+    next_slot = db.Column(db.DateTime, nullable=False)  # Moved forward with a compare-and-set by each publish
+    
+    def __repr__(self):
+        """
+        Representation method for the PublishSlot model.
+        
+        Returns:
+            str: A string representation of the PublishSlot object.
+        """
+        return f'<PublishSlot {self.account} {self.next_slot}>'
@@ -0,0 +1,195 @@
+# Import necessary modules for on-demand profiling
+import cProfile
+import hashlib
+import hmac
+import io
+import logging
+import os
+import pstats
+import random
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+import click
+from app.config import get_settings
+from app.metrics import PROFILES_WRITTEN
+
+logger = logging.getLogger("LOLify.profiling")
+
+# Header carrying a signed profiling request, see ``sign_profile_request``
+PROFILE_HEADER = "X-Profile"
+
+# Names of the profile files: time, what was profiled and a random suffix
+_PROFILE_NAME = re.compile(r"^\d{8}T\d{6}-[a-z0-9_.-]+-[0-9a-f]{8}\.prof$")
+
+# Serializes file rotation between threads
+_rotate_lock = threading.Lock()
+
+def sign_profile_request(timestamp=None):
+    """
+    Build the value of a signed profiling header.
+
+    The signature is an HMAC of the time it was made with SECRET_KEY, so only holders of the
+    key can switch profiling on, and a captured header stops working after PROFILE_SIGNATURE_TTL.
+
+    Args:
+        timestamp (int): Unix time of the signature (defaults to now).
+
+    Returns:
+        str: ``<timestamp>.<signature>``, or None if SECRET_KEY is not set.
+    """
+    key = get_settings().SECRET_KEY
+    if not key:
+        return None
+    timestamp = int(time.time() if timestamp is None else timestamp)
+    signature = hmac.new(key.encode(), f"profile:{timestamp}".encode(), hashlib.sha256).hexdigest()
+    return f"{timestamp}.{signature}"
+
+def verify_profile_request(value):
+    """
+    Check a signed profiling header.
+
+    Args:
+        value (str): The header value, or None if the header is missing.
+
+    Returns:
+        bool: True if it was signed with SECRET_KEY no longer than PROFILE_SIGNATURE_TTL seconds ago.
+    """
+    if not value or "." not in value:
+        return False
+    timestamp, _, _ = value.partition(".")
+    try:
+        age = time.time() - int(timestamp)
+    except ValueError:
+        return False
+    if not -60 <= age <= get_settings().PROFILE_SIGNATURE_TTL:  # Allow for some clock skew
+        return False
+    expected = sign_profile_request(int(timestamp))
+    return expected is not None and hmac.compare_digest(expected, value)
+
+def should_profile(forced=False):
+    """Decide whether to profile a unit of work: always if forced, otherwise for PROFILE_SAMPLE_RATE of them."""
+    rate = get_settings().PROFILE_SAMPLE_RATE
+    return forced or (rate > 0 and random.random() < rate)
+
+def profile_dir():
+    """Get the directory the profiles are written to."""
+    return Path(get_settings().PROFILE_DIR)
+
+@contextmanager
+def profiled(label, forced=False):
+    """
+    Profile the enclosed block on the calling thread, if it is sampled.
+
+    Every function call is recorded with cProfile against the wall clock, so time spent
+    waiting on the CDN, the Graph API or the database shows up under the call that waited
+    (``get_hashes_from_video``, the ``InstagramAPI`` methods, SQLAlchemy's ``execute``).
+    The profile is written to PROFILE_DIR, keeping the newest PROFILE_MAX_FILES files.
+
+    Args:
+        label (str): What is profiled, e.g. ``webhook`` or ``job-42``; part of the file name.
+        forced (bool): Profile regardless of PROFILE_SAMPLE_RATE, e.g. for a signed request.
+
+    Yields:
+        bool: True if the block is profiled.
+    """
+    if not should_profile(forced):
+        yield False
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as e:
+        # Newer Pythons allow a single active profiler per process
+        logger.info("Not profiling %s: %s", label, e)
+        yield False
+        return
+    try:
+        yield True
+    finally:
+        profiler.disable()
+        try:
+            write_profile(profiler, label)
+        except OSError as e:
+            logger.warning("Failed to write the profile of %s: %s", label, e)
+
+def write_profile(profiler, label):
+    """
+    Write a profile to PROFILE_DIR and delete the oldest ones beyond PROFILE_MAX_FILES.
+
+    Returns:
+        Path: The path of the profile file.
+    """
+    directory = profile_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    label = re.sub(r"[^a-z0-9_.-]+", "_", label.lower())[:64]
+    name = f"{time.strftime('%Y%m%dT%H%M%S', time.gmtime())}-{label}-{uuid.uuid4().hex[:8]}.prof"
+    temp_path = directory / f".{name}.tmp"
+    profiler.dump_stats(str(temp_path))
+    os.replace(temp_path, directory / name)  # Listed only once complete
+    PROFILES_WRITTEN.inc(kind=label.split("-", 1)[0])
+    logger.info("Wrote profile %s", name)
+    rotate_profiles(get_settings().PROFILE_MAX_FILES)
+    return directory / name
+
+def rotate_profiles(max_files):
+    """Delete the oldest profiles beyond ``max_files``."""
+    with _rotate_lock:
+        for path in list_profiles()[max_files:]:
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass  # Rotated by another process meanwhile
+
+def list_profiles():
+    """
+    Get the profile files, newest first.
+
+    Returns:
+        list[Path]: The paths of the profiles.
+    """
+    directory = profile_dir()
+    if not directory.is_dir():
+        return []
+    # The names start with the time they were written at
+    return sorted((path for path in directory.iterdir() if _PROFILE_NAME.match(path.name)), key=lambda path: path.name, reverse=True)
+
+def find_profile(name):
+    """
+    Get the path of a profile by its file name.
+
+    Returns:
+        Path: The path of the profile, or None if there is no such profile.
+    """
+    if not _PROFILE_NAME.match(name):
+        return None  # Also rules out paths outside PROFILE_DIR
+    path = profile_dir() / name
+    return path if path.is_file() else None
+
+def render_profile(path, sort="cumulative", limit=40):
+    """
+    Render the hottest functions of a profile as text.
+
+    Args:
+        path (Path): The path of the profile.
+        sort (str): The pstats sort key, e.g. ``cumulative`` or ``tottime``.
+        limit (int): Number of functions shown.
+
+    Returns:
+        str: The pstats report.
+    """
+    output = io.StringIO()
+    stats = pstats.Stats(str(path), stream=output)
+    stats.strip_dirs().sort_stats(sort).print_stats(limit)
+    return output.getvalue()
+
+@click.command("profile-token")
+def profile_token_command():
+    """Print a signed value for the X-Profile header, valid for PROFILE_SIGNATURE_TTL seconds."""
+    value = sign_profile_request()
+    if value is None:
+        raise click.ClickException("SECRET_KEY is not set")
+    click.echo(value)
@@ -0,0 +1,214 @@
+# Import necessary modules for the publishing quota
+import logging
+import threading
+import time
+from datetime import timedelta
+
+logger = logging.getLogger("LOLify.quota")
+
+# How many times the shared quota is re-read when another process publishes concurrently
+_SLOT_RETRIES = 3
+
+class PublishLimitReached(Exception):
+    """Raised when the Graph API rejects a publish because the publishing limit is used up."""
+
+class PublishQuota:
+    """
+    Token bucket tracking the Instagram content publishing limit.
+
+    The bucket holds one token per post we may still publish and refills at
+    ``limit / window`` tokens per second, which spreads publishes evenly over the
+    rolling window once the limit is reached. It is re-seeded from the Graph API's
+    ``content_publishing_limit`` response, which is authoritative.
+    """
+
+    def __init__(self, limit=50, window=86400, reserve=0):
+        """
+        Initialize the quota.
+
+        Args:
+            limit (int): Number of posts allowed per window, until the Graph API reports its own value.
+            window (int): Length of the rolling window in seconds.
+            reserve (int): Number of posts kept back from automatic publishing.
+
+        Raises:
+            ValueError: If the reserve leaves no posts to publish, which would hold every post forever.
+        """
+        if reserve >= limit:
+            raise ValueError(f"The publishing reserve ({reserve}) must be lower than the limit ({limit})")
+        self._lock = threading.Lock()
+        self._limit = limit
+        self._window = window
+        self._reserve = reserve
+        self._tokens = float(limit - reserve)
+        self._updated_at = time.monotonic()
+        self._synced_at = None
+
+    def _refill(self, now):
+        """Add the tokens earned since the last update."""
+        capacity = self._limit - self._reserve
+        rate = self._limit / self._window
+        self._tokens = min(capacity, self._tokens + (now - self._updated_at) * rate)
+        self._updated_at = now
+
+    def sync(self, quota_usage, quota_total=None, quota_duration=None):
+        """
+        Re-seed the bucket from the Graph API.
+
+        Args:
+            quota_usage (int): Number of posts published in the current window.
+            quota_total (int): Number of posts allowed per window, if reported.
+            quota_duration (int): Length of the window in seconds, if reported.
+        """
+        with self._lock:
+            if quota_total:
+                if quota_total <= self._reserve:
+                    logger.warning("The publishing limit of %s is not above the reserve of %s, publishing 1 post per window",
+                                   quota_total, self._reserve)
+                self._limit = max(quota_total, self._reserve + 1)
+            if quota_duration:
+                self._window = quota_duration
+            self._tokens = float(max(0, self._limit - self._reserve - quota_usage))
+            self._updated_at = self._synced_at = time.monotonic()
+
+    def sync_failed(self):
+        """Record a failed refresh so it is not retried before the next refresh interval."""
+        with self._lock:
+            self._synced_at = time.monotonic()
+
+    def synced_since(self, seconds):
+        """Check whether the bucket was seeded from the Graph API within the last ``seconds``."""
+        with self._lock:
+            return self._synced_at is not None and time.monotonic() - self._synced_at < seconds
+
+    def acquire(self):
+        """
+        Take a token if one is available.
+
+        Returns:
+            float: 0 if a post may be published now, otherwise the seconds until the next token.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) * self._window / self._limit
+
+    def exhaust(self):
+        """Empty the bucket, e.g. after the Graph API rejected a publish for exceeding the limit."""
+        with self._lock:
+            self._tokens = 0.0
+            self._updated_at = time.monotonic()
+
+    def projected_delays(self, count):
+        """
+        Project when the next ``count`` queued posts will be allowed to publish.
+
+        Args:
+            count (int): Number of queued posts.
+
+        Returns:
+            list[float]: Seconds from now until each post gets a token, in queue order.
+        """
+        tokens = self._available()
+        with self._lock:
+            interval = self._window / self._limit
+            delays = []
+            for _ in range(count):
+                delays.append(0.0 if tokens >= 1 else (1 - tokens) * interval)
+                tokens -= 1
+            return delays
+
+    def _available(self):
+        """Get the number of tokens in the bucket now."""
+        with self._lock:
+            self._refill(time.monotonic())
+            return self._tokens
+
+    def snapshot(self):
+        """Get the current state of the bucket."""
+        tokens = self._available()
+        with self._lock:
+            return {"tokens": round(tokens, 2), "limit": self._limit, "window": self._window, "reserve": self._reserve}
+
+class SharedPublishQuota(PublishQuota):
+    """
+    Publishing quota of one account, shared by every process and node that publishes to it.
+
+    A bucket per process would start full in each of them, so N processes could publish N
+    times the limit before their next refresh from the Graph API. Here the bucket is the
+    account's row in the ``publish_slot`` table, kept as a generic cell rate algorithm like the
+    senders' rate limits: each publish moves ``next_slot`` one ``window / limit`` interval
+    forward with a compare-and-set, and a post may be published while the slot is less than
+    ``limit - reserve`` intervals ahead of the database's clock. Limit, window and reserve stay
+    in the process and are re-seeded from the Graph API as before.
+    """
+
+    def __init__(self, app, account, limit=50, window=86400, reserve=0):
+        """
+        Initialize the quota.
+
+        Args:
+            app (Flask): The application whose database holds the quota.
+            account (str): The key of the account.
+            limit (int): Number of posts allowed per window, until the Graph API reports its own value.
+            window (int): Length of the rolling window in seconds.
+            reserve (int): Number of posts kept back from automatic publishing.
+        """
+        super().__init__(limit, window, reserve)
+        self._app = app
+        self._account = account
+
+    def _schedule(self):
+        """Get the interval between two publishes and the bucket's capacity."""
+        with self._lock:
+            return self._window / self._limit, self._limit - self._reserve
+
+    def sync(self, quota_usage, quota_total=None, quota_duration=None):
+        """Re-seed the shared bucket from the Graph API (see ``PublishQuota.sync``)."""
+        # Imported here as the models need the app package to be initialized
+        from app.crud import set_publish_slot
+        super().sync(quota_usage, quota_total, quota_duration)
+        interval, capacity = self._schedule()
+        with self._app.app_context():
+            set_publish_slot(self._account, min(quota_usage, capacity) * interval)
+
+    def acquire(self):
+        """
+        Take a token from the shared bucket if one is available.
+
+        Returns:
+            float: 0 if a post may be published now, otherwise the seconds until the next token.
+        """
+        from app.crud import advance_publish_slot, get_publish_slot
+        interval, capacity = self._schedule()
+        with self._app.app_context():
+            for attempt in range(_SLOT_RETRIES):
+                next_slot, now = get_publish_slot(self._account)
+                slot = max(next_slot or now, now)
+                wait = (slot - now).total_seconds() - (capacity - 1) * interval
+                if wait > 0:
+                    return wait
+                if advance_publish_slot(self._account, next_slot, slot + timedelta(seconds=interval)):
+                    return 0.0
+        # Still contended: other processes are publishing, try again once they are done
+        return min(interval, 1.0)
+
+    def exhaust(self):
+        """Empty the shared bucket, e.g. after the Graph API rejected a publish for exceeding the limit."""
+        from app.crud import set_publish_slot
+        super().exhaust()
+        interval, capacity = self._schedule()
+        with self._app.app_context():
+            set_publish_slot(self._account, capacity * interval)
+
+    def _available(self):
+        """Get the number of tokens in the shared bucket now."""
+        from app.crud import get_publish_slot
+        interval, capacity = self._schedule()
+        with self._app.app_context():
+            next_slot, now = get_publish_slot(self._account)
+        ahead = max(0.0, (next_slot - now).total_seconds()) if next_slot else 0.0
+        return capacity - ahead / interval
@@ -1,18 +1,57 @@
-# Import necessary modules and functions from Flask, dotenv, pathlib, os, and custom modules
-from flask import request, Blueprint, render_template
-from dotenv import load_dotenv
-from pathlib import Path
-import os
-from app.crud import create_post, get_post_by_hashed
-from app.core import get_hash_from_video, InstagramAPI
-
-# Load environment variables from the .env file
-BASE_DIR = Path(__file__).resolve().parent
-load_dotenv(BASE_DIR / ".env")
+# Import necessary modules and functions from Flask and custom modules
+from flask import request, Blueprint, render_template, jsonify, Response, current_app, send_file
+from app.accounts import route_recipient
+from app.admission import admit_reels, settle_reels, DROPPED
+from app.cache import TTLCache
+from app.config import get_settings
+from app.collection import get_collection_page, get_collection_post
+from app.worker import enqueue_jobs
+from app.scheduler import get_scheduler, get_schedulers, DEFAULT_SCHEDULER
+from app.metrics import registry, WEBHOOK_SECONDS, WEBHOOK_REELS, WEBHOOK_REDELIVERIES
+from app.profiling import PROFILE_HEADER, profiled, verify_profile_request, list_profiles, find_profile, render_profile
 
 # Initialize a Blueprint for the main routes
 main = Blueprint('main', __name__)
 
+settings = get_settings()
+
+# Webhook deliveries queued recently, so redeliveries are dropped before any download. Past the
+# size limit the oldest are forgotten early; their redeliveries are still dropped by the job's unique key.
+delivery_cache = TTLCache(settings.DELIVERY_DEDUP_TTL, max_entries=settings.DELIVERY_DEDUP_SIZE)
+
+def iter_webhook_attachments(data):
+    """
+    Walk every attachment of every messaging event in a webhook payload.
+    
+    Args:
+        data (dict): The parsed webhook payload.
+    
+    Yields:
+        tuple: (item, attachment) where item describes the attachment's position, sender, recipient and
+        delivery key (None when the event has no message ID), and attachment is the raw attachment dict.
+    """
+    for entry_index, entry in enumerate(data.get("entry") or []):
+        for message_index, message_instance in enumerate(entry.get("messaging") or []):
+            message = message_instance.get("message") or {}
+            if message.get("is_echo"):
+                continue  # Skip messages sent by our own account
+            sender_id = (message_instance.get("sender") or {}).get("id")  # Extract the sender ID
+            # The account the message was sent to, which routes the reel to the account's queue
+            recipient_id = (message_instance.get("recipient") or {}).get("id") or entry.get("id")
+            # Meta redelivers the same message ID and timestamp when we are slow to acknowledge
+            mid = message.get("mid")
+            timestamp = message_instance.get("timestamp")
+            for attachment_index, attachment in enumerate(message.get("attachments") or []):
+                item = {
+                    "entry": entry_index,
+                    "message": message_index,
+                    "attachment": attachment_index,
+                    "sender_id": sender_id,
+                    "recipient_id": recipient_id,
+                    "delivery_key": f"{mid}:{timestamp}:{attachment_index}" if mid else None,
+                }
+                yield item, attachment
+
 # Define the home route
 @main.route("/", methods=["GET"])
 def home():
@@ -30,10 +69,11 @@ def webhook():
     """
     Webhook route to handle GET and POST requests.
     
-    Handles subscription verification and processes received messages.
+    Handles subscription verification and queues every reel in a batch of received messages.
+    A request with a signed X-Profile header is profiled, and so is the processing of its reels.
     
     Returns:
-        str: A challenge token for GET requests or a simple response for POST requests.
+        str: A challenge token for GET requests, or a JSON summary with one result per attachment for POST requests.
         int: HTTP status code (200 for successful verification, 403 for forbidden access).
     """
     if request.method == 'GET':
@@ -44,46 +84,224 @@ def webhook():
         
         # Verify the subscription mode and token
         if mode and token:
-            if mode == "subscribe" and token == os.getenv("VERIFY_TOKEN"):
+            if mode == "subscribe" and token == current_app.config["VERIFY_TOKEN"]:
                 return challenge, 200  # Return the challenge token if verification is successful
             return "", 403  # Return 403 Forbidden if verification fails
 
     elif request.method == 'POST':
         # Handle POST request to process incoming messages
-        data = request.get_json()  # Parse the JSON payload from the request
-        message_instance = data["entry"][0]["messaging"][0]  # Extract the message instance
-        sender_id = message_instance["sender"]["id"]  # Extract the sender ID
-        attachments = message_instance["message"].get("attachments")  # Extract message attachments if any
-        text = message_instance["message"].get("text")  # Extract text message if any
-
-        if attachments:
-            # Process each attachment in the message
-            for attachment in attachments:
-                if attachment["type"] != "ig_reel":
-                    continue  # Skip non-reel attachments
-                
-                title = attachment["payload"]["title"]  # Extract the title of the reel
-                url = attachment["payload"]["url"]  # Extract the URL of the reel
-                hashed = get_hash_from_video(url)  # Generate a hash from the video URL
-                
-                # Check if the post already exists in the database
-                if get_post_by_hashed(hashed):
-                    return "Already Exists"  
-                else:
-                    with InstagramAPI() as iapi:
-                        # Make a post to Instagram using the API
-                        iapi.make_post(url, caption=title, media_type="REELS")
-                        # Create a new post entry in the database
-                        create_post(caption=title, hashed=hashed)
-                        return "Successful"
-
-        # Add additional processing logic here if needed
-    """
-        Further Will be Done
+        profile = verify_profile_request(request.headers.get(PROFILE_HEADER))
+        with WEBHOOK_SECONDS.time(), profiled("webhook", forced=profile):
+            return queue_webhook_reels(request.get_json(silent=True) or {}, profile=profile)
     
-    """
     return "Hi"
 
+def queue_webhook_reels(data, profile=False):
+    """
+    Queue every reel attachment of a webhook payload.
+    
+    Attachments whose delivery was already queued are reported as redelivered and dropped,
+    first from the in-process delivery cache and otherwise by the unique delivery key of the job.
+    Each reel is routed to the account it was sent to, and reported as unrouted if no account can publish it.
+    The remaining reels go through admission control: each one is queued, deferred until its
+    sender's rate allows it, or dropped with a reason, and the delivery is acknowledged either way.
+    
+    Args:
+        data (dict): The parsed webhook payload.
+        profile (bool): Whether the processing of the queued reels is profiled.
+    
+    Returns:
+        Response: JSON summary with one result per attachment.
+    """
+    results = []  # Per-attachment summary returned to the caller
+    reels = []  # Reels to queue, in the same order as their results
+    ttl = current_app.config["DELIVERY_DEDUP_TTL"]
+    
+    # Collect every reel attachment across all entries and messaging events
+    for item, attachment in iter_webhook_attachments(data):
+        results.append(item)
+        if attachment.get("type") != "ig_reel":
+            item["status"] = "skipped"  # Skip non-reel attachments
+            continue
+        payload = attachment.get("payload") or {}
+        if not payload.get("url"):
+            item["status"] = "invalid"
+            continue
+        account = route_recipient(item["recipient_id"])
+        if account is None:
+            item["status"] = "unrouted"  # Sent to an account this deployment does not serve
+            continue
+        if item["delivery_key"] and not delivery_cache.add(item["delivery_key"], True, ttl):
+            item["status"] = "redelivered"  # Already queued by this process
+            WEBHOOK_REDELIVERIES.inc()
+            continue
+        item["status"] = "queued"
+        reels.append((item, {
+            "url": payload["url"],  # Extract the URL of the reel
+            "caption": payload.get("title"),  # Extract the title of the reel
+            "sender_id": item["sender_id"],
+            "delivery_key": item["delivery_key"],
+            "account_id": account.account_id,
+            "profile": profile,
+        }))
+    
+    # Queue all reels in one transaction; the worker pool processes them in parallel
+    try:
+        decisions = admit_reels([reel for _, reel in reels])
+        jobs = enqueue_jobs([reel for _, reel in reels])
+        settle_reels([reel for _, reel in reels], decisions, jobs)
+    except Exception:
+        # Forget the deliveries so Meta's redelivery of this batch is not dropped
+        for item, _ in reels:
+            if item["delivery_key"]:
+                delivery_cache.invalidate(item["delivery_key"])
+        raise
+    queued = 0
+    for (item, reel), job, decision in zip(reels, jobs, decisions):
+        if job is None:
+            item["status"] = "redelivered"  # Already queued by another process
+            WEBHOOK_REDELIVERIES.inc()
+            continue
+        item["job_id"] = job.id
+        item["status"] = decision
+        if reel["shed_reason"]:
+            item["reason"] = reel["shed_reason"]
+        if reel["run_after"] is not None:
+            item["run_after"] = reel["run_after"].isoformat()
+        if decision != DROPPED:
+            queued += 1
+    
+    WEBHOOK_REELS.inc(queued)
+    return jsonify({"queued": queued, "items": results})
+
+def conditional_response(page):
+    """
+    Build a JSON response carrying ETag and Last-Modified, answering 304 when the client's copy is current.
+    
+    Args:
+        page (dict): A rendered body with its validators, from app.collection.
+    
+    Returns:
+        Response: The full response, or an empty 304 Not Modified response.
+    """
+    response = Response(page["body"], mimetype="application/json")
+    response.set_etag(page["etag"])
+    if page["last_modified"] is not None:
+        response.last_modified = page["last_modified"]
+    response.cache_control.no_cache = True  # Caches may store it, but must revalidate
+    return response.make_conditional(request)
+
+# Define the post collection route
+@main.route("/posts/", methods=["GET"])
+def list_posts():
+    """
+    Route to page through the stored posts, newest first.
+    
+    Query parameters:
+        cursor (str): The ``next_cursor`` of the previous page, omitted for the first page.
+        limit (int): Number of posts per page.
+    
+    Returns:
+        Response: JSON with the posts of the page and the cursor of the next one (None on the last page),
+            or 400 for a malformed cursor.
+    """
+    try:
+        page = get_collection_page(request.args.get("cursor"), request.args.get("limit", type=int))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return conditional_response(page)
+
+# Define the single post route
+@main.route("/posts/<int:post_id>/", methods=["GET"])
+def get_post(post_id):
+    """
+    Route to fetch a single stored post.
+    
+    Args:
+        post_id (int): The ID of the post.
+    
+    Returns:
+        Response: JSON of the post, or 404 if it is not in the collection.
+    """
+    post = get_collection_post(post_id)
+    if post is None:
+        return jsonify({"error": "Post not found"}), 404
+    return conditional_response(post)
+
+# Define the publish queue route
+@main.route("/publish-queue/", methods=["GET"])
+def publish_queue():
+    """
+    Route to inspect the quota-gated publish queue.
+    
+    Returns:
+        Response: JSON with the queue depth, the quota state and the projected publish time of each queued post
+            of the default account, and the same for every other account under ``accounts``.
+    """
+    snapshot = get_scheduler().snapshot()
+    snapshot["accounts"] = {key: scheduler.snapshot() for key, scheduler in get_schedulers().items() if key != DEFAULT_SCHEDULER}
+    return jsonify(snapshot)
+
+# Define the metrics route
+@main.route("/metrics", methods=["GET"])
+def metrics():
+    """
+    Route to expose the pipeline metrics in the Prometheus text format.
+    
+    Returns:
+        Response: Plain-text metrics for a Prometheus scraper.
+    """
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
+# Define the profile listing route
+@main.route("/profiles/", methods=["GET"])
+def profiles():
+    """
+    Route to list the most recent profiles, newest first; requires a signed X-Profile header.
+    
+    Returns:
+        Response: JSON with the name, size and time of each profile, or 403 without a valid signature.
+    """
+    if not verify_profile_request(request.headers.get(PROFILE_HEADER)):
+        return jsonify({"error": "Forbidden"}), 403
+    listing = []
+    for path in list_profiles():
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue  # Rotated meanwhile
+        listing.append({"name": path.name, "size": stat.st_size, "written_at": stat.st_mtime})
+    return jsonify({"profiles": listing})
+
+# Define the profile download route
+@main.route("/profiles/<name>", methods=["GET"])
+def get_profile(name):
+    """
+    Route to download a profile; requires a signed X-Profile header.
+    
+    Query parameters:
+        format (str): ``text`` for a report of the hottest functions instead of the pstats file.
+        sort (str): The pstats sort key of the report, ``cumulative`` by default.
+    
+    Args:
+        name (str): The file name of the profile.
+    
+    Returns:
+        Response: The pstats file or its report, 403 without a valid signature, or 404 if there is no such profile.
+    """
+    if not verify_profile_request(request.headers.get(PROFILE_HEADER)):
+        return jsonify({"error": "Forbidden"}), 403
+    path = find_profile(name)
+    if path is None:
+        return jsonify({"error": "Profile not found"}), 404
+    if request.args.get("format") == "text":
+        try:
+            report = render_profile(path, sort=request.args.get("sort", "cumulative"))
+        except KeyError as e:
+            return jsonify({"error": f"Unknown sort key {e}"}), 400
+        return Response(report, mimetype="text/plain")
+    return send_file(path, mimetype="application/octet-stream", as_attachment=True, download_name=name)
+
 # Define the privacy policy route
 @main.route("/privacy-policy/", methods=["GET"])
 def privacy_policy():
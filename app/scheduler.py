@@ -0,0 +1,341 @@
+# Import necessary modules for the container poll scheduler
+import collections
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from app.quota import PublishQuota, PublishLimitReached, SharedPublishQuota
+from app.metrics import STAGE_SECONDS, CONTAINER_POLLS, CONTAINER_WAIT_SECONDS
+
+logger = logging.getLogger("LOLify.scheduler")
+
+class _PendingContainer:
+    """Bookkeeping for a single container that is waiting to finish processing."""
+
+    __slots__ = ("api", "container_id", "guard", "future", "submitted_at", "interval", "polls", "ready_at")
+
+    def __init__(self, api, container_id, interval, guard=None):
+        self.api = api
+        self.container_id = container_id
+        self.guard = guard
+        self.future = Future()
+        self.submitted_at = time.monotonic()
+        self.interval = interval
+        self.polls = 0
+        self.ready_at = None
+
+class ContainerScheduler:
+    """
+    Single background thread that owns every media container of one account waiting to be published.
+
+    Containers are kept in a heap ordered by their next check time. Each container is
+    checked quickly at first and then less often (exponential backoff up to a cap).
+
+    Once a container is ``finished`` it joins a FIFO publish queue gated by the publishing
+    quota: it is published right away while tokens are available, and held until the
+    bucket refills when we are at the cap. A publish that fails without a definite answer
+    sends the container back to be checked, so one that went through is not published again.
+    """
+
+    def __init__(self, initial_interval=2.0, max_interval=30.0, backoff=1.5, max_wait=1800.0, name="container-scheduler",
+                 account="default"):
+        """
+        Initialize the scheduler.
+
+        Args:
+            initial_interval (float): Seconds before the first status check of a container.
+            max_interval (float): Upper bound on the seconds between two checks.
+            backoff (float): Factor the interval grows by after every unfinished check.
+            max_wait (float): Seconds after which a container that never finishes is given up on.
+            name (str): Name of the scheduler thread.
+            account (str): Key of the account whose containers are published, which the shared quota is stored under.
+        """
+        self.configure(initial_interval, max_interval, backoff, max_wait)
+        self.name = name
+        self.account = account
+        self.quota = PublishQuota()
+        self._quota_refresh_interval = 300.0
+        self._heap = []  # Entries are (due, seq, container), or (due, seq, None) for a publish queue wake-up
+        self._ready = collections.deque()  # Finished containers waiting for a publishing token
+        self._drain_at = None  # When the publish queue is next due to be drained
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def configure(self, initial_interval, max_interval, backoff, max_wait):
+        """Update the polling schedule used for newly submitted containers."""
+        self._initial_interval = initial_interval
+        self._max_interval = max_interval
+        self._backoff = backoff
+        self._max_wait = max_wait
+
+    def configure_quota(self, limit, window, reserve, refresh_interval, app=None):
+        """
+        Set up the publishing quota.
+
+        Args:
+            limit (int): Posts allowed per window until the Graph API reports its own limit.
+            window (int): Length of the rolling window in seconds.
+            reserve (int): Number of posts kept back from automatic publishing.
+            refresh_interval (float): Seconds between refreshes of the quota from the Graph API.
+            app (Flask): The application whose database shares the quota with the account's other
+                publishing processes, or None to keep it in this process.
+
+        Raises:
+            ValueError: If the reserve is not lower than the limit.
+        """
+        if app is not None:
+            self.quota = SharedPublishQuota(app, self.account, limit, window, reserve)
+        else:
+            self.quota = PublishQuota(limit, window, reserve)
+        self._quota_refresh_interval = refresh_interval
+
+    def pending(self):
+        """Get the number of containers currently waiting to be published."""
+        with self._condition:
+            return sum(1 for _, _, entry in self._heap if entry is not None) + len(self._ready)
+
+    def snapshot(self):
+        """
+        Describe the publish queue.
+
+        Returns:
+            dict: The number of containers still processing, the publish queue depth, the quota
+            state and, for each queued container, the projected time it will be published.
+        """
+        with self._condition:
+            processing = sum(1 for _, _, entry in self._heap if entry is not None)
+            ready = list(self._ready)
+        now = time.time()
+        delays = self.quota.projected_delays(len(ready))
+        return {
+            "processing": processing,
+            "queue_depth": len(ready),
+            "quota": self.quota.snapshot(),
+            "queue": [
+                {
+                    "container_id": entry.container_id,
+                    "waiting_for": round(time.monotonic() - entry.ready_at, 1),
+                    "projected_publish_at": now + delay,
+                }
+                for entry, delay in zip(ready, delays)
+            ],
+        }
+
+    def submit(self, api, container_id, guard=None):
+        """
+        Hand a container over to the scheduler.
+
+        Args:
+            api (InstagramAPI): The API client used to check and publish the container.
+            container_id (str): The ID of the media container.
+            guard (callable): Called right before the container is published; if it raises,
+                the container is not published and the future resolves to its exception.
+
+        Returns:
+            Future: Resolves to the published media ID, or None if the container failed or timed out.
+        """
+        entry = _PendingContainer(api, container_id, self._initial_interval, guard)
+        with self._condition:
+            self._ensure_started()
+            self._push(entry, entry.interval)
+            self._condition.notify()
+        return entry.future
+
+    def _ensure_started(self):
+        """Start the scheduler thread on first use."""
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def _push(self, entry, delay):
+        """Schedule the next check of a container ``delay`` seconds from now."""
+        heapq.heappush(self._heap, (time.monotonic() + delay, next(self._counter), entry))
+
+    def _run(self):
+        """Scheduler loop: sleep until the earliest check is due, then run it."""
+        while True:
+            with self._condition:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+                    self._condition.wait(timeout)
+                _, _, entry = heapq.heappop(self._heap)
+                if entry is None:
+                    self._drain_at = None
+            if entry is None:
+                self._drain()
+            else:
+                self._poll(entry)
+
+    def _poll(self, entry):
+        """Check a container once and publish, reschedule or give up on it."""
+        entry.polls += 1
+        CONTAINER_POLLS.inc()
+        try:
+            with STAGE_SECONDS.time(stage="container_status"):
+                status = entry.api._check_container_status(entry.container_id)
+        except Exception as e:
+            logger.warning("Status check failed for container %s: %s", entry.container_id, e)
+            status = None
+
+        if status == "finished":
+            # Queue the container for publishing, subject to the quota
+            entry.ready_at = time.monotonic()
+            CONTAINER_WAIT_SECONDS.observe(entry.ready_at - entry.submitted_at)
+            with self._condition:
+                self._ready.append(entry)
+            self._drain()
+        elif status == "published":
+            # Published before a restart, but the media ID was never recorded; the container ID stands in for it
+            logger.warning("Container %s was already published, its media ID is unknown", entry.container_id)
+            entry.future.set_result(entry.container_id)
+        elif status in ("error", "expired"):
+            logger.error("Error publishing container ID: %s (%s)", entry.container_id, status)
+            entry.future.set_result(None)
+        elif time.monotonic() - entry.submitted_at >= self._max_wait:
+            logger.error("Gave up on container %s after %s checks", entry.container_id, entry.polls)
+            entry.future.set_result(None)
+        else:
+            # Still processing, check again later with a longer interval
+            entry.interval = min(entry.interval * self._backoff, self._max_interval)
+            with self._condition:
+                self._push(entry, entry.interval)
+
+    def _drain(self):
+        """Publish queued containers while the quota allows, then sleep until the next token."""
+        while True:
+            with self._condition:
+                if not self._ready:
+                    return
+                entry = self._ready[0]
+            if entry.guard is not None:
+                try:
+                    entry.guard()
+                except Exception as e:
+                    # The container's owner may no longer publish it, e.g. its job was taken over
+                    logger.warning("Not publishing container %s: %s", entry.container_id, e)
+                    with self._condition:
+                        self._ready.popleft()
+                    entry.future.set_exception(e)
+                    continue
+            self._refresh_quota(entry.api)
+            wait = self.quota.acquire()
+            if wait > 0:
+                logger.info("Publishing limit reached, holding %s container(s) for %.0fs", len(self._ready), wait)
+                self._schedule_drain(wait)
+                return
+            with self._condition:
+                self._ready.popleft()
+            try:
+                with STAGE_SECONDS.time(stage="media_publish"):
+                    media_id = entry.api._media_publish(entry.container_id)
+            except PublishLimitReached:
+                # Our bucket was out of sync with the API, put the container back and wait
+                self.quota.exhaust()
+                with self._condition:
+                    self._ready.appendleft(entry)
+                continue
+            except Exception as e:
+                if time.monotonic() - entry.submitted_at >= self._max_wait:
+                    logger.error("Failed to publish container %s: %s", entry.container_id, e)
+                    entry.future.set_result(None)
+                    continue
+                # The publish may have gone through before the error, e.g. a read timeout: check the
+                # container again instead of failing the job, whose retry would publish the reel twice
+                logger.warning("Failed to publish container %s (%s), checking its status", entry.container_id, e)
+                with self._condition:
+                    self._push(entry, entry.interval)
+                    self._condition.notify()
+                continue
+            entry.future.set_result(media_id)
+
+    def _schedule_drain(self, delay):
+        """Wake up the scheduler to drain the publish queue ``delay`` seconds from now."""
+        due = time.monotonic() + delay
+        with self._condition:
+            if self._drain_at is not None and self._drain_at <= due:
+                return
+            self._drain_at = due
+            heapq.heappush(self._heap, (due, next(self._counter), None))
+            self._condition.notify()
+
+    def _refresh_quota(self, api):
+        """Re-seed the quota from the Graph API if it has not been refreshed recently."""
+        if self.quota.synced_since(self._quota_refresh_interval):
+            return
+        try:
+            config = api.get_publishing_config(use_cache=False)
+        except Exception as e:
+            logger.warning("Failed to refresh publishing limit: %s", e)
+            config = None
+        if config is None:
+            # Try again at the next interval instead of on every publish
+            self.quota.sync_failed()
+            return
+        quota = config.get("config") or {}
+        self.quota.sync(config.get("quota_usage", 0), quota.get("quota_total"), quota.get("quota_duration"))
+
+# Key of the scheduler of the account configured in the settings
+DEFAULT_SCHEDULER = "default"
+
+# Process-wide schedulers, one per Instagram account, so that one account's backlog or
+# exhausted publishing quota never holds up the containers of another
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+_poll_schedule = (2.0, 30.0, 1.5, 1800.0)
+_quota_settings = None
+_quota_app = None
+
+def configure_schedulers(poll_schedule, quota_settings, app=None):
+    """
+    Set the polling schedule and publishing quota of the container schedulers.
+
+    Args:
+        poll_schedule (tuple): Arguments of ``ContainerScheduler.configure``.
+        quota_settings (tuple): Limit, window, reserve and refresh interval, see ``ContainerScheduler.configure_quota``.
+        app (Flask): The application whose database shares each account's quota between processes,
+            or None to give every process its own.
+
+    Raises:
+        ValueError: If the reserve leaves no posts to publish.
+    """
+    global _poll_schedule, _quota_settings, _quota_app
+    limit, _, reserve, _ = quota_settings
+    if reserve >= limit:
+        raise ValueError(f"PUBLISH_QUOTA_RESERVE ({reserve}) must be lower than PUBLISH_QUOTA_LIMIT ({limit})")
+    with _schedulers_lock:
+        _poll_schedule = tuple(poll_schedule)
+        _quota_settings = tuple(quota_settings)
+        _quota_app = app
+        schedulers = list(_schedulers.values())
+    for scheduler in schedulers:
+        scheduler.configure(*_poll_schedule)
+        scheduler.configure_quota(*_quota_settings, app=_quota_app)
+
+def get_scheduler(key=None):
+    """
+    Get the container scheduler of an account, starting a new one on first use.
+
+    Args:
+        key (str): The account's key (defaults to the account configured in the settings).
+
+    Returns:
+        ContainerScheduler: The account's scheduler, with its own thread and publishing quota.
+    """
+    key = key or DEFAULT_SCHEDULER
+    with _schedulers_lock:
+        scheduler = _schedulers.get(key)
+        if scheduler is None:
+            name = "container-scheduler" if key == DEFAULT_SCHEDULER else f"container-scheduler-{key}"
+            scheduler = ContainerScheduler(*_poll_schedule, name=name, account=key)
+            if _quota_settings is not None:
+                scheduler.configure_quota(*_quota_settings, app=_quota_app)
+            _schedulers[key] = scheduler
+        return scheduler
+
+def get_schedulers():
+    """Get the schedulers started so far, keyed by account."""
+    with _schedulers_lock:
+        return dict(_schedulers)
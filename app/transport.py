@@ -0,0 +1,238 @@
+# Import necessary modules for the shared Graph API transport
+import json
+import logging
+import os
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+from app.config import get_settings
+from app.metrics import GRAPH_RESPONSES
+
+logger = logging.getLogger("LOLify.transport")
+
+# Graph API error codes that mean we are being rate limited
+RATE_LIMIT_ERROR_CODES = {4, 17, 32, 613, 80001, 80002, 80004}
+# HTTP status codes worth retrying
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+# Methods that may be sent again after a failure that reached the server
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+def _not_sent(error):
+    """Check whether a request failed before it reached the server, e.g. the connection was refused."""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    if isinstance(error, requests.Timeout):
+        return False  # A read timeout: the server may have acted on the request
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+class GraphTransport:
+    """
+    Thread-safe HTTP transport shared by every Graph API client in the process.
+
+    It keeps one pooled keep-alive session, applies a timeout per endpoint, and retries
+    connection errors, 5xx responses and rate-limit errors with jittered exponential backoff.
+    POSTs such as ``media`` and ``media_publish`` are not idempotent, so they are only sent
+    again when the first attempt never reached the server or was rejected for the rate limit.
+    When the Graph API reports that an access token is throttled, further requests with that
+    token wait until the reported time instead of hammering the API, while the other accounts'
+    requests carry on.
+    """
+
+    USER_AGENT = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36'
+
+    # Connect and read timeouts in seconds, per endpoint
+    TIMEOUTS = {
+        "default": (5, 30),
+        "media": (5, 60),
+        "media_publish": (5, 60),
+        "status": (5, 15),
+    }
+
+    def __init__(self, base_url, pool_size=20, max_retries=4, backoff_base=0.5, backoff_max=30.0):
+        """
+        Initialize the transport.
+
+        Args:
+            base_url (str): Base URL of the Graph API, e.g. a local stand-in server for testing.
+            pool_size (int): Maximum number of kept-alive connections per host.
+            max_retries (int): Number of retries after the first attempt.
+            backoff_base (float): Base delay in seconds of the exponential backoff.
+            backoff_max (float): Longest delay in seconds before giving up on a retry.
+        """
+        self.base_url = base_url.rstrip("/")
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        session = requests.Session()
+        session.headers["User-Agent"] = self.USER_AGENT
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        self.session = session
+        self._blocked_until = {}  # Access token -> monotonic time until which it is throttled
+        self._lock = threading.Lock()
+
+    def url(self, path):
+        """Build an absolute URL for a Graph API path."""
+        if path.startswith(("http://", "https://")):
+            return path
+        return f"{self.base_url}/{path.lstrip('/')}"
+
+    def get(self, path, endpoint="default", **kwargs):
+        """Send a GET request to the Graph API."""
+        return self.request("GET", path, endpoint=endpoint, **kwargs)
+
+    def post(self, path, endpoint="default", **kwargs):
+        """Send a POST request to the Graph API."""
+        return self.request("POST", path, endpoint=endpoint, **kwargs)
+
+    def request(self, method, path, endpoint="default", **kwargs):
+        """
+        Send a request, retrying transient failures.
+
+        Args:
+            method (str): The HTTP method.
+            path (str): Path relative to the base URL, or an absolute URL.
+            endpoint (str): Name of the endpoint, used to pick the timeout.
+            **kwargs: Passed on to ``requests.Session.request``.
+
+        Returns:
+            requests.Response: The last response received.
+
+        Raises:
+            requests.RequestException: If the request could not be sent after every retry.
+        """
+        kwargs.setdefault("timeout", self.TIMEOUTS.get(endpoint, self.TIMEOUTS["default"]))
+        url = self.url(path)
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+        token = self._access_token(kwargs)
+        for attempt in range(self.max_retries + 1):
+            self._wait_if_blocked(token)
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                GRAPH_RESPONSES.inc(endpoint=endpoint, status="error")
+                if attempt == self.max_retries or not (idempotent or _not_sent(e)):
+                    raise
+                delay = self._backoff(attempt)
+                logger.warning("Graph API %s request failed (%s), retrying in %.1fs", endpoint, e, delay)
+            else:
+                GRAPH_RESPONSES.inc(endpoint=endpoint, status=response.status_code)
+                delay = self._retry_delay(response, attempt, idempotent, token)
+                if delay is None or attempt == self.max_retries:
+                    return response
+                logger.warning("Graph API %s returned %s, retrying in %.1fs", endpoint, response.status_code, delay)
+            time.sleep(delay)
+        return response
+
+    def _backoff(self, attempt):
+        """Get a jittered exponential backoff delay for the given attempt."""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    @staticmethod
+    def _access_token(kwargs):
+        """Get the access token a request is sent with, as the Graph API throttles each token separately."""
+        for name in ("params", "data"):
+            values = kwargs.get(name)
+            if isinstance(values, dict) and values.get("access_token"):
+                return values["access_token"]
+        return None
+
+    def _retry_delay(self, response, attempt, idempotent=True, token=None):
+        """
+        Decide whether a response should be retried.
+
+        Args:
+            response (requests.Response): The response received.
+            attempt (int): The number of the attempt, from 0.
+            idempotent (bool): Whether the request may be sent again after a 5xx response,
+                which the server may have sent after acting on it.
+            token (str): The access token the request was sent with, which a throttle applies to.
+
+        Returns:
+            float: Seconds to wait before retrying, or None to return the response as is.
+        """
+        rate_limited = response.status_code == 429
+        if not rate_limited and response.status_code >= 400:
+            try:
+                rate_limited = response.json().get("error", {}).get("code") in RATE_LIMIT_ERROR_CODES
+            except ValueError:
+                pass
+        if not rate_limited and (not idempotent or response.status_code not in RETRY_STATUS_CODES):
+            return None
+        delay = self._backoff(attempt)
+        if rate_limited:
+            # Respect how long the API tells us to back off for
+            regain = self._regain_access_after(response)
+            if regain is not None:
+                now = time.monotonic()
+                with self._lock:
+                    # Forget the tokens whose throttle is over, so the map does not grow with old tokens
+                    for expired in [key for key, until in self._blocked_until.items() if until <= now]:
+                        del self._blocked_until[expired]
+                    self._blocked_until[token] = max(self._blocked_until.get(token, 0.0), now + regain)
+                if regain > self.backoff_max:
+                    return None
+                delay = max(delay, regain)
+        return delay
+
+    @staticmethod
+    def _regain_access_after(response):
+        """Read how many seconds until the API accepts requests again from the rate-limit headers."""
+        retry_after = response.headers.get("Retry-After")
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        usage = response.headers.get("X-Business-Use-Case-Usage")
+        if usage:
+            try:
+                minutes = [
+                    entry.get("estimated_time_to_regain_access", 0)
+                    for entries in json.loads(usage).values()
+                    for entry in entries
+                ]
+            except (ValueError, AttributeError):
+                minutes = []
+            if minutes and max(minutes) > 0:
+                return max(minutes) * 60.0
+        return None
+
+    def _wait_if_blocked(self, token=None):
+        """Sleep while the API has told us the access token is throttled, up to the backoff cap."""
+        with self._lock:
+            remaining = self._blocked_until.get(token, 0.0) - time.monotonic()
+        if remaining > 0:
+            time.sleep(min(remaining, self.backoff_max))
+
+# Process-wide transport, created on first use
+_transport = None
+_transport_lock = threading.Lock()
+
+def get_transport():
+    """Get the process-wide Graph API transport, configured from the app settings."""
+    global _transport
+    if _transport is None:
+        with _transport_lock:
+            if _transport is None:
+                settings = get_settings()
+                _transport = GraphTransport(
+                    settings.GRAPH_API_BASE,
+                    pool_size=settings.GRAPH_POOL_SIZE,
+                    max_retries=settings.GRAPH_MAX_RETRIES,
+                )
+    return _transport
+
+def _reset_after_fork():
+    """Give a forked child (e.g. gunicorn --preload) its own connection pool instead of the parent's sockets."""
+    global _transport, _transport_lock
+    _transport = None
+    _transport_lock = threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,606 @@
+# Import necessary modules for the background job queue
+import hashlib
+import logging
+import os
+import threading
+import time
+from datetime import timedelta
+import click
+from flask import current_app
+from app.accounts import active_accounts, get_credentials
+from app.crud import (create_job, create_jobs, claim_next_job, update_job, defer_job, claim_post, publish_post,
+                      release_post, get_post_by_hashed, migrate_post_hash, get_orphaned_publishing_jobs, take_over_job,
+                      job_lease_name)
+from app.core import get_hashes_from_video, warm_metadata_cache, InstagramAPI
+from app.fingerprint import FingerprintSink, get_fingerprint_index, to_hex
+from app.hashfilter import get_hash_filter, reload_hash_filter
+from app.hashing import hash_versions
+from app.leases import LeaseLost, acquire_lease, holds_lease, release_lease, renew_leases, purge_leases
+from app.metrics import STAGE_SECONDS, DEDUP_CHECKS, JOBS, HASH_MIGRATIONS
+from app.profiling import profiled
+from app.models import Job, Post, utcnow
+from app import db
+
+logger = logging.getLogger("LOLify.worker")
+
+# Reason recorded on a job deferred while another worker downloads the same video
+VIDEO_BUSY = "video_busy"
+
+def video_lease_name(url):
+    """Get the name of the lease held while a video URL is downloaded."""
+    return "video:" + hashlib.sha1(url.encode()).hexdigest()
+
+def process_job(job):
+    """
+    Run the reel pipeline for a job: download, hash, dedup and create the media container.
+
+    The container is handed to the shared scheduler, which publishes it once Instagram
+    has finished processing it, so the worker is free again as soon as the upload is created.
+    Every step is recorded on the job as it happens (hash claimed, container created,
+    published), so a retry after a crash picks up where the last attempt stopped. The download
+    is covered by a lease on the video URL, so two workers, even on different nodes, never
+    download the same video at once: the second one is deferred and reuses the first one's hash.
+
+    Args:
+        job (Job): The claimed job to process.
+
+    Returns:
+        str: The new status of the job.
+
+    Raises:
+        LeaseLost: If another process claimed the job meanwhile.
+        Exception: If any stage of the pipeline fails and the job should be retried.
+    """
+    # An earlier attempt may have claimed the hash already: skip the download and go on from there
+    if job.hashed:
+        # Ask the database directly: the known-hash filter may not have seen another process's claim
+        post = Post.query.filter_by(hashed=job.hashed).first()
+        if post is not None and post.job_id == job.id and post.media_id is None:
+            logger.info("Job %s resuming from its claim on %s", job.id, job.hashed)
+            return submit_container(job, job.hashed, post.fingerprint)
+
+    # The same video was being downloaded for another job: its claim answers this one without a download
+    if job.shed_reason == VIDEO_BUSY:
+        other = Job.query.filter(Job.url == job.url, Job.id != job.id, Job.hashed.isnot(None)).first()
+        # Ask the database directly: the other job may have been claimed by another process or node
+        if other is not None and Post.query.filter_by(hashed=other.hashed).first() is not None:
+            DEDUP_CHECKS.inc(result="exact")
+            update_job(job, Job.DUPLICATE, hashed=other.hashed)
+            return Job.DUPLICATE
+
+    lease_ttl = current_app.config["JOB_LEASE_TTL"]
+    video_lease = video_lease_name(job.url)
+    video_token = acquire_lease(video_lease, lease_ttl)
+    if video_token is None:
+        # Try again once the other download is over
+        defer_job(job, utcnow() + timedelta(seconds=current_app.config["JOB_HEARTBEAT_INTERVAL"]), VIDEO_BUSY)
+        return Job.PENDING
+    try:
+        return _download_and_claim(job)
+    finally:
+        release_lease(video_lease, video_token)
+
+def find_near_duplicate(fingerprint, job):
+    """
+    Find a stored post whose video is a re-encoded copy of the job's.
+
+    Candidates are tried closest first, skipping the job's own claim from an earlier attempt
+    and posts deleted or released since they were indexed.
+
+    Args:
+        fingerprint (int): The perceptual fingerprint of the job's video.
+        job (Job): The job being processed.
+
+    Returns:
+        Post: The closest matching post, or None if there is none.
+    """
+    index = get_fingerprint_index()
+    index.refresh(db.session, Post)
+    for post_id in index.search(fingerprint, current_app.config["FINGERPRINT_MAX_DISTANCE"]):
+        post = db.session.get(Post, post_id)
+        if post is not None and post.job_id != job.id:
+            return post
+    return None
+
+def _download_and_claim(job):
+    """
+    Download and hash a job's video, check it for duplicates and claim it, then create its container.
+
+    While posts hashed under an older hash version remain, the video is hashed under those
+    versions too, in the same pass; a repeat of such a post moves it to the current version.
+    """
+    # Sample frames for the perceptual fingerprint while the video is streamed and hashed
+    sink = FingerprintSink.open()
+    versions = hash_versions()
+    with STAGE_SECONDS.time(stage="download_hash"):
+        digests = get_hashes_from_video(job.url, versions, sink=sink)  # Generate a hash from the video URL
+    if not digests:
+        if sink:
+            sink.close()
+        raise Exception("Failed to hash video")
+    hashed = digests[versions[0]]
+    with STAGE_SECONDS.time(stage="fingerprint"):
+        fingerprint = sink.result() if sink else None
+
+    # Check if a re-encoded copy of the reel has already been posted or claimed
+    if fingerprint is not None:
+        with STAGE_SECONDS.time(stage="near_dedup_lookup"):
+            match_post = find_near_duplicate(fingerprint, job)
+        if match_post is not None:
+            DEDUP_CHECKS.inc(result="near")
+            update_job(job, Job.DUPLICATE, hashed=hashed, fingerprint=to_hex(fingerprint), error=f"Near-duplicate of post {match_post.id}")
+            return Job.DUPLICATE
+
+    # Reels published recently by this process are answered from memory, without a claim attempt
+    if get_hash_filter().lookup(hashed) == get_hash_filter().HIT:
+        DEDUP_CHECKS.inc(result="exact")
+        update_job(job, Job.DUPLICATE, hashed=hashed)
+        return Job.DUPLICATE
+
+    # Compare with the posts stored under older hash versions
+    for version in versions[1:]:
+        post = get_post_by_hashed(digests[version])
+        if post is None or post.job_id == job.id:
+            continue
+        if post.media_id and migrate_post_hash(post.id, post.hashed, hashed, versions[0]):
+            HASH_MIGRATIONS.inc(source="repeat")
+        DEDUP_CHECKS.inc(result="legacy")
+        update_job(job, Job.DUPLICATE, hashed=hashed)
+        return Job.DUPLICATE
+
+    # Atomically claim the hash, so no other worker publishes the same reel
+    with STAGE_SECONDS.time(stage="dedup_lookup"):
+        claimed = claim_post(hashed, job.caption, fingerprint=to_hex(fingerprint), job_id=job.id, hash_version=versions[0])
+        if not claimed:
+            # A retry of this job may find its own claim from an earlier attempt
+            post = get_post_by_hashed(hashed)
+            claimed = post is not None and post.job_id == job.id
+            if post is not None and post.media_id:
+                get_hash_filter().remember(hashed)
+    if not claimed:
+        DEDUP_CHECKS.inc(result="exact")
+        update_job(job, Job.DUPLICATE, hashed=hashed)
+        return Job.DUPLICATE
+    DEDUP_CHECKS.inc(result="miss")
+    # Record the claim, so a retry does not download the video again
+    update_job(job, Job.RUNNING, hashed=hashed, fingerprint=to_hex(fingerprint))
+    return submit_container(job, hashed, to_hex(fingerprint))
+
+def submit_container(job, hashed, fingerprint):
+    """
+    Create the media container of a claimed reel and hand it to the scheduler.
+
+    The container ID is stored on the job before the scheduler starts polling it, so the
+    upload is never repeated once Instagram has accepted it, and the scheduler checks the
+    job's lease right before publishing, so a process that lost the job never publishes it.
+
+    Args:
+        job (Job): The job holding the claim.
+        hashed (str): The hash of the video.
+        fingerprint (str): The fingerprint of the video as hex, if known.
+
+    Returns:
+        str: The new status of the job.
+    """
+    def record(container_id):
+        update_job(job, Job.PUBLISHING, hashed=hashed, container_id=container_id, fingerprint=fingerprint)
+
+    try:
+        with InstagramAPI(job_account(job)) as iapi, STAGE_SECONDS.time(stage="create_container"):
+            # Create the media container and let the scheduler publish it
+            container_id, future = iapi.submit_post(job.url, caption=job.caption, media_type="REELS",
+                                                    on_created=record, guard=_lease_guard(job))
+        if not container_id:
+            raise Exception("Failed to create media container")
+    except Exception:
+        db.session.rollback()
+        release_post(hashed, job.id, job.held_token)  # Let a later attempt claim the hash again
+        raise
+    _track_publish(job, future)
+    return Job.PUBLISHING
+
+def job_account(job):
+    """
+    Get the credentials of the account a job is published to.
+
+    Raises:
+        Exception: If the account was removed or deactivated since the job was queued.
+    """
+    account = get_credentials(job.account_id)
+    if account is None:
+        raise Exception(f"Account {job.account_id} is not active")
+    return account
+
+def _lease_guard(job):
+    """
+    Build the check the scheduler runs right before publishing a job's container.
+
+    Raises:
+        LeaseLost: When called, if the job's lease has passed to another process.
+    """
+    app = current_app._get_current_object()
+    name = job_lease_name(job.id)
+    token = job.held_token
+
+    def guard():
+        with app.app_context():
+            if not holds_lease(name, token):
+                raise LeaseLost(f"Job {job.id} was taken over by another process")
+    return guard
+
+def _track_publish(job, future):
+    """Keep the job's lease until its container is published, then record the outcome."""
+    app = current_app._get_current_object()
+    job_id, token = job.id, job.held_token
+    future.add_done_callback(lambda f: _finish_publish(app, job_id, token, f))
+
+def _finish_publish(app, job_id, token, future):
+    """Record the outcome of a publish once the scheduler is done with the container."""
+    with app.app_context():
+        try:
+            media_id = future.result()
+            job = db.session.get(Job, job_id)
+            job.held_token = token  # Fence the updates with the token the publish was made under
+            if media_id:
+                # Record the claimed post as published
+                publish_post(job.hashed, media_id)
+                update_job(job, Job.DONE)
+                JOBS.inc(status=Job.DONE)
+                logger.info("Job %s finished with status: %s", job.id, Job.DONE)
+            else:
+                release_post(job.hashed, job.id, token)  # Let a later attempt claim the hash again
+                fail_job(job, "Failed to publish reel", app.config["JOB_MAX_ATTEMPTS"])
+        except LeaseLost as e:
+            db.session.rollback()
+            logger.warning("Dropping the publish of job %s: %s", job_id, e)
+        finally:
+            release_lease(job_lease_name(job_id), token)
+
+def recover_jobs(lease_ttl):
+    """
+    Resume the publishes of processes that died while their containers were processing.
+
+    A job left in PUBLISHING whose lease expired is taken over: if its post was recorded as
+    published it is finished, otherwise its existing container is polled and published again
+    instead of uploading the video a second time.
+
+    Args:
+        lease_ttl (float): Seconds the lease of a taken over job is held unless renewed.
+
+    Returns:
+        int: The number of jobs taken over.
+    """
+    recovered = 0
+    for job in get_orphaned_publishing_jobs():
+        if not take_over_job(job, lease_ttl):
+            continue  # Another process took it over first
+        recovered += 1
+        name, token = job_lease_name(job.id), job.held_token
+        post = Post.query.filter_by(hashed=job.hashed).first() if job.hashed else None
+        if post is not None and post.media_id:
+            # Published, but the process died before the job was updated
+            update_job(job, Job.DONE)
+            JOBS.inc(status=Job.DONE)
+            release_lease(name, token)
+            continue
+        logger.info("Resuming container %s of job %s", job.container_id, job.id)
+        try:
+            with InstagramAPI(job_account(job)) as iapi:
+                future = iapi.resume_post(job.container_id, guard=_lease_guard(job))
+        except Exception as e:
+            db.session.rollback()
+            if job.hashed:
+                release_post(job.hashed, job.id, token)  # Let a later attempt claim the hash again
+            fail_job(job, f"Failed to resume container {job.container_id}: {e}", current_app.config["JOB_MAX_ATTEMPTS"])
+            release_lease(name, token)
+            continue
+        _track_publish(job, future)
+    return recovered
+
+def fail_job(job, error, max_attempts):
+    """
+    Record a failed attempt, re-queueing the job until it runs out of attempts.
+
+    Args:
+        job (Job): The job that failed.
+        error (str): Description of the failure.
+        max_attempts (int): Number of attempts after which the job is marked as failed.
+
+    Returns:
+        Job: The updated Job object.
+
+    Raises:
+        LeaseLost: If another process claimed the job meanwhile.
+    """
+    status = Job.FAILED if job.attempts >= max_attempts else Job.PENDING
+    JOBS.inc(status=status if status == Job.FAILED else "retried")
+    logger.error("Job %s attempt %s failed: %s", job.id, job.attempts, error)
+    return update_job(job, status, error=error)
+
+class WorkerPool:
+    """Pool of background threads that process the queued reel jobs of one account."""
+
+    def __init__(self, app, size, account_id=None, name="reel-worker"):
+        """
+        Initialize the pool.
+
+        Args:
+            app (Flask): The application whose configuration and database the workers use.
+            size (int): Number of worker threads to run.
+            account_id (int): The account whose jobs the pool processes, or None for the account from the settings.
+            name (str): Prefix of the worker thread names.
+        """
+        self._app = app
+        self.size = size
+        self._account_id = account_id
+        self._name = name
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = []
+
+    def start(self):
+        """Start the worker threads."""
+        for index in range(self.size):
+            thread = threading.Thread(target=self._run, name=f"{self._name}-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info("Started %s reel worker(s) for %s", self.size, self._name)
+
+    def stop(self, timeout=None):
+        """Ask the worker threads to exit and wait for them to finish their current job."""
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def notify(self):
+        """Wake idle workers so a freshly queued job is picked up immediately."""
+        self._wakeup.set()
+
+    def restart_after_fork(self):
+        """Restart the worker threads in a forked child (e.g. gunicorn --preload), since threads do not survive a fork."""
+        if not self._threads or self._stopping.is_set():
+            return
+        self._wakeup = threading.Event()
+        self._threads = []
+        self.start()
+
+    def _run(self):
+        """Worker loop: claim jobs until the pool is stopped, sleeping while the queue is empty."""
+        config = self._app.config
+        while not self._stopping.is_set():
+            # Clear before claiming so a job queued during the claim still wakes us up
+            self._wakeup.clear()
+            with self._app.app_context():
+                try:
+                    job = claim_next_job(config["JOB_LEASE_TTL"], self._account_id)
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error("Failed to claim job: %s", e)
+                    job = None
+                if job is not None:
+                    self._handle(job, config["JOB_MAX_ATTEMPTS"])
+                    continue
+            # Nothing to do, wait for a notification or the next poll
+            self._wakeup.wait(config["WORKER_POLL_INTERVAL"])
+
+    def _handle(self, job, max_attempts):
+        """Process a claimed job, re-queueing it on failure until it runs out of attempts."""
+        logger.info("Processing job %s", job.id)
+        name, token = job_lease_name(job.id), job.held_token
+        status = None
+        try:
+            # Sampled jobs, and those of a signed profiling request, are profiled
+            with profiled(f"job-{job.id}", forced=job.profile):
+                status = process_job(job)
+            JOBS.inc(status=status)
+            logger.info("Job %s moved to status: %s", job.id, status)
+        except LeaseLost as e:
+            db.session.rollback()
+            logger.warning("Abandoning job %s: %s", job.id, e)
+        except Exception as e:
+            db.session.rollback()
+            try:
+                fail_job(job, str(e), max_attempts)
+            except LeaseLost as lost:
+                logger.warning("Abandoning job %s: %s", job.id, lost)
+        finally:
+            # A publishing job keeps its lease until the scheduler is done with its container
+            if status != Job.PUBLISHING:
+                release_lease(name, token)
+
+class WorkerPools:
+    """
+    The worker pools of a process: one for the account from the settings and one for each
+    registered account, so that an account's backlog only ever occupies its own workers.
+
+    A maintenance thread keeps the pools in line with the active accounts, renews the
+    leases of this process's jobs and takes over interrupted publishes.
+    """
+
+    def __init__(self, app, size):
+        """
+        Initialize the pools.
+
+        Args:
+            app (Flask): The application whose configuration and database the workers use.
+            size (int): Number of worker threads for the account from the settings.
+        """
+        self._app = app
+        self._size = size
+        self._pools = {}  # Account ID (None for the account from the settings) to its WorkerPool
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start the pool of the account from the settings, and the maintenance thread that starts the others."""
+        if self._app.config["PAGE_ID"]:
+            self._start_pool(None, self._size, "reel-worker")
+        self._thread = threading.Thread(target=self._maintain, name="reel-maintenance", daemon=True)
+        self._thread.start()
+
+    def _start_pool(self, account_id, size, name):
+        """Start the worker pool of an account."""
+        pool = WorkerPool(self._app, size, account_id, name)
+        with self._lock:
+            self._pools[account_id] = pool
+        pool.start()
+
+    def sync_accounts(self):
+        """Start pools for new accounts, resize changed ones and stop those of removed or deactivated accounts."""
+        default_size = self._app.config["ACCOUNT_WORKER_THREADS"]
+        sizes = {}
+        for account in active_accounts():
+            sizes[account.account_id] = (account.worker_threads if account.worker_threads is not None else default_size,
+                                         f"reel-worker-{account.key}")
+        with self._lock:
+            pools = dict(self._pools)
+        for account_id, pool in pools.items():
+            if account_id is not None and (account_id not in sizes or sizes[account_id][0] != pool.size):
+                with self._lock:
+                    del self._pools[account_id]
+                pool.stop(timeout=0)  # Workers finish their current job and exit
+        for account_id, (size, name) in sizes.items():
+            if size > 0 and account_id not in self._pools:
+                self._start_pool(account_id, size, name)
+
+    def notify(self, account_ids=None):
+        """
+        Wake idle workers so freshly queued jobs are picked up immediately.
+
+        Args:
+            account_ids (set): The accounts that have new jobs (defaults to every account).
+        """
+        with self._lock:
+            pools = [pool for account_id, pool in self._pools.items() if account_ids is None or account_id in account_ids]
+        for pool in pools:
+            pool.notify()
+
+    def stop(self, timeout=None):
+        """Stop the maintenance thread and every pool, waiting for the workers to finish their current job."""
+        self._stopping.set()
+        with self._lock:
+            pools = list(self._pools.values())
+        for pool in pools:
+            pool.stop(timeout)
+
+    def restart_after_fork(self):
+        """Restart every pool and the maintenance thread in a forked child, since threads do not survive a fork."""
+        if self._thread is None or self._stopping.is_set():
+            return
+        with self._app.app_context():
+            db.engine.dispose(close=False)  # Open fresh connections instead of sharing the parent's
+        with self._lock:
+            pools = list(self._pools.values())
+        for pool in pools:
+            pool.restart_after_fork()
+        self._thread = threading.Thread(target=self._maintain, name="reel-maintenance", daemon=True)
+        self._thread.start()
+
+    def _maintain(self):
+        """
+        Maintenance loop: start the pools of the active accounts, renew the leases of this
+        process's jobs and take over the publishes other processes abandoned, starting with
+        a recovery pass at startup. The known-hash filter is reloaded every
+        HASH_FILTER_RELOAD_INTERVAL seconds.
+        """
+        config = self._app.config
+        interval = config["JOB_HEARTBEAT_INTERVAL"]
+        filter_loaded_at = time.monotonic()
+        while not self._stopping.is_set():
+            with self._app.app_context():
+                try:
+                    renew_leases(config["JOB_LEASE_TTL"])
+                    self.sync_accounts()
+                    recovered = recover_jobs(config["JOB_LEASE_TTL"])
+                    if recovered:
+                        logger.info("Took over %s interrupted publish(es)", recovered)
+                    purge_leases(config["LEASE_RETENTION"])
+                    # Pick up hashes stored by other processes, e.g. a backfill
+                    reload_interval = config["HASH_FILTER_RELOAD_INTERVAL"]
+                    if reload_interval > 0 and time.monotonic() - filter_loaded_at >= reload_interval:
+                        filter_loaded_at = time.monotonic()
+                        if reload_hash_filter():
+                            logger.info("Reloaded the known-hash filter")
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error("Job maintenance failed: %s", e)
+            self._stopping.wait(interval)
+
+def start_workers(app, size=None):
+    """
+    Start the worker pools for the app and register them as an extension.
+
+    Only processes that should work through the job queue call this: ``flask worker``, the
+    gunicorn workers (see gunicorn.conf.py) and the development server in main.py.
+
+    Args:
+        app (Flask): The application the workers run against.
+        size (int): Number of worker threads for the account from the settings (defaults to WORKER_THREADS).
+
+    Returns:
+        WorkerPools: The running worker pools.
+    """
+    pools = WorkerPools(app, size or app.config["WORKER_THREADS"])
+    app.extensions["worker_pools"] = pools
+    pools.start()
+    # Resolve static Graph API metadata in the background so the first job does not have to
+    threading.Thread(target=warm_metadata_cache, name="metadata-warmup", daemon=True).start()
+    if hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=pools.restart_after_fork)
+    return pools
+
+def enqueue_job(url, caption="", sender_id=None, delivery_key=None, account_id=None):
+    """
+    Queue a reel for background processing and wake up the workers.
+
+    Args:
+        url (str): The URL of the reel video.
+        caption (str): The caption for the reel.
+        sender_id (str): The Instagram ID of the user who sent the reel.
+        delivery_key (str): Key of the webhook delivery the reel came from, if known.
+        account_id (int): The ID of the account to publish to, or None for the account from the settings.
+
+    Returns:
+        Job: The newly created Job object.
+    """
+    job = create_job(url, caption=caption, sender_id=sender_id, delivery_key=delivery_key, account_id=account_id)
+    _notify_workers({account_id})
+    return job
+
+def enqueue_jobs(items):
+    """
+    Queue a batch of reels in one transaction and wake up the workers to process them in parallel.
+
+    Args:
+        items (list[dict]): One dict per reel with ``url``, ``caption``, ``sender_id`` and optional ``delivery_key``
+            and ``account_id`` keys.
+
+    Returns:
+        list[Job]: The newly created Job objects in the same order as ``items``, with None for reels already queued.
+    """
+    if not items:
+        return []
+    jobs = create_jobs(items)
+    _notify_workers({item.get("account_id") for item in items})
+    return jobs
+
+def _notify_workers(account_ids):
+    """Wake up this process's worker pools of the given accounts, if it runs them."""
+    pools = current_app.extensions.get("worker_pools")
+    if pools is not None:
+        pools.notify(account_ids)
+
+@click.command("worker")
+@click.option("--threads", type=int, help="Number of worker threads for the default account (defaults to WORKER_THREADS).")
+def worker_command(threads):
+    """Run a standalone process that works through the reel job queues of every account."""
+    app = current_app._get_current_object()
+    pools = start_workers(app, threads or app.config["WORKER_THREADS"] or 1)
+    try:
+        # Block the main thread until interrupted
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pools.stop()
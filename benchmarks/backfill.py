@@ -0,0 +1,75 @@
+"""
+Backfill benchmark: how fast ``flask backfill`` seeds the post table from an account's history.
+
+Starts the Graph API simulator with ``--media`` media already published on its account and
+runs the backfill against an empty temporary SQLite database, then runs it again. Reports:
+
+- media processed per second and the elapsed time of each run
+- posts added, reposted videos caught as duplicates, images skipped and failed downloads
+- video downloads from the CDN; the second run finds every video stored and downloads none
+
+Usage:
+    python benchmarks/backfill.py --media 2000 --concurrency 8
+    python benchmarks/backfill.py --media 500 --video-bandwidth 2000000 --latency 0.1
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import requests
+
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_DIR.parent))
+
+from graph_simulator import PAGE_ID, start_simulator  # noqa: E402
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--media", type=int, default=1000, help="Media published on the account before the backfill.")
+    parser.add_argument("--concurrency", type=int, default=8, help="Videos downloaded and fingerprinted at once.")
+    parser.add_argument("--page-size", type=int, default=50, help="Media requested per Graph API page.")
+    parser.add_argument("--batch-size", type=int, default=200, help="Posts stored per transaction.")
+    parser.add_argument("--latency", type=float, default=0.02, help="Simulated Graph API latency in seconds.")
+    parser.add_argument("--video-size", type=int, default=1024 * 1024, help="Size of the served videos in bytes.")
+    parser.add_argument("--video-bandwidth", type=int, default=0, help="Bytes per second per video connection (0 for unlimited).")
+    args = parser.parse_args()
+
+    server, _ = start_simulator(latency=args.latency, video_size=args.video_size,
+                                video_bandwidth=args.video_bandwidth, media_count=args.media)
+    simulator_url = f"http://127.0.0.1:{server.server_port}"
+    # Keep benchmark data out of the real database, media cache and log file
+    database = tempfile.NamedTemporaryFile(suffix=".db", delete=False)
+    os.environ.update({
+        "DATABASE_URL": f"sqlite:///{database.name}",
+        "MEDIA_CACHE_DIR": tempfile.mkdtemp(prefix="media-cache-"),
+        "LOG_FILE": "",
+        "GRAPH_API_BASE": f"{simulator_url}/v20.0",
+        "PAGE_ID": PAGE_ID,
+        "ACCESS_TOKEN": "benchmark-token",
+        "WORKER_THREADS": "0",
+    })
+    from app import create_app, db
+    from app.accounts import default_credentials
+    from app.backfill import run_backfill
+
+    app = create_app()
+    logging.getLogger("LOLify").setLevel(logging.WARNING)  # Skip the progress logs
+    with app.app_context():
+        db.create_all()
+        print(f"Backfilling {args.media} media, {args.concurrency} downloads at once")
+        print(f"{'':8} {'seconds':>8} {'media/s':>8} {'added':>6} {'dup':>5} {'known':>6} {'skipped':>8} {'failed':>7} {'downloads':>10}")
+        for label in ("first", "again"):
+            before = requests.get(f"{simulator_url}/_stats").json()["video_requests"]
+            result = run_backfill(default_credentials(), args.concurrency, args.page_size, args.batch_size)
+            downloads = requests.get(f"{simulator_url}/_stats").json()["video_requests"] - before
+            processed = sum(count for key, count in result.items() if key != "seconds")
+            print(f"{label:8} {result['seconds']:8.1f} {processed / result['seconds']:8.0f} {result['added']:6} "
+                  f"{result['duplicate']:5} {result['known']:6} {result['skipped']:8} {result['failed']:7} {downloads:10}")
+    server.shutdown()
+    os.unlink(database.name)
+
+if __name__ == "__main__":
+    main()
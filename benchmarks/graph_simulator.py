@@ -0,0 +1,358 @@
+"""
+Local stand-in for graph.facebook.com and the Instagram CDN.
+
+Implements just enough of the Graph API for the reel pipeline:
+
+- ``GET /{PAGE_ID}?fields=instagram_business_account``
+- ``POST /{IG_ID}/media`` creates a container that finishes after a processing delay
+- ``GET /{CONTAINER_ID}?fields=status_code`` reports IN_PROGRESS, FINISHED, PUBLISHED or ERROR
+- ``POST /{IG_ID}/media_publish`` publishes a finished container, enforcing the account's quota
+- ``GET /{IG_ID}/content_publishing_limit`` reports quota usage and configuration
+- ``GET /{IG_ID}/media`` lists the account's media, newest first, with cursor paging: the
+  reels published through the simulator, then ``--media-count`` media published before it
+  (every fifth one an image, and every tenth one a repost of the video before it)
+- ``GET /videos/{name}.mp4`` serves deterministic video bytes, with Range support, optionally
+  throttled per connection and stalling partway through
+- ``GET /_stats`` returns every publish with its timestamp, for benchmarks
+
+With ``--accounts N`` it serves N Pages (``PAGE_ID``, ``PAGE_ID`` + 1, ...), each linked to
+its own Instagram account with its own quota, as listed by ``simulated_accounts``.
+
+Point the app at it with ``GRAPH_API_BASE=http://127.0.0.1:PORT/v20.0``.
+
+Usage:
+    python benchmarks/graph_simulator.py --port 9000 --latency 0.05 --processing-delay 5
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+PAGE_ID = "1000"
+INSTAGRAM_ID = "17840000000000000"
+
+def simulated_accounts(count):
+    """Get the (page ID, Instagram ID) pairs of the first ``count`` simulated accounts."""
+    return [(str(int(PAGE_ID) + index), str(int(INSTAGRAM_ID) + index)) for index in range(count)]
+
+class SimulatorState:
+    """Containers, publishes and quota shared by every request handler."""
+
+    def __init__(self, latency=0.0, error_rate=0.0, container_error_rate=0.0, processing_delay=3.0,
+                 quota_total=50, quota_duration=86400, video_size=2 * 1024 * 1024, video_bandwidth=0,
+                 stall_rate=0.0, accounts=1, media_count=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.container_error_rate = container_error_rate
+        self.processing_delay = processing_delay
+        self.quota_total = quota_total
+        self.quota_duration = quota_duration
+        self.video_size = video_size
+        self.video_bandwidth = video_bandwidth
+        self.stall_rate = stall_rate
+        self.media_count = media_count
+        self.pages = dict(simulated_accounts(accounts))  # Page ID to Instagram ID
+        self.instagram_ids = set(self.pages.values())
+        self.containers = {}
+        self.publishes = []
+        self.requests = 0
+        self.video_requests = 0
+        self.lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    def next_id(self):
+        """Get a fresh numeric ID for a container or media object."""
+        return str(18000000000000000 + next(self._ids))
+
+    def quota_usage(self, instagram_id):
+        """Count an account's publishes within the current quota window."""
+        cutoff = time.time() - self.quota_duration
+        return sum(1 for publish in self.publishes
+                   if publish["instagram_id"] == instagram_id and publish["published_at"] >= cutoff)
+
+    def media_listing(self, instagram_id, base_url):
+        """List an account's media, newest first: its publishes, then the media published before the simulator."""
+        with self.lock:
+            published = [publish for publish in self.publishes if publish["instagram_id"] == instagram_id]
+        media = [{
+            "id": publish["media_id"],
+            "media_type": "VIDEO",
+            "media_product_type": "REELS",
+            "media_url": publish["video_url"],
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S+0000", time.gmtime(publish["published_at"])),
+        } for publish in reversed(published)]
+        first_id = 19000000000000000 + int(instagram_id) % 1000 * 10 ** 8
+        for index in range(self.media_count):
+            item = {
+                "id": str(first_id + index),
+                "caption": f"Old post {index}",
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S+0000", time.gmtime(1700000000 - index * 3600)),
+            }
+            if index % 5 == 4:
+                item.update(media_type="IMAGE", media_product_type="FEED", media_url=f"{base_url}/images/{index}.jpg")
+            else:
+                video = index - 1 if index % 10 == 3 else index  # Reposted the previous video
+                item.update(media_type="VIDEO", media_product_type="REELS",
+                            media_url=f"{base_url}/videos/history-{instagram_id}-{video}.mp4")
+            media.append(item)
+        return media
+
+def video_bytes(name, start, end):
+    """Generate bytes ``start``..``end`` (exclusive) of a deterministic fake video."""
+    block_size = 64 * 1024
+    out = bytearray()
+    block = start // block_size
+    while block * block_size < end:
+        data = hashlib.sha256(f"{name}:{block}".encode()).digest() * (block_size // 32)
+        block_start = block * block_size
+        out += data[max(0, start - block_start):end - block_start]
+        block += 1
+    return bytes(out)
+
+def make_handler(state):
+    """Build a request handler class bound to the simulator state."""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            """Keep the console quiet under load."""
+
+        def _send_json(self, status, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _graph_error(self, status, code, message, subcode=None):
+            error = {"message": message, "type": "OAuthException", "code": code}
+            if subcode:
+                error["error_subcode"] = subcode
+            self._send_json(status, {"error": error})
+
+        def _params(self):
+            parsed = urlparse(self.path)
+            params = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+            length = int(self.headers.get("Content-Length") or 0)
+            if length:
+                body = self.rfile.read(length).decode()
+                params.update({key: values[0] for key, values in parse_qs(body).items()})
+            # Accept an optional version prefix such as /v20.0
+            path = re.sub(r"^/v\d+\.\d+", "", parsed.path).rstrip("/")
+            return path, params
+
+        def _simulate_network(self):
+            """Add latency and random transient errors. Returns True if an error was sent."""
+            with state.lock:
+                state.requests += 1
+            if state.latency:
+                time.sleep(random.uniform(0.5, 1.5) * state.latency)
+            if state.error_rate and random.random() < state.error_rate:
+                self._send_json(503, {"error": {"message": "Service temporarily unavailable", "code": 2}})
+                return True
+            return False
+
+        def do_GET(self):
+            path, params = self._params()
+            if path.startswith("/videos/"):
+                return self._serve_video(path)
+            if path == "/_stats":
+                with state.lock:
+                    return self._send_json(200, {"publishes": state.publishes, "requests": state.requests,
+                                                 "video_requests": state.video_requests})
+            if self._simulate_network():
+                return
+            node, _, edge = path.lstrip("/").partition("/")
+            if node in state.pages and not edge:
+                return self._send_json(200, {"instagram_business_account": {"id": state.pages[node]}, "id": node})
+            if node in state.instagram_ids and edge == "content_publishing_limit":
+                with state.lock:
+                    usage = state.quota_usage(node)
+                return self._send_json(200, {"data": [{
+                    "quota_usage": usage,
+                    "config": {"quota_total": state.quota_total, "quota_duration": state.quota_duration},
+                }]})
+            if node in state.instagram_ids and edge == "media":
+                return self._list_media(node, params)
+            container_id = path.lstrip("/")
+            with state.lock:
+                container = state.containers.get(container_id)
+            if container is None:
+                return self._graph_error(400, 100, "Unsupported get request")
+            if container["published"]:
+                status = "PUBLISHED"
+            elif container["fails"] and time.time() >= container["ready_at"]:
+                status = "ERROR"
+            elif time.time() >= container["ready_at"]:
+                status = "FINISHED"
+            else:
+                status = "IN_PROGRESS"
+            return self._send_json(200, {"status_code": status, "id": container_id})
+
+        def _list_media(self, instagram_id, params):
+            """Serve a page of an account's media; cursors are offsets into the listing."""
+            media = state.media_listing(instagram_id, f"http://{self.headers.get('Host')}")
+            limit = min(int(params.get("limit") or 25), 100)
+            after = params.get("after")
+            if after and not after.startswith("offset-"):
+                return self._graph_error(400, 100, "Invalid cursor")
+            start = int(after[len("offset-"):]) if after else 0
+            page = media[start:start + limit]
+            paging = {"cursors": {"before": f"offset-{start}", "after": f"offset-{start + len(page)}"}}
+            if start + len(page) < len(media):
+                paging["next"] = f"http://{self.headers.get('Host')}/{instagram_id}/media?limit={limit}&after=offset-{start + len(page)}"
+            return self._send_json(200, {"data": page, "paging": paging})
+
+        def do_POST(self):
+            path, params = self._params()
+            if self._simulate_network():
+                return
+            instagram_id, _, edge = path.lstrip("/").partition("/")
+            if instagram_id not in state.instagram_ids:
+                return self._graph_error(400, 100, "Unsupported post request")
+            if edge == "media":
+                if not params.get("video_url") and not params.get("image_url"):
+                    return self._graph_error(400, 100, "Missing media URL")
+                container_id = state.next_id()
+                with state.lock:
+                    state.containers[container_id] = {
+                        "instagram_id": instagram_id,
+                        "video_url": params.get("video_url") or params.get("image_url"),
+                        "created_at": time.time(),
+                        "ready_at": time.time() + state.processing_delay,
+                        "fails": random.random() < state.container_error_rate,
+                        "published": False,
+                    }
+                return self._send_json(200, {"id": container_id})
+            if edge == "media_publish":
+                container_id = params.get("creation_id")
+                with state.lock:
+                    container = state.containers.get(container_id)
+                    if container is None or container["instagram_id"] != instagram_id:
+                        return self._graph_error(400, 100, "Invalid creation ID")
+                    if time.time() < container["ready_at"] or container["fails"]:
+                        return self._graph_error(400, 9007, "Media is not ready to be published")
+                    if container["published"]:
+                        return self._graph_error(400, 100, "Media already published")
+                    if state.quota_usage(instagram_id) >= state.quota_total:
+                        return self._graph_error(400, 9, "Application request limit reached", subcode=2207042)
+                    container["published"] = True
+                    media_id = state.next_id()
+                    state.publishes.append({
+                        "instagram_id": instagram_id,
+                        "media_id": media_id,
+                        "container_id": container_id,
+                        "video_url": container["video_url"],
+                        "created_at": container["created_at"],
+                        "published_at": time.time(),
+                    })
+                return self._send_json(200, {"id": media_id})
+            return self._graph_error(400, 100, "Unsupported post request")
+
+        def do_HEAD(self):
+            path, _ = self._params()
+            if not path.startswith("/videos/"):
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                return self.end_headers()
+            self.send_response(200)
+            self.send_header("Content-Type", "video/mp4")
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Content-Length", str(state.video_size))
+            self.end_headers()
+
+        def _serve_video(self, path):
+            """Serve a fake video, honouring single byte ranges."""
+            name = path.rsplit("/", 1)[-1]
+            size = state.video_size
+            with state.lock:
+                state.video_requests += 1
+            start, end = 0, size
+            match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+            if match:
+                start = int(match.group(1))
+                end = min(size, int(match.group(2)) + 1) if match.group(2) else size
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{end - 1}/{size}")
+            else:
+                self.send_response(200)
+            self.send_header("Content-Type", "video/mp4")
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Content-Length", str(end - start))
+            self.end_headers()
+            chunk = 256 * 1024
+            # A stalled response sends half of its bytes and then hangs without closing the connection
+            stall_at = (start + end) // 2 if state.stall_rate and random.random() < state.stall_rate else None
+            for offset in range(start, end, chunk):
+                if stall_at is not None and offset >= stall_at:
+                    time.sleep(3600)
+                    return
+                data = video_bytes(name, offset, min(end, offset + chunk))
+                self.wfile.write(data)
+                if state.video_bandwidth:
+                    time.sleep(len(data) / state.video_bandwidth)
+
+    return Handler
+
+def start_simulator(host="127.0.0.1", port=0, **options):
+    """
+    Start the simulator in a background thread.
+
+    Args:
+        host (str): Interface to listen on.
+        port (int): Port to listen on, 0 picks a free one.
+        **options: Passed on to ``SimulatorState``.
+
+    Returns:
+        tuple: The running server and its state; the URL is ``http://host:server.server_port``.
+    """
+    state = SimulatorState(**options)
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="graph-simulator", daemon=True).start()
+    return server, state
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency", type=float, default=0.0, help="Average added latency per Graph API call, in seconds.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of Graph API calls answered with a 503.")
+    parser.add_argument("--container-error-rate", type=float, default=0.0, help="Fraction of containers that end in ERROR.")
+    parser.add_argument("--processing-delay", type=float, default=3.0, help="Seconds before a container is FINISHED.")
+    parser.add_argument("--quota-total", type=int, default=50, help="Publishes allowed per account and quota window.")
+    parser.add_argument("--accounts", type=int, default=1, help="Number of simulated Pages and Instagram accounts.")
+    parser.add_argument("--video-size", type=int, default=2 * 1024 * 1024, help="Size of the served videos in bytes.")
+    parser.add_argument("--video-bandwidth", type=int, default=0, help="Bytes per second per video connection (0 for unlimited).")
+    parser.add_argument("--media-count", type=int, default=0, help="Media each account published before the simulator started.")
+    parser.add_argument("--stall-rate", type=float, default=0.0, help="Fraction of video responses that stall halfway.")
+    args = parser.parse_args()
+    server, _ = start_simulator(
+        args.host, args.port,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        container_error_rate=args.container_error_rate,
+        processing_delay=args.processing_delay,
+        quota_total=args.quota_total,
+        video_size=args.video_size,
+        video_bandwidth=args.video_bandwidth,
+        stall_rate=args.stall_rate,
+        accounts=args.accounts,
+        media_count=args.media_count,
+    )
+    print(f"Graph API simulator listening on http://{args.host}:{server.server_port} (PAGE_ID={PAGE_ID})")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
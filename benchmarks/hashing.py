@@ -0,0 +1,102 @@
+"""
+Micro-benchmark of video hashing under concurrent downloads.
+
+Compares the old hashing (SHA-256 fed 8 KiB at a time on the download thread) with the
+versioned engine from ``app.hashing`` (large buffers hashed on the hashing pool) for each
+hash version. Several threads stream the same in-memory video at once, as concurrent
+downloads would, and a probe thread measures how long a tiny piece of Python work waits
+for the GIL meanwhile, standing in for request handling.
+
+Usage:
+    python benchmarks/hashing.py --size-mb 64 --threads 4
+"""
+import argparse
+import hashlib
+import os
+import statistics
+import sys
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app.hashing import HASH_ALGORITHMS, StreamHasher  # noqa: E402
+
+# Size of the chunks the downloader hands to its sink
+CHUNK_SIZE = 1024 * 1024
+
+def feed(data, sink):
+    """Hand ``data`` to a sink the way the downloader does: in chunks read into a reused buffer."""
+    buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(data)
+    for start in range(0, len(data), CHUNK_SIZE):
+        chunk = view[start:start + CHUNK_SIZE]
+        buffer[:len(chunk)] = chunk
+        sink(memoryview(buffer)[:len(chunk)])
+
+def old_hash(data):
+    """Hash the way the app used to: SHA-256, 8 KiB per update, on the calling thread."""
+    hash_func = hashlib.new("sha256")
+
+    def update(chunk):
+        for offset in range(0, len(chunk), 8192):
+            hash_func.update(chunk[offset:offset + 8192])
+
+    feed(data, update)
+    return hash_func.hexdigest()
+
+def engine_hash(data, version):
+    """Hash with the versioned engine."""
+    hasher = StreamHasher([version])
+    feed(data, hasher)
+    return hasher.hexdigests()[version]
+
+def measure(threads, data, hash_video):
+    """
+    Hash ``data`` on ``threads`` threads at once.
+
+    Returns:
+        tuple: Throughput in MiB/s and the p99 delay in milliseconds of a probe thread's 1 ms sleeps.
+    """
+    done = threading.Event()
+    delays = []
+
+    def probe():
+        while not done.is_set():
+            start = time.perf_counter()
+            time.sleep(0.001)
+            delays.append(time.perf_counter() - start - 0.001)
+
+    probe_thread = threading.Thread(target=probe)
+    probe_thread.start()
+    workers = [threading.Thread(target=hash_video, args=(data,)) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    done.set()
+    probe_thread.join()
+    p99 = statistics.quantiles(delays, n=100)[98] if len(delays) >= 100 else max(delays, default=0)
+    return threads * len(data) / elapsed / 1024 / 1024, p99 * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=int, default=64, help="Size of the video hashed by each thread.")
+    parser.add_argument("--threads", type=int, default=4, help="Concurrent downloads.")
+    args = parser.parse_args()
+    data = os.urandom(args.size_mb * 1024 * 1024)
+
+    results = [("sha256, 8 KiB updates (old)",) + measure(args.threads, data, old_hash)]
+    for version, (name, _) in HASH_ALGORITHMS.items():
+        results.append((f"v{version} {name}, engine",) + measure(args.threads, data, lambda d, v=version: engine_hash(d, v)))
+
+    print(f"{args.threads} thread(s) hashing {args.size_mb} MiB each")
+    print(f"{'':32} {'MiB/s':>10} {'probe p99 ms':>14}")
+    for label, throughput, p99 in results:
+        print(f"{label:32} {throughput:10.0f} {p99:14.2f}")
+
+if __name__ == "__main__":
+    main()
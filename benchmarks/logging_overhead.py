@@ -0,0 +1,88 @@
+"""
+Micro-benchmark of the logging cost paid by the calling thread.
+
+Compares the old setup (f-string messages written synchronously to a rotating file) with
+the queued pipeline from ``app.logs`` for enabled, disabled and sampled messages, from
+several threads at once as the reel workers would.
+
+Usage:
+    python benchmarks/logging_overhead.py --records 20000 --threads 4
+"""
+import argparse
+import logging
+import sys
+import tempfile
+import threading
+import time
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app.logs import configure_logging, stop_logging  # noqa: E402
+
+URL = "https://scontent.cdninstagram.com/o1/v/t16/f2/m69/An" + "x" * 180 + ".mp4?efg=eyJ2ZW5jb2RlX3RhZyI6"
+
+def measure(threads, records, log):
+    """Run ``log(i)`` ``records`` times on each of ``threads`` threads and return microseconds per call."""
+    barrier = threading.Barrier(threads + 1)
+
+    def run():
+        barrier.wait()
+        for i in range(records):
+            log(i)
+
+    workers = [threading.Thread(target=run) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for worker in workers:
+        worker.join()
+    return (time.perf_counter() - start) / (threads * records) * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=20000, help="Log calls per thread.")
+    parser.add_argument("--threads", type=int, default=4)
+    args = parser.parse_args()
+    directory = tempfile.mkdtemp()
+
+    # The old setup: DEBUG logger, synchronous text file and stream handlers, f-strings
+    old = logging.getLogger("bench.old")
+    old.setLevel(logging.DEBUG)
+    old.propagate = False
+    handler = RotatingFileHandler(f"{directory}/old.log", maxBytes=5*1024*1024, backupCount=3)
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    old.addHandler(handler)
+    old_info = measure(args.threads, args.records, lambda i: old.info(f"Container ID {i} status: IN_PROGRESS"))
+    old_debug = measure(args.threads, args.records, lambda i: old.debug(f"Creating media container: URL={URL}, caption=Reel {i}"))
+
+    configure_logging({
+        "LOG_LEVEL": "INFO",
+        "LOG_LEVELS": {},
+        "LOG_FORMAT": "json",
+        "LOG_FILE": f"{directory}/new.log",
+        "LOG_QUEUE_SIZE": 10000,
+        "LOG_SAMPLING": {"LOLify.poll": 0.1},
+    })
+    logging.getLogger("LOLify").handlers[0].queue.maxsize = 0  # Measure queueing, not dropping
+    logger = logging.getLogger("LOLify")
+    poll_logger = logging.getLogger("LOLify.poll")
+    new_info = measure(args.threads, args.records, lambda i: logger.info("Container ID %s status: %s", i, "IN_PROGRESS"))
+    new_debug = measure(args.threads, args.records, lambda i: logger.debug("Creating %s media container for %s", "REELS", URL))
+    new_sampled = measure(args.threads, args.records, lambda i: poll_logger.info("Container ID %s status: %s", i, "IN_PROGRESS"))
+    drain_start = time.perf_counter()
+    stop_logging()
+    drain = time.perf_counter() - drain_start
+
+    print(f"{args.threads} threads x {args.records} records")
+    print(f"Synchronous file, enabled:     {old_info:7.2f} us/call")
+    print(f"Synchronous file, debug:       {old_debug:7.2f} us/call")
+    print(f"Queued JSON, enabled:          {new_info:7.2f} us/call")
+    print(f"Queued JSON, disabled debug:   {new_debug:7.2f} us/call")
+    print(f"Queued JSON, sampled 1 in 10:  {new_sampled:7.2f} us/call")
+    print(f"Listener drain after the run:  {drain:7.2f} s")
+
+if __name__ == "__main__":
+    main()
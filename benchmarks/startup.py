@@ -0,0 +1,94 @@
+"""
+Startup benchmark: how long a fresh process takes to import the app and run create_app().
+
+Every trial runs in a new interpreter, as a gunicorn worker would boot, against an empty
+temporary SQLite database with the in-process workers and the metadata warm-up disabled,
+so only the app's own startup cost is measured. Reports the median over the trials, the
+number of modules loaded, and whether heavy modules that should be deferred (requests,
+Alembic, the PostgreSQL dialect) were imported.
+
+With ``--max-import`` / ``--max-create`` the script exits with status 1 when the median
+exceeds the given budget, so it can run as a startup regression test.
+
+Usage:
+    python benchmarks/startup.py --trials 10
+    python benchmarks/startup.py --max-import 1.0 --max-create 0.3
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Modules that must not be imported at startup
+DEFERRED = ["requests", "alembic", "flask_migrate", "sqlalchemy.dialects.postgresql"]
+
+# Runs in the child process and prints its timings as JSON
+PROBE = f"""
+import json, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+application = app.create_app()
+created = time.perf_counter()
+print(json.dumps({{
+    "import": imported - start,
+    "create_app": created - imported,
+    "modules": len(sys.modules),
+    "deferred": [name for name in {DEFERRED!r} if name in sys.modules],
+}}))
+"""
+
+def run_trial(directory):
+    """Boot the app once in a new interpreter and return its timings."""
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": str(ROOT),
+        "DATABASE_URL": f"sqlite:///{directory}/startup.db",
+        "MEDIA_CACHE_DIR": f"{directory}/media_cache",
+        "LOG_FILE": "",
+        "LOG_LEVEL": "ERROR",
+        "WORKER_THREADS": "0",
+        "PAGE_ID": "",  # Skips the metadata warm-up request
+    })
+    result = subprocess.run([sys.executable, "-c", PROBE], cwd=directory, env=env,
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--trials", type=int, default=7, help="Number of processes to boot.")
+    parser.add_argument("--max-import", type=float, help="Fail if the median import time exceeds this many seconds.")
+    parser.add_argument("--max-create", type=float, help="Fail if the median create_app() time exceeds this many seconds.")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="startup-")
+    run_trial(directory)  # Warm the OS file cache and write the bytecode cache
+    trials = [run_trial(directory) for _ in range(args.trials)]
+    import_time = statistics.median(trial["import"] for trial in trials)
+    create_time = statistics.median(trial["create_app"] for trial in trials)
+    deferred = sorted({name for trial in trials for name in trial["deferred"]})
+
+    print(f"{args.trials} trials")
+    print(f"import app:           {import_time * 1000:7.1f} ms (median)")
+    print(f"create_app():         {create_time * 1000:7.1f} ms (median)")
+    print(f"Total:                {(import_time + create_time) * 1000:7.1f} ms")
+    print(f"Modules loaded:       {trials[-1]['modules']}")
+    print(f"Deferred but loaded:  {', '.join(deferred) or 'none'}")
+
+    failed = False
+    if args.max_import is not None and import_time > args.max_import:
+        print(f"FAIL: import time above {args.max_import}s")
+        failed = True
+    if args.max_create is not None and create_time > args.max_create:
+        print(f"FAIL: create_app() time above {args.max_create}s")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+"""
+End-to-end load benchmark for the webhook and reel pipeline.
+
+Starts the Graph API simulator and the app (with its background workers) in this
+process, replays recorded webhook payloads at a target rate and reports:
+
+- webhook ack latency (p50/p95/p99)
+- end-to-end publish latency, from webhook delivery to media_publish (p50/p95/p99)
+- throughput of acknowledged webhooks and published reels
+- video downloads from the CDN, to spot reels fetched more than once
+- admission decisions, and publish latency of a spamming sender against everyone else
+- with ``--accounts``, publishes and publish latency of a busy account against the others
+- peak RSS of the process
+
+Payload files are JSON lines; ``{n}``, ``{sender}`` and ``{video_url}`` are substituted
+for every request, so each replayed payload refers to its own video. With ``--accounts N``
+the recipient is spread over N simulated accounts: the first is the app's default account,
+the others are registered in its account table.
+
+Usage:
+    python benchmarks/webhook_load.py --requests 200 --rate 20 --workers 4
+    python benchmarks/webhook_load.py --accounts 4 --hot-account-ratio 0.7 --quota-total 20
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_DIR.parent))
+
+from graph_simulator import INSTAGRAM_ID, PAGE_ID, simulated_accounts, start_simulator  # noqa: E402
+
+def percentile(values, fraction):
+    """Get the given percentile of a list of numbers (nearest rank)."""
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def load_payloads(path):
+    """Read the payload templates from a JSON lines file."""
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+def pick_account(n, accounts, hot_ratio):
+    """Get the index of the account request ``n`` is sent to; account 0 is the busy one when ``hot_ratio`` is set."""
+    if hot_ratio > 0:
+        return 0 if (n * 3571 % 100) < hot_ratio * 100 else 1 + n % max(1, accounts - 1)
+    return n % accounts
+
+def render(template, n, senders, video_base, duplicate_ratio, spammer_ratio=0.0, instagram_id=INSTAGRAM_ID):
+    """Fill in a payload template for request ``n``; sender 0 is the spammer when ``spammer_ratio`` is set."""
+    video = n if duplicate_ratio <= 0 or (n * 7919 % 100) >= duplicate_ratio * 100 else 0
+    video_url = f"{video_base}/videos/reel-{video}.mp4"
+    if spammer_ratio > 0:
+        sender = 0 if (n * 6151 % 100) < spammer_ratio * 100 else 1 + n % max(1, senders - 1)
+    else:
+        sender = n % senders
+    payload = template.replace("{n}", str(n)).replace("{sender}", str(sender)).replace("{video_url}", video_url)
+    payload = payload.replace(INSTAGRAM_ID, instagram_id)
+    return json.loads(payload), video_url, sender
+
+def start_app(simulator_url, args):
+    """Configure the app against the simulator and serve it on a free port."""
+    # Keep benchmark data out of the real database, media cache and log file
+    database = tempfile.NamedTemporaryFile(suffix=".db", delete=False)
+    os.environ.update({
+        "DATABASE_URL": f"sqlite:///{database.name}",
+        "MEDIA_CACHE_DIR": tempfile.mkdtemp(prefix="media-cache-"),
+        "LOG_FILE": "",
+        "GRAPH_API_BASE": f"{simulator_url}/v20.0",
+        "PAGE_ID": PAGE_ID,
+        "ACCESS_TOKEN": "benchmark-token",
+        "VERIFY_TOKEN": "benchmark-verify",
+        "WORKER_THREADS": str(args.workers),
+        "WORKER_POLL_INTERVAL": "1",
+        "CONTAINER_POLL_INITIAL": str(args.poll_initial),
+        "PUBLISH_QUOTA_LIMIT": str(args.quota_total),
+        "SENDER_RATE_LIMIT": str(args.sender_rate),
+        "SENDER_BURST": str(args.sender_burst),
+        "INTAKE_QUEUE_SIZE": str(args.intake_size),
+        "JOB_HEARTBEAT_INTERVAL": "1",  # Start the pools of the registered accounts right away
+    })
+    from werkzeug.serving import make_server
+    from app import create_app, db
+
+    from app.models import Account
+
+    from app.worker import start_workers
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        # The first simulated account is the default one, register the others
+        for index, (page_id, instagram_id) in enumerate(simulated_accounts(args.accounts)[1:], 1):
+            db.session.add(Account(name=f"account-{index}", page_id=page_id, instagram_id=instagram_id,
+                                   access_token="benchmark-token", worker_threads=args.workers))
+        db.session.commit()
+    if args.workers > 0:
+        start_workers(app)  # As the gunicorn hook does
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)  # Skip per-request access logs
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="app-server", daemon=True).start()
+    return server, database.name
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--payloads", default=str(BENCH_DIR / "payloads" / "reels.jsonl"))
+    parser.add_argument("--requests", type=int, default=100, help="Number of webhook deliveries to send.")
+    parser.add_argument("--rate", type=float, default=10.0, help="Target deliveries per second.")
+    parser.add_argument("--concurrency", type=int, default=16, help="Maximum deliveries in flight.")
+    parser.add_argument("--senders", type=int, default=10, help="Number of distinct senders.")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.0, help="Fraction of deliveries that reuse the same video.")
+    parser.add_argument("--redelivery-ratio", type=float, default=0.0, help="Fraction of deliveries sent again, as Meta does on slow acks.")
+    parser.add_argument("--spammer-ratio", type=float, default=0.0, help="Fraction of deliveries sent by a single sender.")
+    parser.add_argument("--sender-rate", type=float, default=0.0, help="SENDER_RATE_LIMIT for the app, in reels per hour (0 for unlimited).")
+    parser.add_argument("--sender-burst", type=int, default=10, help="SENDER_BURST for the app.")
+    parser.add_argument("--intake-size", type=int, default=100000, help="INTAKE_QUEUE_SIZE for the app.")
+    parser.add_argument("--workers", type=int, default=4, help="WORKER_THREADS for the app, and worker threads of every other account.")
+    parser.add_argument("--accounts", type=int, default=1, help="Number of Instagram accounts the deliveries are spread over.")
+    parser.add_argument("--hot-account-ratio", type=float, default=0.0, help="Fraction of deliveries sent to the first account.")
+    parser.add_argument("--latency", type=float, default=0.02, help="Simulated Graph API latency in seconds.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Simulated Graph API 503 rate.")
+    parser.add_argument("--processing-delay", type=float, default=2.0, help="Simulated container processing time.")
+    parser.add_argument("--poll-initial", type=float, default=0.5, help="CONTAINER_POLL_INITIAL for the app.")
+    parser.add_argument("--quota-total", type=int, default=100000, help="Publishes allowed per account by the simulator and the app.")
+    parser.add_argument("--video-size", type=int, default=2 * 1024 * 1024)
+    parser.add_argument("--video-bandwidth", type=int, default=0, help="Simulated bytes per second per video connection.")
+    parser.add_argument("--stall-rate", type=float, default=0.0, help="Fraction of video responses that stall halfway.")
+    parser.add_argument("--timeout", type=float, default=300.0, help="Seconds to wait for publishes to complete.")
+    args = parser.parse_args()
+
+    simulator, state = start_simulator(
+        latency=args.latency,
+        error_rate=args.error_rate,
+        processing_delay=args.processing_delay,
+        quota_total=args.quota_total,
+        video_size=args.video_size,
+        video_bandwidth=args.video_bandwidth,
+        stall_rate=args.stall_rate,
+        accounts=args.accounts,
+    )
+    instagram_ids = [instagram_id for _, instagram_id in simulated_accounts(args.accounts)]
+    simulator_url = f"http://127.0.0.1:{simulator.server_port}"
+    server, database = start_app(simulator_url, args)
+    webhook_url = f"http://127.0.0.1:{server.server_port}/webhook/"
+
+    templates = load_payloads(args.payloads)
+    session = requests.Session()
+    sent_at = {}  # video URL -> first delivery time
+    senders = {}  # video URL -> sender
+    accounts = {}  # video URL -> Instagram ID of the account it was sent to
+    decisions = {}  # admission decision -> count
+    dropped = set()  # video URLs dropped by admission control
+    ack_latencies = []
+    failures = []
+    lock = threading.Lock()
+
+    def deliver(n, template):
+        instagram_id = instagram_ids[pick_account(n, args.accounts, args.hot_account_ratio)]
+        payload, video_url, sender = render(template, n, args.senders, simulator_url, args.duplicate_ratio,
+                                            args.spammer_ratio, instagram_id)
+        start = time.monotonic()
+        items = []
+        try:
+            response = session.post(webhook_url, json=payload, timeout=30)
+            ok = response.status_code == 200
+            if ok:
+                items = response.json().get("items", [])
+        except requests.RequestException:
+            ok = False
+        elapsed = time.monotonic() - start
+        with lock:
+            sent_at.setdefault(video_url, time.time() - elapsed)
+            senders.setdefault(video_url, sender)
+            accounts.setdefault(video_url, instagram_id)
+            for item in items:
+                decisions[item.get("status")] = decisions.get(item.get("status"), 0) + 1
+                if item.get("status") == "dropped":
+                    dropped.add(video_url)
+            if ok:
+                ack_latencies.append(elapsed)
+            else:
+                failures.append(n)
+
+    print(f"Sending {args.requests} deliveries at {args.rate}/s to {webhook_url}")
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for n, template in zip(range(1, args.requests + 1), itertools.cycle(templates)):
+            # Pace deliveries to the target rate
+            delay = started + (n - 1) / args.rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(deliver, n, template)
+            if args.redelivery_ratio > 0 and (n * 104729 % 100) < args.redelivery_ratio * 100:
+                executor.submit(deliver, n, template)  # Same message ID and timestamp
+    send_duration = time.monotonic() - started
+
+    # Wait for every distinct video to be published, except those dropped by admission control
+    expected = len(set(sent_at) - dropped)
+    deadline = time.monotonic() + args.timeout
+    while time.monotonic() < deadline:
+        with state.lock:
+            published = len({publish["video_url"] for publish in state.publishes})
+        if published >= expected:
+            break
+        time.sleep(0.2)
+    total_duration = time.monotonic() - started
+
+    with state.lock:
+        publishes = list(state.publishes)
+        graph_requests = state.requests
+        video_requests = state.video_requests
+    publish_latencies = [
+        publish["published_at"] - sent_at[publish["video_url"]]
+        for publish in publishes if publish["video_url"] in sent_at
+    ]
+    spammer_latencies = [
+        publish["published_at"] - sent_at[publish["video_url"]]
+        for publish in publishes if publish["video_url"] in sent_at and senders[publish["video_url"]] == 0
+    ]
+    other_latencies = [
+        publish["published_at"] - sent_at[publish["video_url"]]
+        for publish in publishes if publish["video_url"] in sent_at and senders[publish["video_url"]] != 0
+    ]
+    account_latencies = {}
+    for publish in publishes:
+        if publish["video_url"] in sent_at:
+            account_latencies.setdefault(publish["instagram_id"], []).append(publish["published_at"] - sent_at[publish["video_url"]])
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    if sys.platform == "darwin":
+        peak_rss_mb /= 1024  # ru_maxrss is in bytes on macOS
+
+    print()
+    print(f"Deliveries:        {len(ack_latencies)} ok, {len(failures)} failed in {send_duration:.1f}s")
+    print(f"Ack latency:       p50 {percentile(ack_latencies, .50) * 1000:.1f} ms  "
+          f"p95 {percentile(ack_latencies, .95) * 1000:.1f} ms  p99 {percentile(ack_latencies, .99) * 1000:.1f} ms")
+    print(f"Ack throughput:    {len(ack_latencies) / send_duration:.1f} deliveries/s")
+    print(f"Published:         {len(publishes)} of {expected} distinct videos in {total_duration:.1f}s")
+    print(f"Publish latency:   p50 {percentile(publish_latencies, .50):.2f} s  "
+          f"p95 {percentile(publish_latencies, .95):.2f} s  p99 {percentile(publish_latencies, .99):.2f} s")
+    print(f"Publish throughput: {len(publishes) / total_duration:.2f} reels/s")
+    print(f"Graph API calls:   {graph_requests}")
+    print(f"Video downloads:   {video_requests} for {expected} distinct videos")
+    print(f"Admission:         {', '.join(f'{count} {status}' for status, count in sorted(decisions.items()))}")
+    if args.spammer_ratio > 0:
+        print(f"Publish p50:       spammer {percentile(spammer_latencies, .50):.2f} s  others {percentile(other_latencies, .50):.2f} s")
+    if args.accounts > 1:
+        for index, instagram_id in enumerate(instagram_ids):
+            latencies = account_latencies.get(instagram_id, [])
+            sent = sum(1 for video_url in set(sent_at) - dropped if accounts[video_url] == instagram_id)
+            print(f"Account {index}:         {len(latencies)} of {sent} published, p50 {percentile(latencies, .50):.2f} s")
+    print(f"Peak RSS:          {peak_rss_mb:.1f} MiB")
+
+    server.shutdown()
+    simulator.shutdown()
+    os.remove(database)
+
+if __name__ == "__main__":
+    main()
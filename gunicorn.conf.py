@@ -0,0 +1,14 @@
+# Gunicorn settings, read from the working directory when gunicorn starts
+
+def post_worker_init(worker):
+    """
+    Start the background job workers in each gunicorn worker once it has loaded the app.
+
+    Workers are started here rather than in create_app(), so that ``flask`` commands and
+    the gunicorn master (with ``--preload``) never run them. Set WORKER_THREADS to 0 to
+    leave the job queue to separate ``flask worker`` processes.
+    """
+    app = worker.wsgi
+    if app.config["WORKER_THREADS"] > 0:
+        from app.worker import start_workers
+        start_workers(app)
@@ -1,4 +1,5 @@
 # Import the create_app function from the app package
+import os
 from app import create_app
 
 # Create the Flask application instance using the factory function
@@ -7,6 +8,10 @@ app = create_app()
 # Entry point for running the application
 if __name__ == '__main__':
     """
-    Run the Flask application in debug mode on port 8000.
+    Run the Flask application in debug mode on port 8000, with its background workers.
     """
+    # The reloader runs the app in a child process; only that one works through the job queue
+    if app.config["WORKER_THREADS"] > 0 and os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        from app.worker import start_workers
+        start_workers(app)
     app.run(debug=True, port=8000)
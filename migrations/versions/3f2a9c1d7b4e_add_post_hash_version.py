@@ -0,0 +1,42 @@
+"""Add post.hash_version with a server default
+
+Rows stored before hashes were versioned are SHA-256, version 1. The column is added with
+that default, or given it if an autogenerated revision already added it without one.
+New databases get the column when their tables are created, so nothing is done for them.
+
+Revision ID: 3f2a9c1d7b4e
+Revises:
+Create Date: 2026-10-18 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f2a9c1d7b4e'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    if 'post' not in inspector.get_table_names():
+        return
+    columns = {column['name'] for column in inspector.get_columns('post')}
+    if 'hash_version' not in columns:
+        with op.batch_alter_table('post') as batch_op:
+            batch_op.add_column(sa.Column('hash_version', sa.Integer(), nullable=False, server_default='1'))
+        return
+    op.execute("UPDATE post SET hash_version = 1 WHERE hash_version IS NULL")
+    with op.batch_alter_table('post') as batch_op:
+        batch_op.alter_column('hash_version', existing_type=sa.Integer(), nullable=False, server_default='1')
+
+
+def downgrade():
+    inspector = sa.inspect(op.get_bind())
+    if 'post' not in inspector.get_table_names():
+        return
+    with op.batch_alter_table('post') as batch_op:
+        batch_op.drop_column('hash_version')
@@ -0,0 +1,37 @@
+# Shared fixtures: one application on a temporary SQLite database, emptied before every test
+import os
+import tempfile
+
+import pytest
+
+# The settings are read once, when app.config is imported, so they are set before any app import
+_TMP_DIR = tempfile.mkdtemp(prefix="lolify-tests-")
+os.environ.update({
+    "DATABASE_URL": f"sqlite:///{os.path.join(_TMP_DIR, 'test.db')}",
+    "MEDIA_CACHE_DIR": os.path.join(_TMP_DIR, "media-cache"),
+    "LOG_FILE": "",
+    "PAGE_ID": "test-page",
+    "ACCESS_TOKEN": "test-token",
+    "WORKER_THREADS": "0",
+})
+
+@pytest.fixture(scope="session")
+def app():
+    """The application, created once for the whole test run."""
+    from app import create_app
+    return create_app()
+
+@pytest.fixture
+def db(app):
+    """The database with empty tables, inside an application context."""
+    from app import db
+    from app.config import get_settings
+    from app.hashfilter import configure_hash_filter
+    settings = get_settings()
+    with app.app_context():
+        db.create_all()
+        # Start from an empty known-hash filter too, as the tables are empty
+        configure_hash_filter(settings.HASH_FILTER_CAPACITY, settings.HASH_FILTER_ERROR_RATE, settings.HASH_FILTER_RECENT)
+        yield db
+        db.session.remove()
+        db.drop_all()
@@ -0,0 +1,91 @@
+# Tests for the per-sender GCRA rate limit and the intake queue bound
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from app.admission import (DEFERRED, INTAKE_FULL, QUEUED, SENDER_OVER_LIMIT, SENDER_RATE_LIMITED,
+                           admit_reels, schedule_sender, settle_reels)
+from app.models import Job, User
+from app.worker import enqueue_jobs
+
+NOW = datetime(2026, 1, 1, 12, 0)
+
+def make_settings(**overrides):
+    """Admission settings: 60 reels per hour in bursts of 3, deferred up to an hour."""
+    values = dict(SENDER_RATE_LIMIT=60, SENDER_BURST=3, SENDER_MAX_DEFER=3600, INTAKE_QUEUE_SIZE=1000)
+    values.update(overrides)
+    return SimpleNamespace(**values)
+
+def make_user(**overrides):
+    """A sender with the default limits and no reels admitted yet."""
+    values = dict(priority=0, rate_limit=None, burst=None, next_slot=None)
+    values.update(overrides)
+    return SimpleNamespace(**values)
+
+def schedule(count, user=None, settings=None, depth=0):
+    """Schedule ``count`` reels of one sender arriving at NOW."""
+    reels = [{"account_id": None} for _ in range(count)]
+    next_slot, depths = schedule_sender(reels, user or make_user(), NOW, {None: depth}, settings or make_settings())
+    return reels, next_slot, depths
+
+def test_burst_is_queued_then_reels_are_spaced():
+    reels, next_slot, depths = schedule(5)
+    # The burst of 3 runs right away, the next reels wait a minute apart
+    assert [reel["run_after"] for reel in reels] == [None, None, None, NOW + timedelta(minutes=1), NOW + timedelta(minutes=2)]
+    assert [reel["shed_reason"] for reel in reels[3:]] == [SENDER_RATE_LIMITED] * 2
+    assert next_slot == NOW + timedelta(minutes=5)
+    assert depths == {None: 3}  # Deferred reels do not count towards the intake queue
+
+def test_reels_too_far_ahead_are_dropped():
+    reels, next_slot, _ = schedule(5, settings=make_settings(SENDER_MAX_DEFER=60))
+    assert [reel["status"] for reel in reels] == [Job.PENDING] * 4 + [Job.DROPPED]
+    assert reels[4]["shed_reason"] == SENDER_OVER_LIMIT
+    assert next_slot == NOW + timedelta(minutes=4)  # Dropped reels take no slot
+
+def test_slot_recovers_over_time():
+    user = make_user(next_slot=NOW - timedelta(hours=1))
+    reels, next_slot, _ = schedule(1, user=user)
+    assert reels[0]["run_after"] is None
+    assert next_slot == NOW + timedelta(minutes=1)  # An idle sender's slot restarts from now
+
+def test_unlimited_sender_and_per_sender_limits():
+    reels, next_slot, _ = schedule(20, user=make_user(rate_limit=0))
+    assert all(reel["run_after"] is None for reel in reels) and next_slot is None
+    reels, _, _ = schedule(3, user=make_user(burst=1))
+    assert [reel["run_after"] is None for reel in reels] == [True, False, False]
+
+def test_full_intake_queue_drops_regular_senders_only():
+    reels, _, _ = schedule(2, settings=make_settings(INTAKE_QUEUE_SIZE=1), depth=1)
+    assert [(reel["status"], reel["shed_reason"]) for reel in reels] == [(Job.DROPPED, INTAKE_FULL)] * 2
+    reels, _, _ = schedule(2, user=make_user(priority=1), settings=make_settings(INTAKE_QUEUE_SIZE=1), depth=1)
+    assert all(reel["status"] == Job.PENDING for reel in reels)
+    assert reels[0]["priority"] == 1
+
+def webhook_reels(count, sender_id="sender", key="m1"):
+    """Reels as the webhook passes them to admission."""
+    return [{"url": f"http://cdn/{key}-{index}.mp4", "caption": "", "sender_id": sender_id,
+             "delivery_key": f"{key}:{index}", "account_id": None} for index in range(count)]
+
+def test_admit_reels_stores_the_sender_slot(db, monkeypatch):
+    from app.config import get_settings
+    monkeypatch.setattr(get_settings(), "SENDER_BURST", 1)
+    decisions = admit_reels(webhook_reels(2))
+    assert decisions == [QUEUED, DEFERRED]
+    first_slot = User.query.filter_by(instagram_id="sender").one().next_slot
+    assert first_slot is not None
+    assert admit_reels(webhook_reels(1, key="m2")) == [DEFERRED]
+    assert User.query.filter_by(instagram_id="sender").one().next_slot > first_slot
+
+def test_redelivered_reels_give_their_slots_back(db):
+    reels = webhook_reels(2)
+    settle_reels(reels, admit_reels(reels), enqueue_jobs(reels))
+    slot = User.query.filter_by(instagram_id="sender").one().next_slot
+    db.session.commit()
+    # Another process queued the same delivery first: the inserts are skipped
+    redelivered = webhook_reels(2)
+    decisions = admit_reels(redelivered)
+    assert User.query.filter_by(instagram_id="sender").one().next_slot > slot
+    db.session.commit()
+    jobs = enqueue_jobs(redelivered)
+    assert jobs == [None, None]
+    settle_reels(redelivered, decisions, jobs)
+    assert User.query.filter_by(instagram_id="sender").one().next_slot == slot
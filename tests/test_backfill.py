@@ -0,0 +1,119 @@
+# Tests for the backfill of an account's existing media and its resumable checkpoint
+import click
+import pytest
+
+import app.backfill as backfill
+import app.core as core
+from app.accounts import default_credentials
+from app.backfill import run_backfill
+from app.crud import backfill_lease_name, save_backfill_batch, start_backfill
+from app.leases import LeaseLost, acquire_lease, release_lease
+from app.models import Backfill, Post
+
+def make_media(count):
+    """An account history, newest first: every fifth media is an image, the rest are videos."""
+    media = []
+    for index in range(count):
+        item = {"id": f"media-{index}", "caption": f"Post {index}",
+                "timestamp": f"2024-01-{28 - index // 24:02d}T{23 - index % 24:02d}:00:00+0000"}
+        if index % 5 == 4:
+            item.update(media_type="IMAGE", media_url=f"http://cdn/{index}.jpg")
+        else:
+            item.update(media_type="VIDEO", media_url=f"http://cdn/{index}.mp4")
+        media.append(item)
+    return media
+
+class FakeAPI:
+    """Lists a fixed history in pages with ``offset-N`` cursors, failing on request once ``fail_at`` pages were listed."""
+
+    media = []
+    requested = []
+    fail_at = None
+
+    def __init__(self, credentials):
+        pass
+
+    def get_media_page(self, after=None, limit=50):
+        if FakeAPI.fail_at is not None and len(FakeAPI.requested) == FakeAPI.fail_at:
+            raise RuntimeError("Failed to list media: 500")
+        FakeAPI.requested.append(after)
+        start = int(after.split("-")[1]) if after else 0
+        end = start + limit
+        return FakeAPI.media[start:end], f"offset-{end}" if end < len(FakeAPI.media) else None
+
+@pytest.fixture
+def api(monkeypatch):
+    """A fake Graph API over 40 media, with videos "fingerprinted" by their URL."""
+    monkeypatch.setattr(FakeAPI, "media", make_media(40))
+    monkeypatch.setattr(FakeAPI, "requested", [])
+    monkeypatch.setattr(FakeAPI, "fail_at", None)
+    monkeypatch.setattr(core, "InstagramAPI", FakeAPI)
+    downloads = []
+
+    def fingerprint_video(url, version):
+        downloads.append(url)
+        return f"hash-of-{url}", None
+
+    monkeypatch.setattr(backfill, "fingerprint_video", fingerprint_video)
+    monkeypatch.setattr(FakeAPI, "downloads", downloads, raising=False)
+    return FakeAPI
+
+def test_backfill_stores_every_video(db, api):
+    result = run_backfill(default_credentials(), concurrency=2, page_size=5, batch_size=4)
+    assert (result["added"], result["skipped"], result["known"], result["failed"]) == (32, 8, 0, 0)
+    assert Post.query.count() == 32 and len(api.downloads) == 32
+    post = Post.query.filter_by(media_id="media-0").one()
+    assert str(post.created_at) == str(post.published_at) == "2024-01-28 23:00:00"
+    checkpoint = db.session.get(Backfill, "default")
+    assert checkpoint.cursor is None and checkpoint.finished_at is not None
+    assert (checkpoint.media_seen, checkpoint.posts_added) == (40, 32)
+
+def test_interrupted_backfill_resumes_after_its_checkpoint(db, api):
+    api.fail_at = 5
+    with pytest.raises(RuntimeError):
+        run_backfill(default_credentials(), concurrency=2, page_size=5, batch_size=4)
+    checkpoint = db.session.get(Backfill, "default")
+    assert checkpoint.finished_at is None and checkpoint.cursor is not None
+    resume_from = checkpoint.cursor
+    saved = int(resume_from.split("-")[1])
+    assert checkpoint.media_seen == saved and Post.query.count() == checkpoint.posts_added
+
+    api.fail_at = None
+    api.requested.clear()
+    result = run_backfill(default_credentials(), concurrency=2, page_size=5, batch_size=4)
+    assert api.requested[0] == resume_from  # Nothing before the checkpoint is listed again
+    assert Post.query.count() == 32
+    checkpoint = db.session.get(Backfill, "default")
+    assert checkpoint.finished_at is not None and checkpoint.media_seen == 40
+    assert result["added"] + result["duplicate"] == 32 - saved * 4 // 5
+
+def test_finished_backfill_starts_over_and_skips_known_media(db, api):
+    run_backfill(default_credentials(), concurrency=2, page_size=5, batch_size=4)
+    api.downloads.clear()
+    api.requested.clear()
+    result = run_backfill(default_credentials(), concurrency=2, page_size=5, batch_size=4)
+    assert api.requested[0] is None
+    assert (result["known"], result["added"]) == (32, 0) and api.downloads == []
+
+def test_restart_discards_an_unfinished_checkpoint(db, api):
+    api.fail_at = 5
+    with pytest.raises(RuntimeError):
+        run_backfill(default_credentials(), concurrency=2, page_size=5, batch_size=4)
+    assert start_backfill("default", restart=True).cursor is None
+
+def test_only_one_backfill_per_account(db, api):
+    token = acquire_lease(backfill_lease_name("default"), 60)
+    with pytest.raises(click.ClickException):
+        run_backfill(default_credentials())
+    release_lease(backfill_lease_name("default"), token)
+
+def test_checkpoint_is_fenced_by_the_lease(db):
+    start_backfill("default")
+    token = acquire_lease(backfill_lease_name("default"), 60)
+    release_lease(backfill_lease_name("default"), token)
+    acquire_lease(backfill_lease_name("default"), 60)  # Another run, under a new token
+    rows = [{"caption": "", "hashed": "abc", "hash_version": 1, "fingerprint": None, "media_id": "media-0",
+             "job_id": None, "published_at": None, "created_at": None}]
+    with pytest.raises(LeaseLost):
+        save_backfill_batch("default", token, rows, "offset-5", 5, 0)
+    assert Post.query.count() == 0 and db.session.get(Backfill, "default").cursor is None
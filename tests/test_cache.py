@@ -0,0 +1,52 @@
+# Tests for the in-process TTL cache
+import threading
+
+from app.cache import TTLCache
+
+def test_misses_of_one_key_share_a_single_load():
+    cache = TTLCache(60)
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def loader():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "value"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_load("key", loader))) for _ in range(5)]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert results == ["value"] * 5
+    assert len(calls) == 1
+
+def test_a_slow_load_does_not_hold_other_keys():
+    cache = TTLCache(60)
+    started, release = threading.Event(), threading.Event()
+
+    def slow():
+        started.set()
+        release.wait(5)
+        return "slow"
+
+    thread = threading.Thread(target=cache.get_or_load, args=("slow", slow))
+    thread.start()
+    started.wait(5)
+    try:
+        # Loaded while the other key's load is still in flight
+        assert cache.get_or_load("fast", lambda: "fast") == "fast"
+    finally:
+        release.set()
+        thread.join(5)
+    assert cache.get("slow") == "slow"
+
+def test_failed_loads_are_not_cached():
+    cache = TTLCache(60)
+    assert cache.get_or_load("key", lambda: None) is None
+    assert cache.get_or_load("key", lambda: "value") == "value"
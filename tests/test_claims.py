@@ -0,0 +1,58 @@
+# Tests for the atomic hash claim and its release
+import threading
+
+from app.crud import claim_post, create_job, get_post_by_hashed, publish_post, release_post
+from app.models import Job, Post
+
+def test_only_first_claim_wins(db):
+    assert claim_post("abc", "first", job_id=1) is True
+    assert claim_post("abc", "second", job_id=2) is False
+    post = Post.query.filter_by(hashed="abc").one()
+    assert (post.caption, post.job_id) == ("first", 1)
+
+def test_release_lets_the_reel_be_claimed_again(db):
+    assert claim_post("abc", "", job_id=1)
+    release_post("abc", 1)
+    assert Post.query.filter_by(hashed="abc").count() == 0
+    assert claim_post("abc", "", job_id=2) is True
+
+def test_release_keeps_claims_of_other_jobs(db):
+    claim_post("abc", "", job_id=1)
+    release_post("abc", 2)
+    assert Post.query.filter_by(hashed="abc").one().job_id == 1
+
+def test_release_keeps_published_posts(db):
+    claim_post("abc", "", job_id=1)
+    publish_post("abc", "media-1")
+    release_post("abc", 1)
+    post = get_post_by_hashed("abc")
+    assert post is not None and post.media_id == "media-1"
+
+def test_release_is_fenced_by_the_lease_token(db):
+    job = create_job("http://cdn/reel.mp4")
+    Job.query.filter_by(id=job.id).update({"lease_token": 2})
+    db.session.commit()
+    claim_post("abc", "", job_id=job.id)
+    # A worker that lost the job to another process must not drop the new owner's claim
+    release_post("abc", job.id, lease_token=1)
+    assert Post.query.filter_by(hashed="abc").count() == 1
+    release_post("abc", job.id, lease_token=2)
+    assert Post.query.filter_by(hashed="abc").count() == 0
+
+def test_concurrent_claims_have_one_winner(app, db):
+    results = []
+    barrier = threading.Barrier(8)
+
+    def claim(job_id):
+        with app.app_context():
+            barrier.wait()
+            results.append(claim_post("abc", "", job_id=job_id))
+            db.session.remove()
+
+    threads = [threading.Thread(target=claim, args=(job_id,)) for job_id in range(1, 9)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(results) == [False] * 7 + [True]
+    assert Post.query.filter_by(hashed="abc").count() == 1
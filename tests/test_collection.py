@@ -0,0 +1,56 @@
+# Tests for the post collection API: keyset pagination and conditional requests
+from datetime import datetime
+
+import pytest
+
+from app.collection import invalidate_collection
+from app.crud import create_post
+from app.models import Post
+
+@pytest.fixture
+def client(app, db):
+    """A test client over a collection of seven posts, five of them stored in the same second."""
+    same_time = datetime(2025, 1, 1, 12, 0, 0)
+    times = [datetime(2025, 1, 1, 11, 0, 0)] + [same_time] * 5 + [datetime(2025, 1, 1, 13, 0, 0)]
+    db.session.add_all(Post(caption=f"post {i}", hashed=f"{i:064x}", media_id=f"media-{i}", created_at=created_at)
+                       for i, created_at in enumerate(times))
+    db.session.commit()
+    invalidate_collection()  # Pages cached by earlier tests show other rows
+    return app.test_client()
+
+def test_cursor_pages_through_equal_times_without_duplicates_or_gaps(client):
+    seen = []
+    cursor = None
+    while True:
+        response = client.get("/posts/", query_string={"limit": 2, **({"cursor": cursor} if cursor else {})})
+        assert response.status_code == 200
+        page = response.get_json()
+        assert len(page["posts"]) <= 2
+        seen.extend(post["id"] for post in page["posts"])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    expected = [post.id for post in Post.query.order_by(Post.created_at.desc(), Post.id.desc())]
+    assert seen == expected
+    assert len(set(seen)) == 7
+
+def test_malformed_cursor_is_a_bad_request(client):
+    for cursor in ("not-a-cursor", "!!!", "MjAyNg"):
+        response = client.get("/posts/", query_string={"cursor": cursor})
+        assert response.status_code == 400
+        assert "Invalid cursor" in response.get_json()["error"]
+
+def test_unchanged_page_is_not_modified(client):
+    response = client.get("/posts/")
+    etag = response.headers["ETag"]
+    assert response.status_code == 200
+    assert client.get("/posts/", headers={"If-None-Match": etag}).status_code == 304
+    assert client.get("/posts/", headers={"If-None-Match": '"stale"'}).status_code == 200
+
+def test_etag_changes_when_a_post_is_added(client):
+    etag = client.get("/posts/").headers["ETag"]
+    create_post("new post", "f" * 64)  # Invalidates the cached pages
+    response = client.get("/posts/", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert response.get_json()["posts"][0]["caption"] == "new post"
@@ -0,0 +1,128 @@
+# Tests for the ranged video downloader, over a fake CDN session
+import io
+import threading
+import time
+
+import pytest
+
+from app.download import DownloadError, DownloadTimeout, RangedDownloader
+
+VIDEO = bytes(range(256)) * 400  # 102400 bytes
+
+class FakeRaw(io.BytesIO):
+    """A response body, optionally cut short or slowed down."""
+
+    decode_content = False
+
+    def __init__(self, data, delay=0.0):
+        super().__init__(data)
+        self.delay = delay
+
+    def readinto(self, buffer):
+        time.sleep(self.delay)
+        return super().readinto(buffer)
+
+class FakeResponse:
+    """A streamed response of the fake CDN."""
+
+    def __init__(self, status_code, data=b"", headers=None, delay=0.0):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.raw = FakeRaw(data, delay)
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+class FakeCDN:
+    """
+    Stands in for the downloader's session, serving ``video``.
+
+    Args:
+        ranges (bool): Whether byte ranges are honoured (206) or ignored (200 with the whole video).
+        cut (dict): Range start -> number of bytes after which the connection drops, once.
+        delay (float): Seconds each read of a response body takes.
+    """
+
+    def __init__(self, video, ranges=True, cut=None, delay=0.0):
+        self.video = video
+        self.ranges = ranges
+        self.cut = dict(cut or {})
+        self.delay = delay
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def get(self, url, headers=None, stream=False, timeout=None):
+        start, _, end = headers["Range"][len("bytes="):].partition("-")
+        start, end = int(start), int(end) + 1 if end else len(self.video)
+        with self._lock:
+            self.requests.append((start, end))
+            cut = self.cut.pop(start, None)
+        if not self.ranges:
+            return FakeResponse(200, self.video, {"Content-Length": str(len(self.video))}, self.delay)
+        end = min(end, len(self.video))
+        body = self.video[start:end]
+        if cut is not None:
+            body = body[:cut]
+        headers = {"Content-Range": f"bytes {start}-{end - 1}/{len(self.video)}"}
+        return FakeResponse(206, body, headers, self.delay)
+
+def make_downloader(cdn, **kwargs):
+    """A downloader with small parts and no backoff delays, over a fake CDN."""
+    options = dict(part_size=16 * 1024, parallelism=3, chunk_size=4096, backoff_base=0)
+    options.update(kwargs)
+    downloader = RangedDownloader(**options)
+    downloader.session = cdn
+    return downloader
+
+def download(downloader, max_bytes=10 ** 9):
+    """Download the fake video, returning the bytes in the order the sink got them."""
+    received = bytearray()
+    total = downloader.download("https://cdn.test/video.mp4", lambda chunk: received.extend(chunk), max_bytes)
+    assert total == len(received)
+    return bytes(received)
+
+def test_server_ignoring_ranges_is_streamed_whole():
+    cdn = FakeCDN(VIDEO, ranges=False)
+    assert download(make_downloader(cdn)) == VIDEO
+    assert len(cdn.requests) == 1
+
+def test_parts_are_fetched_by_range_and_delivered_in_order():
+    # Later parts come back first, as the first one streams slowly
+    cdn = FakeCDN(VIDEO, delay=0.001)
+    assert download(make_downloader(cdn)) == VIDEO
+    starts = sorted(start for start, _ in cdn.requests)
+    assert starts == list(range(0, len(VIDEO), 16 * 1024))
+    assert all(end - start <= 16 * 1024 for start, end in cdn.requests)
+
+def test_short_read_is_resumed_from_the_last_byte():
+    cdn = FakeCDN(VIDEO, cut={0: 5000, 32 * 1024: 100})
+    assert download(make_downloader(cdn)) == VIDEO
+    assert (5000, 16 * 1024) in cdn.requests
+    assert (32 * 1024 + 100, 48 * 1024) in cdn.requests
+
+def test_video_over_the_size_limit_is_rejected():
+    with pytest.raises(DownloadError, match="too large"):
+        download(make_downloader(FakeCDN(VIDEO)), max_bytes=len(VIDEO) - 1)
+    with pytest.raises(DownloadError, match="too large"):
+        download(make_downloader(FakeCDN(VIDEO, ranges=False)), max_bytes=len(VIDEO) - 1)
+
+def test_stream_without_length_is_cut_at_the_size_limit():
+    cdn = FakeCDN(VIDEO, ranges=False)
+    original = cdn.get
+
+    def without_length(*args, **kwargs):
+        response = original(*args, **kwargs)
+        response.headers = {}
+        return response
+
+    cdn.get = without_length
+    with pytest.raises(DownloadError, match="exceeded"):
+        download(make_downloader(cdn), max_bytes=len(VIDEO) // 2)
+
+def test_stalled_download_runs_into_the_total_deadline():
+    cdn = FakeCDN(VIDEO, delay=0.05)
+    started = time.monotonic()
+    with pytest.raises(DownloadTimeout):
+        download(make_downloader(cdn, total_timeout=0.2))
+    assert time.monotonic() - started < 2
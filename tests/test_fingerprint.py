@@ -0,0 +1,100 @@
+# Tests for the perceptual fingerprint and its multi-index Hamming search
+import random
+
+from app.fingerprint import FRAME_SIZE, FingerprintIndex, fingerprint_from_frames, from_hex, to_hex
+
+def flip(fingerprint, bits):
+    """Flip the given bit positions of a fingerprint."""
+    for bit in bits:
+        fingerprint ^= 1 << bit
+    return fingerprint
+
+def test_search_finds_fingerprint_within_distance():
+    index = FingerprintIndex()
+    index.add(0x0123456789ABCDEF, 1)
+    # Flips spread over every band, so no band matches exactly
+    assert index.search(flip(0x0123456789ABCDEF, [0, 20, 40, 60]), max_distance=8) == [1]
+    assert index.search(flip(0x0123456789ABCDEF, range(0, 64, 8)), max_distance=8) == [1]
+
+def test_search_ignores_fingerprint_beyond_distance():
+    index = FingerprintIndex()
+    index.add(0x0123456789ABCDEF, 1)
+    assert index.search(flip(0x0123456789ABCDEF, range(0, 64, 7)), max_distance=8) == []
+    assert index.search(0xFEDCBA9876543210, max_distance=8) == []
+
+def test_search_returns_every_match_closest_first():
+    index = FingerprintIndex()
+    index.add(flip(0, [1, 17, 33]), 1)
+    index.add(flip(0, [2]), 2)
+    index.add(flip(0, [3, 19, 35, 51, 4]), 3)
+    index.add(flip(0, range(0, 64, 6)), 4)  # 11 bits away
+    assert index.search(0, max_distance=8) == [2, 1, 3]
+
+def test_search_matches_linear_scan():
+    rng = random.Random(42)
+    stored = [rng.getrandbits(64) for _ in range(500)]
+    index = FingerprintIndex()
+    for post_id, fingerprint in enumerate(stored, start=1):
+        index.add(fingerprint, post_id)
+    assert len(index) == 500
+    for _ in range(200):
+        target = rng.choice(stored)
+        query = flip(target, rng.sample(range(64), rng.randint(0, 12)))
+        distances = {post_id: bin(fingerprint ^ query).count("1") for post_id, fingerprint in enumerate(stored, start=1)}
+        expected = sorted((distance, post_id) for post_id, distance in distances.items() if distance <= 8)
+        assert index.search(query, max_distance=8) == [post_id for _, post_id in expected]
+
+def test_refresh_loads_only_new_posts(db):
+    from app.models import Post
+    index = FingerprintIndex()
+    db.session.add(Post(caption="", hashed="a", fingerprint=to_hex(0xFFFF), hash_version=1))
+    db.session.add(Post(caption="", hashed="b", fingerprint=None, hash_version=1))
+    db.session.commit()
+    index.refresh(db.session, Post)
+    assert len(index) == 1
+    db.session.add(Post(caption="", hashed="c", fingerprint=to_hex(0xFFFF0000), hash_version=1))
+    db.session.commit()
+    index.refresh(db.session, Post)
+    assert len(index) == 2
+    assert index.search(0xFFFF0000, max_distance=0) == [Post.query.filter_by(hashed="c").one().id]
+
+def test_fingerprint_from_frames():
+    # Brightness falling from left to right sets every bit; a flat frame has no fingerprint
+    frame = bytes(255 - 20 * (index % 9) for index in range(FRAME_SIZE))
+    assert fingerprint_from_frames(frame * 3) == (1 << 64) - 1
+    assert fingerprint_from_frames(bytes(FRAME_SIZE)) is None
+    assert fingerprint_from_frames(b"") is None
+    assert from_hex(to_hex(0x1F)) == 0x1F and to_hex(None) is None
+
+def test_refresh_picks_up_posts_committed_out_of_id_order(db):
+    from app.models import Post
+    index = FingerprintIndex()
+    # Post 5 commits first; post 3, inserted earlier by a slower transaction, commits after the refresh
+    db.session.add(Post(id=5, caption="", hashed="late-id", fingerprint=to_hex(0xFFFF), hash_version=1))
+    db.session.commit()
+    index.refresh(db.session, Post)
+    db.session.add(Post(id=3, caption="", hashed="early-id", fingerprint=to_hex(0xFFFF0000), hash_version=1))
+    db.session.commit()
+    index.refresh(db.session, Post)
+    index.refresh(db.session, Post)
+    assert len(index) == 2  # Each post is indexed once
+    assert index.search(0xFFFF0000, max_distance=0) == [3]
+
+def test_near_duplicate_skips_released_and_own_claims(db, monkeypatch):
+    from types import SimpleNamespace
+    import app.fingerprint as fingerprint
+    from app.models import Post
+    from app.worker import find_near_duplicate
+    monkeypatch.setattr(fingerprint, "_index", FingerprintIndex())  # Not the index of earlier tests
+    db.session.add_all([
+        Post(id=1, caption="", hashed="released", fingerprint=to_hex(0), hash_version=1),
+        Post(id=2, caption="", hashed="own-claim", fingerprint=to_hex(1), job_id=7, hash_version=1),
+        Post(id=3, caption="", hashed="other", fingerprint=to_hex(3), job_id=8, hash_version=1),
+    ])
+    db.session.commit()
+    fingerprint.get_fingerprint_index().refresh(db.session, Post)
+    Post.query.filter_by(id=1).delete()
+    db.session.commit()
+    assert find_near_duplicate(0, SimpleNamespace(id=7)).id == 3
+    assert find_near_duplicate(0, SimpleNamespace(id=8)).id == 2
+    assert find_near_duplicate(0xFFFFFFFF, SimpleNamespace(id=7)) is None
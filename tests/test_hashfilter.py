@@ -0,0 +1,58 @@
+# Tests for the known-hash filter in front of the post lookup
+from app.crud import claim_post, get_post_by_hashed, publish_post
+from app.hashfilter import BloomFilter, KnownHashFilter, get_hash_filter, reload_hash_filter
+from app.models import Post
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = BloomFilter(1000, 0.01)
+    items = [f"hash-{index}" for index in range(1000)]
+    for item in items:
+        bloom.add(item)
+    assert all(item in bloom for item in items)
+    false_positives = sum(f"other-{index}" in bloom for index in range(10000))
+    assert false_positives < 300  # About 1% expected
+
+def test_lookup_classifies_hashes():
+    hash_filter = KnownHashFilter(capacity=100, lru_size=2)
+    hash_filter.add("stored")
+    hash_filter.add("published", published=True)
+    assert hash_filter.lookup("never-stored") == KnownHashFilter.MISS
+    assert hash_filter.lookup("stored") == KnownHashFilter.MAYBE
+    assert hash_filter.lookup("published") == KnownHashFilter.HIT
+
+def test_recent_hashes_are_evicted_oldest_first():
+    hash_filter = KnownHashFilter(capacity=100, lru_size=2)
+    for hashed in ("a", "b", "c"):
+        hash_filter.add(hashed, published=True)
+    assert hash_filter.lookup("a") == KnownHashFilter.MAYBE  # Still stored, no longer recent
+    assert hash_filter.lookup("c") == KnownHashFilter.HIT
+
+def test_load_reads_the_post_table(db):
+    db.session.add_all([
+        Post(caption="", hashed="claimed", hash_version=1),
+        Post(caption="", hashed="published", media_id="media-1", hash_version=1),
+    ])
+    db.session.commit()
+    hash_filter = KnownHashFilter(capacity=100)
+    hash_filter.load(db.session, Post)
+    assert hash_filter.lookup("claimed") == KnownHashFilter.MAYBE
+    assert hash_filter.lookup("published") == KnownHashFilter.HIT
+    assert hash_filter.lookup("missing") == KnownHashFilter.MISS
+
+def test_claims_and_publishes_update_the_filter(db):
+    assert get_hash_filter().lookup("abc") == KnownHashFilter.MISS
+    claim_post("abc", "", job_id=1)
+    assert get_hash_filter().lookup("abc") == KnownHashFilter.MAYBE
+    publish_post("abc", "media-1")
+    assert get_hash_filter().lookup("abc") == KnownHashFilter.HIT
+    assert get_post_by_hashed("abc").media_id == "media-1"
+
+def test_reload_picks_up_hashes_stored_elsewhere(db):
+    get_hash_filter()
+    # Stored by another process: this process's filter does not know the hash yet
+    db.session.add(Post(caption="", hashed="abc", media_id="media-1", hash_version=1))
+    db.session.commit()
+    assert get_post_by_hashed("abc") is None
+    assert reload_hash_filter() is True
+    assert get_hash_filter().lookup("abc") == KnownHashFilter.HIT
+    assert get_post_by_hashed("abc").media_id == "media-1"
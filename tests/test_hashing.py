@@ -0,0 +1,51 @@
+# Tests for the versioned content hashing engine
+import hashlib
+import random
+
+import pytest
+
+from app.config import Config
+from app.hashing import StreamHasher, hash_file
+
+VIDEO = random.Random(0).randbytes(300_000)
+
+def expected():
+    """The one-shot digests of the video under each version."""
+    return {1: hashlib.sha256(VIDEO).hexdigest(), 2: hashlib.blake2b(VIDEO, digest_size=32).hexdigest()}
+
+@pytest.fixture(params=[0, 2], ids=["inline", "pooled"])
+def threads(request, monkeypatch):
+    """Hash on the calling thread, or on a pool of hashing threads."""
+    monkeypatch.setattr(Config, "HASH_THREADS", request.param)
+    return request.param
+
+# Byte by byte is slow, so that case hashes the start of the video only
+@pytest.mark.parametrize("chunk_size, length", [(1, 5000), (1000, None), (4096, None), (65_536, None),
+                                                (100_000, None), (300_000, None)])
+def test_chunks_in_a_reused_buffer_hash_like_one_shot(threads, chunk_size, length):
+    video = VIDEO[:length]
+    hasher = StreamHasher([1, 2], buffer_size=64 * 1024)
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    for start in range(0, len(video), chunk_size):
+        size = len(video[start:start + chunk_size])
+        buffer[:size] = video[start:start + size]
+        hasher(view[:size])
+        buffer[:size] = b"\0" * size  # The caller reuses its buffer once the call returns
+    assert hasher.hexdigests() == {1: hashlib.sha256(video).hexdigest(),
+                                   2: hashlib.blake2b(video, digest_size=32).hexdigest()}
+
+def test_immutable_parts_are_hashed_like_one_shot(threads):
+    # Parts of a ranged download: bytes objects at least as large as the buffer, after a small first chunk
+    hasher = StreamHasher([1, 2], buffer_size=64 * 1024)
+    hasher(memoryview(bytearray(VIDEO[:1000])))
+    for start in range(1000, len(VIDEO), 100_000):
+        hasher(memoryview(VIDEO[start:start + 100_000]))
+    assert hasher.hexdigests() == expected()
+
+def test_empty_stream_and_files(tmp_path, threads):
+    assert StreamHasher([1, 2]).hexdigests() == {1: hashlib.sha256().hexdigest(),
+                                                 2: hashlib.blake2b(digest_size=32).hexdigest()}
+    path = tmp_path / "video.mp4"
+    path.write_bytes(VIDEO)
+    assert hash_file(path, [1, 2], buffer_size=50_000) == expected()
@@ -0,0 +1,171 @@
+# Tests for job leases, claiming and the fencing of writes made under a lost lease
+from concurrent.futures import Future
+from datetime import timedelta
+
+import pytest
+
+from app import leases, worker
+from app.crud import (claim_next_job, claim_post, create_job, get_orphaned_publishing_jobs, job_lease_name,
+                      publish_post, take_over_job, update_job)
+from app.leases import LeaseLost, acquire_lease, holds_lease, release_lease, renew_leases
+from app.models import Job, Lease, Post, utcnow
+from app.worker import fail_job, recover_jobs
+
+@pytest.fixture(autouse=True)
+def forget_leases():
+    """Forget the leases earlier tests left held by this process."""
+    with leases._held_lock:
+        leases._held.clear()
+
+def expire(name):
+    """Let a lease run out, as if its holder stopped renewing it a minute ago."""
+    Lease.query.filter_by(name=name).update({"expires_at": utcnow() - timedelta(minutes=1)})
+    leases.db.session.commit()
+
+def test_lease_is_exclusive_until_it_expires(db):
+    token = acquire_lease("work", 60)
+    assert token == 1 and holds_lease("work", token)
+    assert acquire_lease("work", 60) is None
+    expire("work")
+    assert not holds_lease("work", token)
+    # Taking over moves the token on, so the old holder is told apart
+    assert acquire_lease("work", 60) == 2
+    assert not holds_lease("work", token)
+
+def test_released_lease_keeps_its_token_growing(db):
+    token = acquire_lease("work", 60)
+    release_lease("work", token)
+    assert acquire_lease("work", 60) == token + 1
+    # A lease whose row was purged starts after the token the caller last saw
+    assert acquire_lease("fresh", 60, after=7) == 8
+
+def test_renewal_extends_held_leases_and_forgets_lost_ones(db):
+    kept = acquire_lease("kept", 60)
+    lost = acquire_lease("lost", 60)
+    expire("lost")
+    acquire_lease("lost", 60)  # Another holder, under a new token
+    with leases._held_lock:
+        leases._held["lost"] = lost
+    expire("kept")
+    assert renew_leases(60) == 1
+    assert holds_lease("kept", kept)
+    assert "lost" not in leases._held
+
+def test_claim_records_the_lease_token(db):
+    job = create_job("http://cdn/reel.mp4")
+    claimed = claim_next_job(60)
+    assert claimed.id == job.id and claimed.status == Job.RUNNING and claimed.attempts == 1
+    assert claimed.lease_token == claimed.held_token == 1
+    assert holds_lease(job_lease_name(job.id), claimed.held_token)
+    assert claim_next_job(60) is None  # Running under a live lease
+
+def test_claim_order_and_deferred_jobs(db):
+    low = create_job("http://cdn/low.mp4")
+    later = create_job("http://cdn/later.mp4", priority=5, run_after=utcnow() + timedelta(hours=1))
+    high = create_job("http://cdn/high.mp4", priority=1)
+    assert claim_next_job(60).id == high.id
+    assert claim_next_job(60).id == low.id
+    assert claim_next_job(60) is None
+    assert later.id not in {job.id for job in Job.query.filter_by(status=Job.RUNNING)}
+
+def test_expired_job_is_reclaimed_and_the_old_holder_is_fenced(db):
+    create_job("http://cdn/reel.mp4")
+    stale = claim_next_job(60)
+    db.session.expunge(stale)  # Held by another process from here on
+    expire(job_lease_name(stale.id))
+    current = claim_next_job(60)
+    assert current.id == stale.id and current.held_token == stale.held_token + 1 and current.attempts == 2
+    with pytest.raises(LeaseLost):
+        update_job(stale, Job.FAILED, error="paused past the lease")
+    update_job(current, Job.DONE)
+    assert db.session.get(Job, current.id).status == Job.DONE
+
+def test_orphaned_publishing_job_is_taken_over_once(db):
+    create_job("http://cdn/reel.mp4")
+    job = claim_next_job(60)
+    update_job(job, Job.PUBLISHING, container_id="container-1")
+    assert get_orphaned_publishing_jobs() == []
+    db.session.refresh(job)
+    db.session.expunge(job)  # The process that died
+    expire(job_lease_name(job.id))
+    orphans = get_orphaned_publishing_jobs()
+    assert [orphan.id for orphan in orphans] == [job.id]
+    assert take_over_job(orphans[0], 60) is True
+    assert orphans[0].held_token == job.held_token + 1
+    assert take_over_job(job, 60) is False  # The lease is live again
+    with pytest.raises(LeaseLost):
+        update_job(job, Job.DONE)
+
+def test_failed_job_is_requeued_until_it_runs_out_of_attempts(db):
+    job = create_job("http://cdn/reel.mp4")
+    for attempt in (1, 2, 3):
+        claimed = claim_next_job(60)
+        assert claimed.id == job.id and claimed.attempts == attempt
+        fail_job(claimed, f"failure {attempt}", max_attempts=3)
+        release_lease(job_lease_name(claimed.id), claimed.held_token)
+        failed = db.session.get(Job, job.id)
+        assert failed.error == f"failure {attempt}"
+        assert failed.status == (Job.FAILED if attempt == 3 else Job.PENDING)
+    assert claim_next_job(60) is None
+
+def orphan(db, hashed, container_id):
+    """A publishing job with a claimed post, left behind by a process that died."""
+    create_job(f"http://cdn/{hashed}.mp4")
+    job = claim_next_job(60)
+    claim_post(hashed, "", job_id=job.id)
+    update_job(job, Job.PUBLISHING, hashed=hashed, container_id=container_id)
+    db.session.refresh(job)
+    db.session.expunge(job)
+    expire(job_lease_name(job.id))
+    with leases._held_lock:
+        leases._held.clear()
+    return job
+
+class FakeInstagramAPI:
+    """Resumes containers from a table of outcomes: a media ID, or an exception raised when resuming."""
+
+    outcomes = {}
+    resumed = []
+
+    def __init__(self, account):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def resume_post(self, container_id, guard=None):
+        self.resumed.append(container_id)
+        outcome = self.outcomes[container_id]
+        if isinstance(outcome, Exception):
+            raise outcome
+        future = Future()
+        future.set_result(outcome)
+        return future
+
+def test_recovered_jobs_are_finished_resumed_or_failed(db, monkeypatch):
+    monkeypatch.setattr(worker, "InstagramAPI", FakeInstagramAPI)
+    monkeypatch.setattr(FakeInstagramAPI, "resumed", [])
+    monkeypatch.setattr(FakeInstagramAPI, "outcomes", {"resumed": "media-2", "gone": RuntimeError("container expired")})
+    published = orphan(db, "published", "published")
+    publish_post("published", "media-1")  # Published before the process died
+    resumed = orphan(db, "resumed", "resumed")
+    gone = orphan(db, "gone", "gone")
+
+    assert recover_jobs(60) == 3
+    db.session.expire_all()
+    # The published job is finished without publishing again
+    assert FakeInstagramAPI.resumed == ["resumed", "gone"]
+    assert db.session.get(Job, published.id).status == Job.DONE
+    # The resumed container is published and its claim recorded
+    assert db.session.get(Job, resumed.id).status == Job.DONE
+    assert Post.query.filter_by(hashed="resumed").one().media_id == "media-2"
+    # The container that cannot be resumed gives its claim back and the job is retried
+    assert db.session.get(Job, gone.id).status == Job.PENDING
+    assert "container expired" in db.session.get(Job, gone.id).error
+    assert Post.query.filter_by(hashed="gone").count() == 0
+    assert recover_jobs(60) == 0
+    # Its lease was released, so the retry can be claimed right away
+    assert claim_next_job(60).id == gone.id
@@ -0,0 +1,87 @@
+# Tests for the on-disk media cache and hashing videos through it
+import hashlib
+import os
+
+import app.core as core
+from app.mediacache import MediaCache
+
+VIDEO = bytes(range(256)) * 64
+
+class RecordingSink:
+    """A download sink keeping what it was fed since it was last reset."""
+
+    def __init__(self):
+        self.data = bytearray()
+        self.resets = 0
+
+    def __call__(self, chunk):
+        self.data += chunk
+
+    def reset(self):
+        self.data.clear()
+        self.resets += 1
+
+def cache_video(cache, data, url):
+    """Write a video through the cache like a download does."""
+    temp_file = cache.writer()
+    temp_file.write(data)
+    hashed = hashlib.sha256(data).hexdigest()
+    cache.commit(temp_file, hashed, url)
+    return hashed
+
+def test_commit_is_atomic_and_indexed_by_url(tmp_path):
+    cache = MediaCache(tmp_path, max_bytes=10 * len(VIDEO))
+    temp_file = cache.writer()
+    temp_file.write(VIDEO[:100])
+    # Until it is committed, the download is neither indexed nor stored as an object
+    assert cache.lookup("https://cdn.test/a.mp4") is None
+    assert not list((tmp_path / "objects").glob("*/*"))
+    temp_file.write(VIDEO[100:])
+    hashed = hashlib.sha256(VIDEO).hexdigest()
+    cache.commit(temp_file, hashed, "https://cdn.test/a.mp4")
+    found, path = cache.lookup("https://cdn.test/a.mp4")
+    assert found == hashed
+    assert path.read_bytes() == VIDEO
+    assert not os.listdir(tmp_path / "tmp")
+
+def test_discarded_download_leaves_nothing_behind(tmp_path):
+    cache = MediaCache(tmp_path, max_bytes=10 * len(VIDEO))
+    temp_file = cache.writer()
+    temp_file.write(VIDEO)
+    cache.discard(temp_file)
+    assert not os.listdir(tmp_path / "tmp")
+    assert cache.lookup("https://cdn.test/a.mp4") is None
+
+def test_least_recently_used_videos_are_evicted(tmp_path):
+    cache = MediaCache(tmp_path, max_bytes=2 * len(VIDEO))
+    videos = [bytes([i]) * len(VIDEO) for i in range(3)]
+    first = cache_video(cache, videos[0], "https://cdn.test/0.mp4")
+    second = cache_video(cache, videos[1], "https://cdn.test/1.mp4")
+    os.utime(cache.find(second), (1, 1))  # Used long before the first one
+    cache_video(cache, videos[2], "https://cdn.test/2.mp4")
+    assert cache.find(second) is None
+    assert cache.lookup("https://cdn.test/1.mp4") is None
+    assert cache.find(first) is not None
+    assert cache.lookup("https://cdn.test/2.mp4") is not None
+    assert cache.size() <= cache.max_bytes
+
+def test_failed_cache_read_restarts_the_sink_before_downloading(tmp_path, monkeypatch):
+    cache = MediaCache(tmp_path, max_bytes=10 * len(VIDEO))
+    cache_video(cache, VIDEO, "https://cdn.test/a.mp4")
+
+    def broken_read(path, sink):
+        sink(memoryview(VIDEO[:1000]))
+        raise OSError("I/O error")
+
+    def download(url, sink, max_bytes=None):
+        for start in range(0, len(VIDEO), 4096):
+            sink(memoryview(VIDEO[start:start + 4096]))
+
+    monkeypatch.setattr(core, "get_media_cache", lambda: cache)
+    monkeypatch.setattr(core, "read_video_from_file", broken_read)
+    monkeypatch.setattr(core, "stream_video", download)
+    sink = RecordingSink()
+    digests = core.get_hashes_from_video("https://cdn.test/a.mp4", [1, 2], sink=sink)
+    assert digests[1] == hashlib.sha256(VIDEO).hexdigest()
+    assert sink.resets == 1
+    assert bytes(sink.data) == VIDEO
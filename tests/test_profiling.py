@@ -0,0 +1,60 @@
+# Tests for the signed profiling header and the profile download route
+import time
+
+import pytest
+
+from app.config import Config
+from app.profiling import PROFILE_HEADER, find_profile, sign_profile_request, verify_profile_request
+
+PROFILE_NAME = "20261018T120000-webhook-0123abcd.prof"
+
+@pytest.fixture
+def profiles(tmp_path, monkeypatch):
+    """A signing key and a profile directory holding one profile, next to a file outside of it."""
+    monkeypatch.setattr(Config, "SECRET_KEY", "test-secret")
+    monkeypatch.setattr(Config, "PROFILE_DIR", str(tmp_path / "profiles"))
+    (tmp_path / "profiles").mkdir()
+    (tmp_path / "profiles" / PROFILE_NAME).write_bytes(b"profile")
+    (tmp_path / PROFILE_NAME).write_bytes(b"secret")
+    return tmp_path / "profiles"
+
+def test_valid_signature_is_accepted(profiles):
+    assert verify_profile_request(sign_profile_request())
+
+def test_tampered_signature_is_rejected(profiles):
+    value = sign_profile_request()
+    timestamp, _, signature = value.partition(".")
+    forged = signature[:-1] + ("0" if signature[-1] != "0" else "1")
+    assert not verify_profile_request(f"{timestamp}.{forged}")
+    # The signature does not carry over to another time
+    assert not verify_profile_request(f"{int(timestamp) + 1}.{signature}")
+    assert not verify_profile_request("not-a-signature")
+    assert not verify_profile_request(None)
+
+def test_expired_signature_is_rejected(profiles):
+    ttl = Config.PROFILE_SIGNATURE_TTL
+    assert verify_profile_request(sign_profile_request(time.time() - ttl + 5))
+    assert not verify_profile_request(sign_profile_request(time.time() - ttl - 5))
+    assert not verify_profile_request(sign_profile_request(time.time() + 3600))
+
+def test_nothing_is_accepted_without_a_secret_key(profiles, monkeypatch):
+    value = sign_profile_request()
+    monkeypatch.setattr(Config, "SECRET_KEY", None)
+    assert sign_profile_request() is None
+    assert not verify_profile_request(value)
+
+def test_profiles_outside_the_directory_are_not_found(profiles):
+    assert find_profile(PROFILE_NAME) == profiles / PROFILE_NAME
+    assert find_profile(f"../{PROFILE_NAME}") is None
+    assert find_profile(str(profiles.parent / PROFILE_NAME)) is None
+    assert find_profile("../../etc/passwd") is None
+
+def test_profile_route_requires_a_signature_and_stays_in_the_directory(app, profiles):
+    client = app.test_client()
+    assert client.get(f"/profiles/{PROFILE_NAME}").status_code == 403
+    headers = {PROFILE_HEADER: sign_profile_request()}
+    response = client.get(f"/profiles/{PROFILE_NAME}", headers=headers)
+    assert response.status_code == 200
+    assert response.data == b"profile"
+    for name in (f"..%2F{PROFILE_NAME}", f"..%2f..%2f{PROFILE_NAME}", "..%5C" + PROFILE_NAME):
+        assert client.get(f"/profiles/{name}", headers=headers).status_code == 404
@@ -0,0 +1,44 @@
+# Tests for the publishing quota, per process and shared through the database
+import pytest
+
+from app.quota import PublishQuota, SharedPublishQuota
+from app.scheduler import configure_schedulers
+
+def test_reserve_at_the_limit_is_rejected():
+    with pytest.raises(ValueError):
+        PublishQuota(limit=5, window=3600, reserve=5)
+    with pytest.raises(ValueError):
+        configure_schedulers((2.0, 30.0, 1.5, 1800.0), (5, 3600, 6, 300))
+
+def test_reported_limit_below_the_reserve_is_clamped():
+    quota = PublishQuota(limit=50, window=3600, reserve=10)
+    quota.sync(quota_usage=0, quota_total=5)
+    assert quota.snapshot()["limit"] == 11
+    assert quota.acquire() == 0.0
+    assert quota.acquire() > 0
+
+def test_processes_share_the_account_quota(app, db):
+    # Two processes publishing to the same account get the limit between them, not each
+    first = SharedPublishQuota(app, "acct", limit=4, window=86400, reserve=1)
+    second = SharedPublishQuota(app, "acct", limit=4, window=86400, reserve=1)
+    other = SharedPublishQuota(app, "other", limit=4, window=86400, reserve=1)
+    granted = [quota.acquire() == 0.0 for quota in (first, second, first, second, first)]
+    assert granted == [True, True, True, False, False]
+    assert second.acquire() > 0
+    assert other.acquire() == 0.0
+
+def test_shared_quota_is_seeded_from_the_graph_api(app, db):
+    first = SharedPublishQuota(app, "acct", limit=10, window=86400, reserve=0)
+    second = SharedPublishQuota(app, "acct", limit=10, window=86400, reserve=0)
+    first.sync(quota_usage=8)
+    assert round(second.snapshot()["tokens"]) == 2
+    assert second.projected_delays(3)[:2] == [0.0, 0.0]
+    assert second.acquire() == 0.0
+    assert first.acquire() == 0.0
+    assert second.acquire() > 0
+
+def test_exhausted_shared_quota_holds_every_process(app, db):
+    first = SharedPublishQuota(app, "acct", limit=10, window=86400, reserve=0)
+    second = SharedPublishQuota(app, "acct", limit=10, window=86400, reserve=0)
+    first.exhaust()
+    assert second.acquire() == pytest.approx(8640, rel=0.01)
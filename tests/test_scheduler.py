@@ -0,0 +1,102 @@
+# Tests for the container scheduler: status polling, the publish queue and its quota
+import time
+
+import requests
+
+from app.crud import claim_next_job, claim_post, create_job, update_job
+from app.models import Job, Post
+from app.scheduler import ContainerScheduler
+from app.worker import _track_publish
+
+class FakeAPI:
+    """A Graph API account whose containers finish after ``polls_to_finish`` checks."""
+
+    def __init__(self, polls_to_finish=1, status="finished"):
+        self.polls_to_finish = polls_to_finish
+        self.status = status
+        self.checks = []
+        self.check_times = []
+        self.publish_times = []
+        self.published = []  # Containers the "server" published
+        self.publish_errors = []  # Raised by the next publishes, after the server acted on them
+
+    def _check_container_status(self, container_id):
+        self.checks.append(container_id)
+        self.check_times.append(time.monotonic())
+        if container_id in self.published:
+            return "published"
+        return self.status if len(self.checks) >= self.polls_to_finish else "in_progress"
+
+    def _media_publish(self, container_id):
+        if container_id in self.published:
+            return None  # The API refuses to publish a container twice
+        self.published.append(container_id)
+        self.publish_times.append(time.monotonic())
+        if self.publish_errors:
+            raise self.publish_errors.pop(0)
+        return f"media-of-{container_id}"
+
+    def get_publishing_config(self, use_cache=True):
+        return None
+
+def make_scheduler(**kwargs):
+    """A scheduler checking containers every few milliseconds."""
+    options = dict(initial_interval=0.01, max_interval=0.05, backoff=2, max_wait=5)
+    options.update(kwargs)
+    return ContainerScheduler(**options, name="test-scheduler")
+
+def test_read_timeout_on_publish_does_not_publish_twice():
+    api = FakeAPI()
+    api.publish_errors.append(requests.ReadTimeout("read timed out"))
+    future = make_scheduler().submit(api, "container-1")
+    # The publish went through although its response was lost: the container ID stands in for the media ID
+    assert future.result(timeout=5) == "container-1"
+    assert api.published == ["container-1"]
+
+def wait_for(condition, timeout=5):
+    """Wait until ``condition()`` is true, e.g. for a callback running on the scheduler thread."""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+def test_checks_back_off_while_the_container_is_in_progress():
+    api = FakeAPI(polls_to_finish=6)
+    future = make_scheduler(initial_interval=0.02, backoff=2, max_interval=0.08).submit(api, "container-1")
+    assert future.result(timeout=5) == "media-of-container-1"
+    gaps = [later - earlier for earlier, later in zip(api.check_times, api.check_times[1:])]
+    # 0.02s, then twice as long after every check, up to the 0.08s cap
+    for gap, interval in zip(gaps, [0.04, 0.08, 0.08, 0.08, 0.08]):
+        assert interval - 0.005 <= gap < 2 * interval
+
+def test_failed_container_releases_the_claim_and_requeues_the_job(db):
+    create_job("http://cdn/reel.mp4")
+    job = claim_next_job(60)
+    claim_post("abc", "", job_id=job.id)
+    update_job(job, Job.PUBLISHING, hashed="abc", container_id="container-1")
+    future = make_scheduler().submit(FakeAPI(status="error"), "container-1")
+    _track_publish(job, future)
+    assert future.result(timeout=5) is None
+
+    def settled():
+        db.session.expire_all()
+        return db.session.get(Job, job.id).status != Job.PUBLISHING
+
+    wait_for(settled)
+    assert db.session.get(Job, job.id).status == Job.PENDING  # Attempts remain
+    assert Post.query.filter_by(hashed="abc").count() == 0  # A later attempt may claim the reel again
+
+def test_publishing_waits_while_the_quota_is_exhausted():
+    api = FakeAPI()
+    scheduler = make_scheduler()
+    scheduler.configure_quota(1, 0.5, 0, 300)  # One post per half second
+    first = scheduler.submit(api, "container-1")
+    second = scheduler.submit(api, "container-2")
+    assert first.result(timeout=5) == "media-of-container-1"
+    time.sleep(0.1)
+    assert not second.done()
+    snapshot = scheduler.snapshot()
+    assert snapshot["queue_depth"] == 1
+    assert snapshot["queue"][0]["container_id"] == "container-2"
+    assert second.result(timeout=5) == "media-of-container-2"
+    assert api.publish_times[1] - api.publish_times[0] >= 0.3
@@ -0,0 +1,77 @@
+# Tests for the retries of the shared Graph API transport
+import pytest
+import requests
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+
+from app.transport import GraphTransport
+
+class FakeSession:
+    """Stands in for the requests session, answering from a list of responses and exceptions."""
+
+    def __init__(self, outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = []
+
+    def request(self, method, url, **kwargs):
+        self.calls.append((method, url))
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+def make_response(status, body=b"{}"):
+    """A response with the given status code and JSON body."""
+    response = requests.Response()
+    response.status_code = status
+    response._content = body
+    return response
+
+def make_transport(outcomes):
+    """A transport without backoff delays over a fake session."""
+    transport = GraphTransport("http://graph.test/v20.0", max_retries=3, backoff_base=0)
+    transport.session = FakeSession(outcomes)
+    return transport
+
+def refused():
+    """The error of a connection that could not be opened."""
+    return requests.ConnectionError(MaxRetryError(None, "/", NewConnectionError(None, "Connection refused")))
+
+def test_get_is_retried_after_read_timeouts_and_5xx():
+    transport = make_transport([requests.ReadTimeout(), make_response(503), make_response(200)])
+    assert transport.get("me").status_code == 200
+    assert len(transport.session.calls) == 3
+
+def test_post_is_not_retried_after_a_read_timeout():
+    transport = make_transport([requests.ReadTimeout(), make_response(200, b'{"id": "2"}')])
+    with pytest.raises(requests.ReadTimeout):
+        transport.post("1/media_publish", endpoint="media_publish")
+    assert len(transport.session.calls) == 1
+
+def test_post_is_not_retried_after_a_5xx_response():
+    transport = make_transport([make_response(502), make_response(200)])
+    assert transport.post("1/media", endpoint="media").status_code == 502
+    assert len(transport.session.calls) == 1
+
+def test_post_is_retried_when_it_never_reached_the_server():
+    transport = make_transport([requests.ConnectTimeout(), refused(), make_response(200, b'{"id": "2"}')])
+    assert transport.post("1/media", endpoint="media").json() == {"id": "2"}
+    assert len(transport.session.calls) == 3
+
+def test_post_is_retried_when_rate_limited():
+    throttled = make_response(400, b'{"error": {"code": 4}}')
+    transport = make_transport([throttled, make_response(200, b'{"id": "2"}')])
+    assert transport.post("1/media_publish", endpoint="media_publish").json() == {"id": "2"}
+    assert len(transport.session.calls) == 2
+
+def test_throttle_only_holds_the_rate_limited_token(monkeypatch):
+    throttled = make_response(400, b'{"error": {"code": 4}}')
+    throttled.headers["Retry-After"] = "3600"
+    transport = make_transport([throttled, make_response(200)])
+    assert transport.get("me", params={"access_token": "busy"}).status_code == 400
+    sleeps = []
+    monkeypatch.setattr("app.transport.time.sleep", sleeps.append)
+    assert transport.get("me", params={"access_token": "idle"}).status_code == 200
+    assert sleeps == []
+    transport.session.outcomes.append(make_response(200))
+    transport.get("me", params={"access_token": "busy"})
+    assert sleeps and sleeps[0] > 0
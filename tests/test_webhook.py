@@ -0,0 +1,48 @@
+# Tests for the webhook's handling of redelivered messages
+import pytest
+
+import app.routes as routes
+from app.cache import TTLCache
+from app.models import Job
+
+def delivery(mid, timestamp=1700000000000):
+    """A webhook payload with one reel, as Meta sends (and resends) it."""
+    return {"entry": [{"id": "test-page", "messaging": [{
+        "sender": {"id": "sender"},
+        "recipient": {"id": "test-page"},
+        "timestamp": timestamp,
+        "message": {"mid": mid, "attachments": [
+            {"type": "ig_reel", "payload": {"url": f"https://cdn.test/{mid}.mp4", "title": "lol"}},
+        ]},
+    }]}]}
+
+@pytest.fixture
+def client(app, db, monkeypatch):
+    """A test client with an empty delivery cache holding at most one delivery."""
+    monkeypatch.setattr(routes, "delivery_cache", TTLCache(60, max_entries=1))
+    return app.test_client()
+
+def statuses(response):
+    """The status of each attachment in a webhook response."""
+    return [item["status"] for item in response.get_json()["items"]]
+
+def test_delivery_cache_is_sized_from_the_settings():
+    from app.config import get_settings
+    settings = get_settings()
+    assert routes.delivery_cache._ttl == settings.DELIVERY_DEDUP_TTL
+    assert routes.delivery_cache._max_entries == settings.DELIVERY_DEDUP_SIZE
+
+def test_redelivery_is_dropped_in_process(client):
+    assert statuses(client.post("/webhook/", json=delivery("m1"))) == ["queued"]
+    assert statuses(client.post("/webhook/", json=delivery("m1"))) == ["redelivered"]
+    # A later message with the same ID is a different delivery
+    assert statuses(client.post("/webhook/", json=delivery("m1", timestamp=1700000000001))) == ["queued"]
+    assert Job.query.count() == 2
+
+def test_redelivery_forgotten_by_the_process_is_dropped_by_the_job_key(client):
+    assert statuses(client.post("/webhook/", json=delivery("m1"))) == ["queued"]
+    # Pushes m1 out of the one-entry cache, as another process would never have seen it
+    assert statuses(client.post("/webhook/", json=delivery("m2"))) == ["queued"]
+    assert routes.delivery_cache.get("m1:1700000000000:0") is None
+    assert statuses(client.post("/webhook/", json=delivery("m1"))) == ["redelivered"]
+    assert Job.query.count() == 2